@@ -1,24 +1,205 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, stream_template, g, has_request_context
+from flask import before_render_template, template_rendered, stream_with_context, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, or_, event, func, text, table, column, literal_column, select, bindparam
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, contains_eager
+from sqlalchemy.orm.exc import StaleDataError
+from markupsafe import Markup, escape
+from jinja2 import FileSystemBytecodeCache, pass_context
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+from functools import lru_cache, wraps
+from types import MappingProxyType
+from urllib.parse import urlsplit
+import base64
+import binascii
+import click
+import cProfile
+import csv
+import difflib
+import hashlib
+import hmac
+import json
+import math
+import mimetypes
 import os
-from config import Config
+import random
+import re
+import sqlite3
+import tarfile
+import threading
+import time
+import tempfile
+import unicodedata
+import zlib
+from config import Config, PLACEHOLDER_SECRET_KEY
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are served at full size only
+    Image = None
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # boto3 is only needed for STORAGE_BACKEND = 's3'
+    boto3 = None
+
+try:
+    import numpy as np
+    import scipy.sparse as sparse
+except ImportError:  # related notes are not shown
+    np = sparse = None
+
+try:
+    import zstandard
+except ImportError:  # note bodies are compressed with zlib instead
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # responses are compressed with gzip only
+    brotli = None
 
 
 # Initialize Flask application
 app = Flask(__name__)
 app.config.from_object(Config)
+# Deployment overrides from instance/config.py and the environment, e.g. FLASK_SQLITE_BUSY_TIMEOUT=10000
+app.config.from_pyfile(os.path.join(app.instance_path, 'config.py'), silent=True)
+app.config.from_prefixed_env()
 db = SQLAlchemy(app)
 
 
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    """Tune every new SQLite connection for several worker processes sharing one file"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    cursor.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    cursor.execute(f"PRAGMA cache_size = {int(app.config['SQLITE_CACHE_SIZE'])}")
+    cursor.close()
+    # Plain text of a note body, for the search index triggers and the note_plain view
+    dbapi_connection.create_function('note_text', 1, decompress_text, deterministic=True)
+
+
+def create_app():
+    """Prepare the application for a WSGI server without seeding the database
+
+    Routes are registered on the module-level app, so this returns that app once
+    the folders it writes to exist. Seed the database once per deployment with
+    `flask --app app init-db` instead of on every worker boot.
+    """
+    if app.config['SECRET_KEY'] == PLACEHOLDER_SECRET_KEY and not (app.debug or app.testing):
+        raise RuntimeError('SECRET_KEY is the placeholder from config.py; set FLASK_SECRET_KEY or '
+                           'SECRET_KEY in instance/config.py to a long random value')
+    create_folders()
+    return app
+
+
+def create_folders():
+    """Create the folders the app writes to, including the compiled template cache"""
+    os.makedirs(app.instance_path, exist_ok=True)
+    if app.config['STORAGE_BACKEND'] == 'local':
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    # Compiled templates are kept on disk, so new worker processes load them instead of compiling
+    if app.config['JINJA_BYTECODE_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE_DIR'])
+
+
+# Compressed note bodies
+#
+# Note bodies of NOTE_COMPRESS_MIN_BYTES or more are stored as zstd (or zlib) compressed BLOBs
+# in the same column, shorter ones as plain TEXT, and CompressedText converts transparently.
+# SQL that reads note.notes directly has to call note_text(notes), which configure_sqlite()
+# registers on every connection; the search index reads the note_plain view for this reason.
+# The sqlite3 shell does not know note_text(), so write notes through the app.
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def compress_text(value):
+    """Compressed bytes of a long text, or the text itself when compression does not pay off"""
+    method = app.config['NOTE_COMPRESSION']
+    if not isinstance(value, str) or not method:
+        return value
+    data = value.encode()
+    if len(data) < app.config['NOTE_COMPRESS_MIN_BYTES']:
+        return value
+    if method == 'zstd' and zstandard is not None:
+        compressed = zstandard.ZstdCompressor(level=app.config['NOTE_COMPRESSION_LEVEL']).compress(data)
+    else:
+        compressed = zlib.compress(data, min(app.config['NOTE_COMPRESSION_LEVEL'], 9))
+    return compressed if len(compressed) < len(data) else value
+
+
+def decompress_text(value):
+    """Text of a stored note body, whether it was compressed or not"""
+    if not isinstance(value, bytes):
+        return value
+    if value.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError('A note body is zstd-compressed; install the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(value).decode()
+    return zlib.decompress(value).decode()
+
+
+class CompressedText(db.TypeDecorator):
+    """Text column whose long values are stored compressed, see compress_text()"""
+    impl = db.Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+
 # Define database models
 
+# SQLite's clock in the layout SQLAlchemy writes DateTime values in. It is read inside the
+# writing statement, and SQLite admits one writer at a time, so rows stamped with it are
+# committed in timestamp order (see api_v1_sync()).
+SQL_NOW = func.strftime('%Y-%m-%d %H:%M:%f000', 'now')
+
+class User(db.Model):
+    """Student account; notes, current courses and elective names belong to a user"""
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), nullable=False, unique=True)
+    password_hash = db.Column(db.String(256), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def set_password(self, password):
+        self.password_hash = generate_password_hash(password)
+
+    def check_password(self, password):
+        return check_password_hash(self.password_hash, password)
+
+
 class Department(db.Model):
     """Department model representing university departments"""
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     courses = db.relationship('Course', backref='department', lazy=True)
 
+    __table_args__ = (
+        db.Index('uq_department_name', 'name', unique=True),
+    )
+
 
 class Course(db.Model):
     """Course model representing courses offered by departments"""
@@ -27,78 +208,1476 @@ class Course(db.Model):
     year = db.Column(db.Integer, nullable=False)
     semester = db.Column(db.String(20), nullable=False)
     course_name = db.Column(db.String(200), nullable=False)
+    # Catalogue code such as 'MATH 1131'; with department, year and semester it identifies
+    # the course in data/catalogue.csv even after an elective is renamed
+    code = db.Column(db.String(50))
     notes = db.relationship('Note', backref='course', lazy=True)
 
+    __table_args__ = (
+        # courses(): filter_by(department_id, year)
+        db.Index('ix_course_department_year', 'department_id', 'year'),
+        db.Index('uq_course_natural_key', 'department_id', 'year', 'semester', 'code', unique=True),
+    )
+
 
 
 class Note(db.Model):
     """Note model for storing course-related notes and images"""
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
-    notes = db.Column(db.Text)
+    notes = db.Column(CompressedText)
     image_path = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone(timedelta(hours=3))))
+    # Incremented on every write; ORM updates are conditional on it (optimistic concurrency)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # Time of the last write, which the delta-sync feed is ordered by
+    updated_at = db.Column(db.DateTime, default=SQL_NOW, onupdate=SQL_NOW)
+
+    # Uploaded image metadata, joined in so templates can build srcset without extra queries
+    image = db.relationship('ImageBlob', primaryjoin='foreign(Note.image_path) == ImageBlob.path',
+                            viewonly=True, lazy='joined')
+
+    __table_args__ = (
+        # all_notes(): (created_at, id) keyset pagination per user; SQLite appends the rowid to every index
+        db.Index('ix_note_user_created', 'user_id', 'created_at'),
+        # add_note(): a user's notes for one course, newest first
+        db.Index('ix_note_user_course_created', 'user_id', 'course_id', 'created_at'),
+        # api_v1_sync(): a user's notes changed since a sync token
+        db.Index('ix_note_user_updated', 'user_id', 'updated_at'),
+    )
+    __mapper_args__ = {'version_id_col': version}
+
+
+
+class ImageBlob(db.Model):
+    """Content-addressed uploaded image, shared by every note that uploads the same file"""
+    path = db.Column(db.String(200), primary_key=True)  # storage path, see store_upload()
+    sha256 = db.Column(db.String(64), nullable=False, unique=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    # Comma-separated widths of the generated WebP variants, set by the background worker
+    variant_widths = db.Column(db.String(100))
+
+    def variant_path(self, width):
+        return f"{os.path.splitext(self.path)[0]}_{width}.webp"
+
+    def srcset(self):
+        """srcset attribute value listing the WebP variants (empty until they are generated)"""
+        if not self.variant_widths:
+            return ''
+        return ', '.join(
+            f"{upload_url(self.variant_path(width))} {width}w"
+            for width in map(int, self.variant_widths.split(','))
+        )
 
 
 
+class TableVersion(db.Model):
+    """Write counter per table, bumped by triggers; drives the ETags of cached pages"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+
 class CurrentCourse(db.Model):
     """Current courses taken by the student in the current semester"""
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # A course is either current for a user or not; also serves toggle_current_course() lookups.
+        # Declared as a unique index so existing databases can get it without a table rebuild
+        db.Index('uq_current_course_user_course', 'user_id', 'course_id', unique=True),
+        # current_courses() lists them newest first without sorting
+        db.Index('ix_current_course_user_added', 'user_id', 'added_at'),
+    )
+
+
+class CourseNameOverride(db.Model):
+    """A user's own name for an elective course, shown instead of the catalogue name"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
+    course_name = db.Column(db.String(200), nullable=False)
+
+    __table_args__ = (
+        db.Index('uq_course_name_override_user_course', 'user_id', 'course_id', unique=True),
+    )
+
+
+class CourseNoteStats(db.Model):
+    """A user's note count, image count and latest note date for one course, kept by triggers"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True)
+    note_count = db.Column(db.Integer, nullable=False, default=0)
+    image_count = db.Column(db.Integer, nullable=False, default=0)
+    latest_note_at = db.Column(db.DateTime)
+
+
+class NoteRevision(db.Model):
+    """One saved version of a note, stored as a compressed delta against the previous revision"""
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), nullable=False)
+    version = db.Column(db.Integer, nullable=False)  # Note.version this revision holds
+    # Deltas since the last full snapshot; 0 means this revision is a snapshot
+    depth = db.Column(db.Integer, nullable=False)
+    delta = db.Column(db.LargeBinary, nullable=False)  # zlib-compressed JSON, see make_delta()
+    length = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Written by autosave, so later autosaves may be folded into it
+    autosave = db.Column(db.Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        db.Index('uq_note_revision_note_version', 'note_id', 'version', unique=True),
+    )
+
+
+class NoteTombstone(db.Model):
+    """A deleted note, kept for SYNC_TOMBSTONE_DAYS so that synced clients drop it too"""
+    note_id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_note_tombstone_user_deleted', 'user_id', 'deleted_at'),
+    )
+
+
+class RateLimitBucket(db.Model):
+    """Tokens left in a client's rate limit bucket, for RATE_LIMIT_BACKEND = 'database'"""
+    key = db.Column(db.String(200), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)  # time.time() of the last request
+
+
+# Request instrumentation
+#
+# Every request is timed and split into SQL time, query count and template render time.
+# Upload file I/O is timed too. The numbers feed the Prometheus histograms served by /metrics (per worker process),
+# an optional Server-Timing header, the N+1 query guard, and the slow-request profiler.
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:  # pyinstrument is optional; cProfile is used without it
+    SamplingProfiler = None
+
+# Only one profiler can run at a time in a process
+profiler_lock = threading.Lock()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    g.db_time = 0.0
+    g.render_time = 0.0
+    g.io_time = 0.0
+
+    config = app.config
+    if (config['PROFILE_SLOW_REQUESTS'] and random.random() < config['PROFILE_SAMPLE_RATE']
+            and profiler_lock.acquire(blocking=False)):
+        if SamplingProfiler:
+            g.profiler = SamplingProfiler()
+            g.profiler.start()
+        else:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """Count every SQL statement issued while handling a request"""
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    """Add the duration of each SQL statement to the request's DB time"""
+    started = conn.info.get('query_started')
+    if started and has_request_context():
+        g.db_time = g.get('db_time', 0.0) + time.perf_counter() - started.pop()
+
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    if 'render_started' in g:
+        g.render_time = g.get('render_time', 0.0) + time.perf_counter() - g.pop('render_started')
+
+
+class RouteMetrics:
+    """Per-endpoint request counters and latency histograms in Prometheus format"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)  # (endpoint, method, status) -> count
+        self._histograms = {}  # (endpoint, method) -> [bucket counts..., +Inf count, sum]
+        self._totals = defaultdict(float)  # (metric, endpoint) -> sum
+
+    def observe(self, endpoint, method, status, duration, db_time, query_count, render_time, io_time):
+        with self._lock:
+            self._requests[(endpoint, method, status)] += 1
+            histogram = self._histograms.setdefault((endpoint, method), [0] * (len(self.BUCKETS) + 2))
+            for i, bound in enumerate(self.BUCKETS):
+                if duration <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += duration
+            self._totals[('db_seconds', endpoint)] += db_time
+            self._totals[('db_queries', endpoint)] += query_count
+            self._totals[('template_seconds', endpoint)] += render_time
+            self._totals[('upload_io_seconds', endpoint)] += io_time
+
+    def render(self):
+        lines = [
+            '# HELP noteswise_requests_total Requests handled, by endpoint, method and status.',
+            '# TYPE noteswise_requests_total counter',
+        ]
+        with self._lock:
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append(f'noteswise_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+
+            lines += [
+                '# HELP noteswise_request_duration_seconds Request latency, by endpoint and method.',
+                '# TYPE noteswise_request_duration_seconds histogram',
+            ]
+            for (endpoint, method), histogram in sorted(self._histograms.items()):
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                for bound, count in zip(self.BUCKETS, histogram):
+                    lines.append(f'noteswise_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'noteswise_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram[-2]}')
+                lines.append(f'noteswise_request_duration_seconds_count{{{labels}}} {histogram[-2]}')
+                lines.append(f'noteswise_request_duration_seconds_sum{{{labels}}} {histogram[-1]:.6f}')
+
+            for metric, help_text in (('db_seconds', 'Time spent in SQL statements'),
+                                      ('db_queries', 'SQL statements issued'),
+                                      ('template_seconds', 'Time spent rendering templates'),
+                                      ('upload_io_seconds', 'Time spent writing uploaded files')):
+                lines += [f'# HELP noteswise_{metric}_total {help_text}, by endpoint.',
+                          f'# TYPE noteswise_{metric}_total counter']
+                for (name, endpoint), value in sorted(self._totals.items()):
+                    if name == metric:
+                        lines.append(f'noteswise_{metric}_total{{endpoint="{endpoint}"}} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+route_metrics = RouteMetrics()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Record the request's timings and dump a profile if it was slow"""
+    if 'request_started' not in g:
+        return response
+    duration = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+
+    if app.config['METRICS_ENABLED'] and endpoint != 'metrics':
+        route_metrics.observe(endpoint, request.method, response.status_code,
+                              duration, g.db_time, g.query_count, g.render_time, g.io_time)
+    if app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = (
+            f'db;dur={g.db_time * 1000:.1f};desc="{g.query_count} queries", '
+            f'tpl;dur={g.render_time * 1000:.1f}, io;dur={g.io_time * 1000:.1f}, total;dur={duration * 1000:.1f}'
+        )
+
+    profiler = g.pop('profiler', None)
+    if profiler:
+        try:
+            dump_profile(profiler, endpoint, duration)
+        finally:
+            profiler_lock.release()
+    return response
+
+
+@app.teardown_request
+def release_profiler(exc):
+    """Stop the profiler of a request whose after_request handlers did not run, e.g. because an
+    exception propagated, so that the next requests can be profiled"""
+    profiler = g.pop('profiler', None)
+    if profiler:
+        try:
+            if SamplingProfiler:
+                profiler.stop()
+            else:
+                profiler.disable()
+        finally:
+            profiler_lock.release()
+
+
+def dump_profile(profiler, endpoint, duration):
+    """Stop a request profiler and keep its output if the request was slow"""
+    if SamplingProfiler:
+        profiler.stop()
+    else:
+        profiler.disable()
+    if duration * 1000 < app.config['PROFILE_THRESHOLD_MS']:
+        return
+
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{endpoint}_{duration * 1000:.0f}ms"
+    path = os.path.join(app.config['PROFILE_DIR'], name)
+    if SamplingProfiler:
+        with open(path + '.html', 'w') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.dump_stats(path + '.prof')
+    app.logger.warning('Slow request %s %s took %.0f ms, profile saved to %s',
+                       request.method, request.full_path, duration * 1000, path)
+
+
+def metrics_authorized():
+    """True for scrapers that send METRICS_TOKEN as a bearer token or connect from METRICS_ALLOWED_IPS"""
+    token = app.config['METRICS_TOKEN']
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    return request.remote_addr in app.config['METRICS_ALLOWED_IPS']
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics of this worker process"""
+    if not app.config['METRICS_ENABLED'] or not metrics_authorized():
+        abort(404)
+    cache = catalogue_cache.stats()
+    fragments = fragment_cache.stats()
+    body = route_metrics.render() + (
+        '# HELP noteswise_catalogue_cache_hits_total Catalogue cache lookups served from memory.\n'
+        '# TYPE noteswise_catalogue_cache_hits_total counter\n'
+        f"noteswise_catalogue_cache_hits_total {cache['hits']}\n"
+        '# HELP noteswise_catalogue_cache_misses_total Catalogue cache lookups that hit the database.\n'
+        '# TYPE noteswise_catalogue_cache_misses_total counter\n'
+        f"noteswise_catalogue_cache_misses_total {cache['misses']}\n"
+        '# HELP noteswise_fragment_cache_hits_total Note cards and course items served from memory.\n'
+        '# TYPE noteswise_fragment_cache_hits_total counter\n'
+        f"noteswise_fragment_cache_hits_total {fragments['hits']}\n"
+        '# HELP noteswise_fragment_cache_misses_total Note cards and course items rendered.\n'
+        '# TYPE noteswise_fragment_cache_misses_total counter\n'
+        f"noteswise_fragment_cache_misses_total {fragments['misses']}\n"
+        '# HELP noteswise_fragment_cache_bytes HTML held by the fragment cache.\n'
+        '# TYPE noteswise_fragment_cache_bytes gauge\n'
+        f"noteswise_fragment_cache_bytes {fragments['bytes']}\n"
+    )
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+
+# Bulk endpoints whose query count grows with their input by design
+QUERY_COUNT_EXEMPT_ENDPOINTS = {'import_notes', 'api_v1_notes_batch'}
+
+
+@app.after_request
+def check_query_count(response):
+    """Warn (debug) or fail (testing) when a view issues too many SQL statements"""
+    limit = app.config['QUERY_COUNT_LIMIT']
+    if limit is None or not (app.debug or app.testing) or request.endpoint in QUERY_COUNT_EXEMPT_ENDPOINTS:
+        return response
+
+    count = g.get('query_count', 0)
+    if count > limit:
+        message = f'{request.method} {request.path} issued {count} SQL queries (limit {limit})'
+        if app.testing:
+            raise AssertionError(message)
+        app.logger.warning(message)
+    return response
+
+
+# Upload storage
+#
+# Uploaded files live in a storage backend addressed by relative paths with / separators:
+# LocalStorage keeps them under UPLOAD_FOLDER, S3Storage in an S3-compatible bucket (AWS S3,
+# MinIO, ...), so several app nodes can share them without a shared filesystem. Files are
+# written by staging them in a local temporary file first, because their path is their
+# content hash; S3 uploads and downloads above S3_MULTIPART_THRESHOLD are split into parts
+# that are transferred by S3_MAX_CONCURRENCY threads. Browsers fetch uploads from
+# /uploads/<path>, which serves local files directly and redirects to presigned URLs for S3.
+
+StoredFile = namedtuple('StoredFile', 'size mtime')
+
+
+class LocalStorage:
+    """Uploads in a directory on this machine"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def __str__(self):
+        return self.root
+
+    def full_path(self, path):
+        return os.path.join(self.root, path)
+
+    def temp_dir(self):
+        """Where files are staged before put(); the same filesystem, so put() is a rename"""
+        os.makedirs(self.root, exist_ok=True)
+        return self.root
+
+    def put(self, temp_path, path):
+        """Move a staged file to path; when path exists, refresh it and drop the staged copy"""
+        full_path = self.full_path(path)
+        if os.path.exists(full_path):
+            os.remove(temp_path)
+            # Freshen the shared file so gc-uploads leaves it alone until this upload commits
+            os.utime(full_path)
+        else:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(temp_path, full_path)
+
+    def open(self, path):
+        """Seekable binary file object; raises FileNotFoundError"""
+        return open(self.full_path(path), 'rb')
+
+    def read_chunks(self, path):
+        with self.open(path) as f:
+            while chunk := f.read(app.config['UPLOAD_CHUNK_SIZE']):
+                yield chunk
+
+    def stat(self, path):
+        """StoredFile of path, or None when it does not exist"""
+        try:
+            stat = os.stat(self.full_path(path))
+        except FileNotFoundError:
+            return None
+        return StoredFile(stat.st_size, stat.st_mtime)
+
+    def files(self):
+        """Every stored file as path -> StoredFile"""
+        files = {}
+        for root, dirs, names in os.walk(self.root):
+            for name in names:
+                full_path = os.path.join(root, name)
+                stat = os.stat(full_path)
+                files[os.path.relpath(full_path, self.root).replace(os.sep, '/')] = StoredFile(stat.st_size, stat.st_mtime)
+        return files
+
+    def delete(self, paths):
+        """Delete files, ignoring ones that are already gone"""
+        for path in paths:
+            try:
+                os.remove(self.full_path(path))
+            except FileNotFoundError:
+                pass
+
+    def url(self, path):
+        """External download URL, or None when the app serves the file itself"""
+        return None
+
+
+class S3Storage:
+    """Uploads in a bucket of an S3-compatible object store"""
+
+    def __init__(self, config):
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND = 's3' needs boto3 (pip install boto3)")
+        self.bucket = config['S3_BUCKET']
+        self.prefix = config['S3_PREFIX'] or ''
+        self.presign_expires = config['S3_PRESIGN_EXPIRES']
+        self.client = boto3.client(
+            's3',
+            endpoint_url=config['S3_ENDPOINT_URL'],
+            region_name=config['S3_REGION'],
+            aws_access_key_id=config['S3_ACCESS_KEY_ID'],
+            aws_secret_access_key=config['S3_SECRET_ACCESS_KEY'],
+            config=BotoConfig(
+                signature_version='s3v4',
+                # Self-hosted stores such as MinIO are addressed as <endpoint>/<bucket>
+                s3={'addressing_style': 'path' if config['S3_ENDPOINT_URL'] else 'auto'},
+                # One pooled connection per transfer thread, for every request thread
+                max_pool_connections=max(10, config['S3_MAX_CONCURRENCY'] * 4),
+            ),
+        )
+        self.transfer = TransferConfig(
+            multipart_threshold=config['S3_MULTIPART_THRESHOLD'],
+            multipart_chunksize=config['S3_MULTIPART_CHUNK_SIZE'],
+            max_concurrency=config['S3_MAX_CONCURRENCY'],
+        )
+
+    def __str__(self):
+        return f's3://{self.bucket}/{self.prefix}'
+
+    def key(self, path):
+        return self.prefix + path
+
+    def temp_dir(self):
+        return None  # the system temporary directory
+
+    def put(self, temp_path, path):
+        """Upload a staged file to path (in parallel parts when large) and remove the staged copy"""
+        try:
+            if self.stat(path):
+                self.touch(path)
+            else:
+                self.client.upload_file(temp_path, self.bucket, self.key(path), Config=self.transfer, ExtraArgs={
+                    'ContentType': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                    'CacheControl': f"public, max-age={app.config['STATIC_MAX_AGE']}, immutable",
+                })
+        finally:
+            os.remove(temp_path)
+
+    def touch(self, path):
+        """Refresh LastModified by copying the object onto itself"""
+        key = self.key(path)
+        head = self.client.head_object(Bucket=self.bucket, Key=key)
+        self.client.copy_object(Bucket=self.bucket, Key=key, CopySource={'Bucket': self.bucket, 'Key': key},
+                                MetadataDirective='REPLACE', Metadata=head.get('Metadata', {}),
+                                ContentType=head.get('ContentType', 'application/octet-stream'),
+                                CacheControl=head.get('CacheControl', ''))
+
+    def open(self, path):
+        """Download into a seekable temporary file, in parallel ranged parts when large"""
+        f = tempfile.SpooledTemporaryFile(max_size=app.config['S3_MULTIPART_THRESHOLD'])
+        try:
+            self.client.download_fileobj(self.bucket, self.key(path), f, Config=self.transfer)
+        except ClientError as e:
+            f.close()
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(path) from e
+            raise
+        f.seek(0)
+        return f
+
+    def read_chunks(self, path):
+        """Stream an object without holding it in memory"""
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key(path))['Body']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(path) from e
+            raise
+        with body:
+            yield from body.iter_chunks(app.config['UPLOAD_CHUNK_SIZE'])
+
+    def stat(self, path):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(path))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return StoredFile(head['ContentLength'], head['LastModified'].timestamp())
+
+    def files(self):
+        files = {}
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', ()):
+                files[item['Key'][len(self.prefix):]] = StoredFile(item['Size'], item['LastModified'].timestamp())
+        return files
+
+    def delete(self, paths):
+        paths = list(paths)
+        for start in range(0, len(paths), 1000):  # the most keys one DeleteObjects request takes
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self.key(path)} for path in paths[start:start + 1000]],
+                'Quiet': True,
+            })
+
+    def url(self, path):
+        """Presigned GET URL, so the object store serves the download instead of the app"""
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': self.key(path)},
+                                                  ExpiresIn=self.presign_expires)
+
+
+def make_storage(config):
+    backend = config['STORAGE_BACKEND']
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if backend == 's3':
+        return S3Storage(config)
+    raise RuntimeError(f'Unknown STORAGE_BACKEND {backend!r}')
+
+
+storage = make_storage(app.config)
+
+
+@app.template_global()
+def upload_url(path):
+    """URL of an uploaded file for templates"""
+    if app.config['UPLOAD_BASE_URL']:
+        return f"{app.config['UPLOAD_BASE_URL'].rstrip('/')}/{path}"
+    return url_for('serve_upload', path=path)
+
+
+# Only these are served from uploads, so a stored file can never become an HTML page of this site
+UPLOAD_MIMETYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+
+
+def is_served_upload(path):
+    """True for the upload paths /uploads and /static/uploads may serve"""
+    return mimetypes.guess_type(path)[0] in UPLOAD_MIMETYPES
+
+
+@app.before_request
+def guard_static_uploads():
+    """Uploads under static/ (the default UPLOAD_FOLDER) are served as images only, like /uploads"""
+    if request.endpoint == 'static' and request.view_args['filename'].startswith('uploads/') \
+            and not is_served_upload(request.view_args['filename']):
+        abort(404)
+
+
+@app.route('/uploads/<path:path>')
+def serve_upload(path):
+    """Send a local upload, or redirect to a presigned URL of the object store"""
+    if not is_served_upload(path):
+        abort(404)
+    url = storage.url(path)
+    if url:
+        response = redirect(url)
+        # Browsers may reuse the redirect while the signature is still valid
+        response.cache_control.private = True
+        response.cache_control.max_age = storage.presign_expires // 2
+        return response
+    response = send_from_directory(storage.root, path)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if CONTENT_ADDRESSED_UPLOAD.match(path):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+
+# Image upload pipeline
+#
+# Uploads are copied to a staging file in chunks while being hashed, stored once per SHA-256
+# as <first two hex digits>/<sha256><ext>, and reference-counted by ImageBlob.
+# Resized WebP variants are generated on a background worker pool.
+
+image_executor = ThreadPoolExecutor(max_workers=app.config['IMAGE_WORKERS']) if app.config['IMAGE_WORKERS'] else None
+
+
+def save_upload(file):
+    """Store an uploaded image by content hash and return its storage path"""
+    path, sha256 = store_image(file.stream, file.filename)
+    add_image_refs(path, sha256)
+    return path
+
+
+def store_image(stream, filename):
+    """Store an image named by its detected type; returns (path, sha256), or raises UploadRejected"""
+    # Checked before anything is written, and the stream need not be seekable (tar members)
+    head = stream.read(16)
+    mimetype = sniff_image(head)
+    if mimetypes.guess_type(filename)[0] != mimetype:
+        filename = 'image' + mimetypes.guess_extension(mimetype)
+    return store_upload(stream, filename, head)
+
+
+def store_upload(stream, filename, head=b''):
+    """Copy a stream, after the bytes already read from it, into storage under its content hash;
+    returns (path, sha256)"""
+    ext = os.path.splitext(secure_filename(filename))[1].lower()
+
+    started = time.perf_counter()
+    digest = hashlib.sha256(head)
+    fd, temp_path = tempfile.mkstemp(dir=storage.temp_dir(), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(head)
+            while chunk := stream.read(app.config['UPLOAD_CHUNK_SIZE']):
+                digest.update(chunk)
+                out.write(chunk)
+
+        sha256 = digest.hexdigest()
+        path = f"{sha256[:2]}/{sha256}{ext}"
+        storage.put(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if has_request_context():
+        g.io_time = g.get('io_time', 0.0) + time.perf_counter() - started
+    return path, sha256
+
+
+def add_image_refs(path, sha256, count=1):
+    """Atomically create the blob of a stored file or take more references to it"""
+    db.session.execute(
+        sqlite_insert(ImageBlob)
+        .values(path=path, sha256=sha256, ref_count=count)
+        .on_conflict_do_update(index_elements=['path'], set_={'ref_count': ImageBlob.ref_count + count})
+    )
+
+
+def schedule_variants(path):
+    """Generate image variants in the background, or inline when IMAGE_WORKERS is 0"""
+    if Image is None:
+        return
+    if image_executor:
+        image_executor.submit(generate_variants, path)
+    else:
+        generate_variants(path)
+
+
+def generate_variants(path):
+    """Write resized WebP variants of an image and record their widths on its blob"""
+    with app.app_context():
+        blob = db.session.get(ImageBlob, path)
+        if blob is None or blob.variant_widths:
+            return
+        try:
+            with storage.open(path) as f, Image.open(f) as original:
+                original = ImageOps.exif_transpose(original)
+                if original.mode not in ('RGB', 'RGBA'):
+                    original = original.convert('RGBA' if 'A' in original.getbands() else 'RGB')
+
+                widths = [w for w in app.config['IMAGE_VARIANT_WIDTHS'] if w < original.width]
+                for width in widths:
+                    variant = original.resize((width, round(original.height * width / original.width)),
+                                              Image.LANCZOS)
+                    fd, temp_path = tempfile.mkstemp(dir=storage.temp_dir(), suffix='.part')
+                    with os.fdopen(fd, 'wb') as out:
+                        variant.save(out, 'WEBP', quality=app.config['IMAGE_WEBP_QUALITY'])
+                    storage.put(temp_path, blob.variant_path(width))
+        except Exception:
+            app.logger.exception('Could not generate variants for %s', path)
+            return
+
+        if widths:
+            blob.variant_widths = ','.join(map(str, widths))
+            db.session.commit()
+
+
+def release_image(path):
+    """Drop one reference to an image; returns the files to delete once it is unused"""
+    blobs = ImageBlob.__table__
+    # Decremented in SQL, so a concurrent add_image_refs() from another worker is not overwritten
+    ref_count = db.session.execute(
+        blobs.update().where(blobs.c.path == path)
+        .values(ref_count=blobs.c.ref_count - 1)
+        .returning(blobs.c.ref_count)
+    ).scalar()
+    if ref_count is None:
+        # Uploaded before content addressing: the file belongs to this note alone
+        return [path]
+    if ref_count > 0:
+        return []
+
+    # The write lock is held from the UPDATE on, so no reference can be added before the delete
+    blob = db.session.get(ImageBlob, path)
+    files = [path]
+    if blob.variant_widths:
+        files += [blob.variant_path(width) for width in map(int, blob.variant_widths.split(','))]
+    db.session.delete(blob)
+    return files
+
+
+def remove_uploads(paths):
+    """Delete files from storage, ignoring ones that are already gone"""
+    if paths:
+        storage.delete(paths)
+
+
+# HTTP caching
+#
+# Catalogue pages get an ETag built from the versions of the tables they read, so a
+# revalidation costs one small query instead of the page's queries and rendering.
+# Static files are fingerprinted with ?v=<content hash> and cached as immutable.
+
+def build_fingerprint():
+    """Hash of the templates and static assets, so a deploy invalidates every ETag"""
+    digest = hashlib.sha256()
+    for folder in (app.template_folder, app.static_folder):
+        folder = os.path.join(app.root_path, folder)
+        for root, dirs, files in sorted(os.walk(folder)):
+            if os.path.relpath(root, folder).split(os.sep)[0] == 'uploads':
+                continue
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f:
+                    digest.update(name.encode() + f.read())
+    return digest.hexdigest()[:16]
+
+
+BUILD_FINGERPRINT = build_fingerprint()
+
+# Uploads named by content hash never change, see save_upload()
+CONTENT_ADDRESSED_UPLOAD = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{64}')
+
+
+def cached_view(*tables):
+    """Answer conditional GETs with 304 while none of the given tables has changed"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pages carrying flash messages are one-off renders
+            if '_flashes' in session:
+                return view(*args, **kwargs)
+
+            versions = TableVersion.query.filter(TableVersion.name.in_(tables)).all()
+            if len(versions) < len(tables):  # database not migrated yet
+                return view(*args, **kwargs)
+            user_id = g.user.id if g.user else 0
+            tag = hashlib.sha256('|'.join(
+                [BUILD_FINGERPRINT, request.full_path, str(user_id)] + [f'{v.name}:{v.version}' for v in versions]
+            ).encode()).hexdigest()[:32]
+            last_modified = max((v.updated_at for v in versions), default=None)
+
+            if request.if_none_match:
+                # Weak comparison: compress_response() turns the tag weak for compressed bodies
+                not_modified = request.if_none_match.contains_weak(tag)
+            else:
+                not_modified = (request.if_modified_since and last_modified
+                                and last_modified.replace(tzinfo=timezone.utc) <= request.if_modified_since)
+
+            response = app.response_class(status=304) if not_modified else app.make_response(view(*args, **kwargs))
+            response.set_etag(tag)
+            if last_modified:
+                response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+@lru_cache(maxsize=256)
+def static_fingerprint(path, mtime_ns):
+    """Short content hash of a static file (recomputed when its mtime changes)"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    """Append ?v=<content hash> to static asset URLs"""
+    if endpoint != 'static' or values.get('filename', '').startswith('uploads/'):
+        return
+    path = os.path.join(app.static_folder, values['filename'])
+    try:
+        values['v'] = static_fingerprint(path, os.stat(path).st_mtime_ns)
+    except OSError:
+        pass
+
+
+@app.after_request
+def static_cache_headers(response):
+    """Cache fingerprinted assets and content-addressed uploads for a year"""
+    if request.endpoint != 'static' or response.status_code not in (200, 304):
+        return response
+
+    filename = request.view_args['filename']
+    if filename.startswith('uploads/'):
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+    # Uploads under static/ are still served there for pages rendered before /uploads existed
+    immutable = filename.startswith('uploads/') and bool(CONTENT_ADDRESSED_UPLOAD.match(filename[len('uploads/'):]))
+    if not immutable and request.args.get('v'):
+        path = os.path.join(app.static_folder, filename)
+        immutable = request.args['v'] == static_fingerprint(path, os.stat(path).st_mtime_ns)
+
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+
+# Response compression
+#
+# Text responses of COMPRESS_MIN_SIZE bytes or more are compressed with brotli (when the
+# brotli package is installed) or gzip, whichever the client prefers. Streamed responses
+# (stream=1 pages, static files) are compressed chunk by chunk and flushed after each
+# chunk, so the browser still renders them progressively.
+
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'image/svg+xml'}
+
+
+def response_encoder(encoding):
+    """Return (compress(chunk), finish()) for a brotli or gzip stream"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+        return (lambda chunk: compressor.process(chunk) + compressor.flush()), compressor.finish
+    compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)  # 31: gzip container
+    return (lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+
+
+def compressed_chunks(body, encoding):
+    """Compress an iterable response body as it is produced"""
+    compress, finish = response_encoder(encoding)
+    for chunk in body:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if chunk:
+            yield compress(chunk)
+    yield finish()
+
+
+@app.after_request
+def compress_response(response):
+    """Compress text responses with the best encoding the client accepts"""
+    if not app.config['COMPRESS_RESPONSES'] or (
+            not response.mimetype.startswith('text/') and response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if (request.method == 'HEAD' or response.status_code != 200 or 'Content-Encoding' in response.headers
+            or (response.content_length or float('inf')) < app.config['COMPRESS_MIN_SIZE']):
+        return response
+
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding is None:
+        return response
+
+    if response.is_streamed or response.direct_passthrough:
+        body = response.response
+        response.response = compressed_chunks(body, encoding)
+        response.direct_passthrough = False
+        if hasattr(body, 'close'):
+            response.call_on_close(body.close)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        compress, finish = response_encoder(encoding)
+        response.set_data(compress(data) + finish())
+
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Accept-Ranges', None)
+    # The compressed bytes differ from the identity ones, so a strong validator would be wrong
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# In-process catalogue cache
+#
+# Departments and courses only change when the catalogue is loaded, and a user's current
+# course set only through toggle_current_course(), so both are held in memory as
+# immutable tuples. Local writes invalidate them at once; writes made by other worker
+# processes are noticed through table_version, checked at most every CATALOGUE_CACHE_TTL.
+# Per-user entries are evicted least recently used beyond CATALOGUE_CACHE_MAX_ENTRIES.
+
+DepartmentRow = namedtuple('DepartmentRow', 'id name')
+CourseRow = namedtuple('CourseRow', 'id department_id year semester course_name')
+Catalogue = namedtuple('Catalogue', 'departments departments_by_id courses_by_id courses_by_term courses_by_year')
+CacheEntry = namedtuple('CacheEntry', 'versions checked_at value')
+
+
+def load_catalogue():
+    """Read every department and course into immutable, indexed structures"""
+    departments = tuple(DepartmentRow(*row) for row in
+                        db.session.query(Department.id, Department.name).order_by(Department.id))
+    by_id = {}
+    by_term = defaultdict(list)
+    by_year = defaultdict(list)
+    columns = (Course.id, Course.department_id, Course.year, Course.semester, Course.course_name)
+    for course in map(CourseRow._make, db.session.query(*columns).order_by(Course.id)):
+        by_id[course.id] = course
+        by_term[(course.department_id, course.year, course.semester)].append(course)
+        by_year[(course.department_id, course.year)].append(course)
+
+    return Catalogue(
+        departments=departments,
+        departments_by_id=MappingProxyType({dept.id: dept for dept in departments}),
+        courses_by_id=MappingProxyType(by_id),
+        courses_by_term=MappingProxyType({key: tuple(value) for key, value in by_term.items()}),
+        courses_by_year=MappingProxyType({key: tuple(value) for key, value in by_year.items()}),
+    )
+
+
+def load_current_course_ids(user_id):
+    query = db.session.query(CurrentCourse.course_id).filter(CurrentCourse.user_id == user_id)
+    return frozenset(course_id for course_id, in query)
+
+
+class CatalogueCache:
+    """Cache of the course catalogue and the current course ids, with hit/miss counters"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, tables, load):
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry and now - entry.checked_at < app.config['CATALOGUE_CACHE_TTL']:
+            self.hits += 1
+            self._touch(key, entry)
+            return entry.value
+
+        versions = tuple(v for _, v in sorted(
+            db.session.query(TableVersion.name, TableVersion.version).filter(TableVersion.name.in_(tables))
+        ))
+        if entry and entry.versions == versions:
+            self.hits += 1
+            self._touch(key, entry._replace(checked_at=now))
+            return entry.value
+
+        self.misses += 1
+        value = load()
+        self._touch(key, CacheEntry(versions, now, value))
+        return value
+
+    def _touch(self, key, entry):
+        """Store an entry as the most recently used one, evicting the oldest beyond the limit"""
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > app.config['CATALOGUE_CACHE_MAX_ENTRIES']:
+                self._entries.popitem(last=False)
+
+    def catalogue(self):
+        return self._get('catalogue', ('department', 'course'), load_catalogue)
+
+    def departments(self):
+        return self.catalogue().departments
+
+    def department(self, dept_id):
+        return self.catalogue().departments_by_id.get(dept_id)
+
+    def course(self, course_id):
+        return self.catalogue().courses_by_id.get(course_id)
+
+    def courses(self, dept_id, year, semester=None):
+        catalogue = self.catalogue()
+        if semester:
+            return catalogue.courses_by_term.get((dept_id, year, semester), ())
+        return catalogue.courses_by_year.get((dept_id, year), ())
+
+    def current_course_ids(self, user_id):
+        return self._get(('current_course_ids', user_id), ('current_course',),
+                         lambda: load_current_course_ids(user_id))
+
+    def invalidate_catalogue(self):
+        with self._lock:
+            self._entries.pop('catalogue', None)
+
+    def invalidate_current_courses(self, user_id):
+        with self._lock:
+            self._entries.pop(('current_course_ids', user_id), None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+catalogue_cache = CatalogueCache()
+
+
+# Fragment cache
+#
+# Note cards and course items are rendered once per distinct content and kept in memory as
+# Markup. Each fragment is keyed by its template, row id and a version tuple holding every
+# value its HTML shows that can change (Note.version, image variants, the user's course
+# name, current-course flag, note statistics), so a write made by any worker process leads
+# to a new key and the stale entry ages out. update_note(), delete_note(), edit_elective()
+# and toggle_current_course() also drop the entries of the rows they change at once.
+# Entries are evicted least recently used beyond FRAGMENT_CACHE_MAX_BYTES of HTML.
+
+class FragmentCache:
+    """Size-bounded LRU cache of rendered template fragments"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()  # (template, row id, version) -> Markup
+        self._rows = defaultdict(set)  # (template, row id) -> keys of its entries
+        self._lock = threading.Lock()
+
+    def render(self, context, template, row_id, version, **variables):
+        """The fragment for this row version, rendered with the calling template's context"""
+        key = (template, row_id, version)
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+
+        self.misses += 1
+        html = Markup(app.jinja_env.get_template(template).render({**context.get_all(), **variables}))
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = html
+                self._rows[key[:2]].add(key)
+                self.size += len(html)
+            while self.size > app.config['FRAGMENT_CACHE_MAX_BYTES'] and self._entries:
+                self._remove(*self._entries.popitem(last=False))
+        return html
+
+    def _remove(self, key, html):
+        self.size -= len(html)
+        keys = self._rows[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self._rows[key[:2]]
+
+    def invalidate(self, template, row_id):
+        """Drop every cached version of one row's fragment"""
+        with self._lock:
+            for key in self._rows.pop((template, row_id), ()):
+                self.size -= len(self._entries.pop(key))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self.size}
+
+
+fragment_cache = FragmentCache()
+
+NOTE_CARD = 'partials/note_card.html'
+COURSE_ITEM = 'partials/course_item.html'
+
+
+@app.template_global()
+@pass_context
+def note_card(context, note, show_course=False):
+    """Cached partials/note_card.html for a note"""
+    # SQLite reuses the ids of deleted notes, and other workers cannot invalidate this
+    # process's entries, so the owner and timestamps tell a reused id or a remote write apart
+    version = (note.user_id, note.created_at, note.updated_at, note.version,
+               note.image.variant_widths if note.image else None,
+               display_course_name(note.course) if show_course else None)
+    return fragment_cache.render(context, NOTE_CARD, note.id, version, note=note, show_course=show_course)
+
+
+@app.template_global()
+@pass_context
+def course_item(context, course, current, course_stats=None):
+    """Cached partials/course_item.html for a course as the current user sees it"""
+    version = (course.course_name, display_course_name(course), current,
+               (course_stats.note_count, course_stats.image_count, course_stats.latest_note_at)
+               if course_stats else None)
+    return fragment_cache.render(context, COURSE_ITEM, course.id, version,
+                                 course=course, current=current, course_stats=course_stats)
+
+
+# User accounts
+#
+# The logged-in user is kept in the session and loaded into g.user for every request.
+# Only the catalogue pages and the account pages are available without logging in.
+
+PUBLIC_ENDPOINTS = {'index', 'select_class', 'login', 'register', 'static', 'serve_upload', 'service_worker',
+                    'api_v1_departments', 'api_v1_department_courses', 'api_v1_course'}
+
+
+@app.before_request
+def load_user():
+    """Load the logged-in user, sending anonymous visitors of private pages to the login page"""
+    user_id = session.get('user_id')
+    g.user = db.session.get(User, user_id) if user_id else None
+    if g.user or request.endpoint in PUBLIC_ENDPOINTS or request.endpoint is None:
+        return None
+    if request.endpoint == 'metrics' and metrics_authorized():  # Prometheus scrapes without logging in
+        return None
+    if request.path.startswith('/api/') or request.is_json:
+        return jsonify({'success': False, 'error': 'Login required'}), 401
+    return redirect(url_for('login', next=request.full_path))
+
+
+def display_course_name(course):
+    """Course name as the current user sees it, with their elective renames applied"""
+    if 'course_names' not in g:
+        g.course_names = dict(
+            db.session.query(CourseNameOverride.course_id, CourseNameOverride.course_name)
+            .filter(CourseNameOverride.user_id == g.user.id)
+        ) if g.user else {}
+    return g.course_names.get(course.id, course.course_name)
+
+
+@app.context_processor
+def inject_user():
+    return {'current_user': g.get('user'), 'course_name': display_course_name}
+
+
+def safe_next_url(default):
+    """The ?next= URL if it points into this site, else the default"""
+    next_url = request.args.get('next', '')
+    parts = urlsplit(next_url)
+    # Browsers read a backslash as a slash and drop tabs and newlines, so /\evil.com means //evil.com
+    if not next_url.startswith('/') or parts.scheme or parts.netloc or \
+            any(char == '\\' or char < ' ' for char in next_url):
+        return default
+    return next_url
+
+
+@app.route('/register', methods=['GET', 'POST'])
+def register():
+    """Create an account and log in"""
+    if request.method == 'POST':
+        username = request.form.get('username', '').strip()
+        password = request.form.get('password', '')
+        if not username or len(password) < 8:
+            flash('Choose a username and a password of at least 8 characters.', 'error')
+        elif User.query.filter_by(username=username).first():
+            flash('This username is already taken.', 'error')
+        else:
+            user = User(username=username)
+            user.set_password(password)
+            db.session.add(user)
+            db.session.commit()
+            session.clear()
+            session['user_id'] = user.id
+            flash('Welcome to YasarNoteWise!', 'success')
+            return redirect(url_for('index'))
+
+    return render_template('register.html')
+
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    """Log in with username and password"""
+    if request.method == 'POST':
+        user = User.query.filter_by(username=request.form.get('username', '').strip()).first()
+        if user and user.check_password(request.form.get('password', '')):
+            session.clear()
+            session['user_id'] = user.id
+            return redirect(safe_next_url(url_for('index')))
+        flash('Invalid username or password.', 'error')
+
+    return render_template('login.html')
+
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    session.clear()
+    return redirect(url_for('index'))
+
+
+# Upload admission control
+#
+# Request bodies larger than MAX_CONTENT_LENGTH (IMPORT_MAX_CONTENT_LENGTH for archives sent to
+# /import) are refused from their Content-Length header, before the form parser reads and spools
+# them; bodies sent without one are cut off at the limit while being read. Uploaded images are
+# checked by their first bytes before anything is stored. Uploads and note writes are limited
+# per client by token buckets, kept per worker process or shared through the database.
+
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+class UploadRejected(ValueError):
+    """An uploaded file that is not an image we accept"""
+
+
+def sniff_image(head):
+    """Mimetype of an uploaded image from its first (at least 12) bytes"""
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    raise UploadRejected('Only JPEG, PNG, GIF and WebP images can be uploaded.')
+
+
+def admission_error(message, status, retry_after=None):
+    """Refuse a request: a JSON error for scripts and main.js, a flash message for forms"""
+    if request.path.startswith('/api/') or request.is_json or wants_fragment():
+        response = jsonify({'success': False, 'error': message})
+        response.status_code = status
+    else:
+        flash(message, 'error')
+        back = request.referrer if (request.referrer or '').startswith(request.host_url) else None
+        response = redirect(back or url_for('index'))
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+@app.before_request
+def limit_request_size():
+    """Refuse request bodies over the size limit before they are read"""
+    if request.endpoint == 'import_notes':
+        request.max_content_length = app.config['IMPORT_MAX_CONTENT_LENGTH']
+    limit = request.max_content_length
+    if limit is not None and (request.content_length or 0) > limit:
+        raise RequestEntityTooLarge()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_too_large(e):
+    """Explain the size limit instead of showing a bare 413 page"""
+    limit = request.max_content_length
+    return admission_error(f'Uploads are limited to {limit / 1024 / 1024:g} MB.', 413)
+
+
+class MemoryRateLimiter:
+    """Token buckets held in this worker process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (tokens, monotonic time, time the bucket is full again), least recently used first
+        self._buckets = OrderedDict()
+
+    def take(self, key, burst, rate, cost=1):
+        """Take tokens from a bucket; returns 0, or the seconds until enough have been refilled"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            buckets = self._buckets
+            buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            buckets.move_to_end(key)
+            # A full bucket is the same as no bucket; past RATE_LIMIT_MAX_CLIENTS the least
+            # recently used buckets go too
+            while buckets and (len(buckets) > app.config['RATE_LIMIT_MAX_CLIENTS']
+                              or next(iter(buckets.values()))[2] <= now):
+                buckets.popitem(last=False)
+        return wait
+
+
+class DatabaseRateLimiter:
+    """Token buckets in the rate_limit_bucket table, shared by every worker process"""
+
+    def __init__(self):
+        self._takes = 0
+
+    def take(self, key, burst, rate, cost=1):
+        """Take tokens from a bucket; returns 0, or the seconds until enough have been refilled"""
+        bucket = RateLimitBucket.__table__
+        now = time.time()
+        refilled = func.min(burst, bucket.c.tokens + (now - bucket.c.updated_at) * rate)
+        # One statement, so concurrent requests cannot both take the last token; committed on
+        # its own connection so the request does not hold the write lock
+        with db.engine.begin() as connection:
+            taken = connection.execute(
+                sqlite_insert(bucket)
+                .values(key=key, tokens=burst - cost, updated_at=now)
+                .on_conflict_do_update(index_elements=['key'], set_={'tokens': refilled - cost, 'updated_at': now},
+                                       where=refilled >= cost)
+                .returning(bucket.c.tokens)
+            ).first()
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                connection.execute(bucket.delete().where(bucket.c.updated_at < now - app.config['RATE_LIMIT_IDLE_SECONDS']))
+            if taken:
+                return 0
+            tokens = connection.execute(select(refilled).where(bucket.c.key == key)).scalar() or 0
+        return (cost - tokens) / rate
+
+
+def make_rate_limiter(config):
+    """The rate limiter chosen by RATE_LIMIT_BACKEND"""
+    if config['RATE_LIMIT_BACKEND'] == 'database':
+        return DatabaseRateLimiter()
+    if config['RATE_LIMIT_BACKEND'] != 'memory':
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND {config['RATE_LIMIT_BACKEND']!r}")
+    return MemoryRateLimiter()
+
+
+rate_limiter = make_rate_limiter(app.config)
+
+
+def rate_limited(name):
+    """Limit POSTs to a view per client, by the <NAME>_RATE_BURST / _RATE_PER_MINUTE bucket"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            per_minute = app.config[f'{name.upper()}_RATE_PER_MINUTE']
+            if request.method == 'POST' and per_minute:
+                client = f'user:{g.user.id}' if g.user else f'ip:{request.remote_addr}'
+                wait = rate_limiter.take(f'{name}:{client}', app.config[f'{name.upper()}_RATE_BURST'], per_minute / 60)
+                if wait:
+                    seconds = math.ceil(wait)
+                    return admission_error(f'Too many requests, try again in {seconds} seconds.', 429, seconds)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
 
 # Define routes
 
 @app.route('/')
+@cached_view('department')
 def index():
     """Home page listing all departments"""
-    departments = Department.query.all()
+    departments = catalogue_cache.departments()
     return render_template('index.html', departments=departments)
 
 
 @app.route('/select_class/<int:dept_id>')
+@cached_view('department')
 def select_class(dept_id):
     """Page to select a class after choosing a department"""
-    department = Department.query.get_or_404(dept_id)
+    department = catalogue_cache.department(dept_id) or abort(404)
     return render_template('select_class.html', department=department)
 
 
 @app.route('/courses/<int:dept_id>/<int:year>')
+@cached_view('department', 'course', 'current_course', 'course_name_override', 'course_note_stats')
 def courses(dept_id, year):
     """List courses for a selected department and year"""
-    department = Department.query.get_or_404(dept_id)
-    courses = Course.query.filter_by(department_id=dept_id, year=year).all()
-    current_courses = CurrentCourse.query.all()
-    current_course_ids = [cc.course_id for cc in current_courses]
+    department = catalogue_cache.department(dept_id) or abort(404)
+    courses = catalogue_cache.courses(dept_id, year)
+    current_course_ids = catalogue_cache.current_course_ids(g.user.id)
+    stats = course_note_stats(g.user.id, [course.id for course in courses])
     return render_template('courses.html', department=department, courses=courses, year=year,
-                           current_course_ids=current_course_ids)
+                           current_course_ids=current_course_ids, stats=stats)
+
+
+def current_courses_query(user_id):
+    """A user's current courses with their note statistics, most recently added first"""
+    return (
+        db.session.query(Course, CourseNoteStats)
+        .join(CurrentCourse, CurrentCourse.course_id == Course.id)
+        .outerjoin(CourseNoteStats, and_(CourseNoteStats.user_id == CurrentCourse.user_id,
+                                         CourseNoteStats.course_id == Course.id))
+        .filter(CurrentCourse.user_id == user_id)
+        .options(joinedload(Course.department))
+        .order_by(CurrentCourse.added_at.desc())
+    )
 
 
 @app.route('/current_courses')
+@cached_view('department', 'course', 'current_course', 'course_name_override', 'course_note_stats')
 def current_courses():
     """Show currently taken courses"""
-    current_courses = CurrentCourse.query.order_by(CurrentCourse.added_at.desc()).all()
-    courses = [Course.query.get(cc.course_id) for cc in current_courses]
-    return render_template('current_courses.html', courses=courses)
+    rows = current_courses_query(g.user.id).all()
+    courses = [course for course, _ in rows]
+    stats = {course.id: course_stats for course, course_stats in rows if course_stats}
+    return render_template('current_courses.html', courses=courses, stats=stats)
+
+
+def wants_fragment():
+    """True for main.js requests that swap the returned HTML fragment into the page"""
+    return request.headers.get('X-Fragment') == '1'
+
+
+def wants_notes_shell():
+    """True when the service worker asks for a notes page without the notes, which main.js
+    renders from this user's notes saved in the browser"""
+    return request.headers.get('X-Notes-Cache') == str(g.user.id)
+
+
+def notes_page_response(html):
+    response = app.make_response(html)
+    response.vary.add('X-Notes-Cache')
+    return response
 
 
 @app.route('/toggle_current_course/<int:course_id>', methods=['POST'])
 def toggle_current_course(course_id):
     """Add or remove a course from the current semester"""
-    course = Course.query.get_or_404(course_id)
-    current_course = CurrentCourse.query.filter_by(course_id=course_id).first()
-
-    if current_course:
-        db.session.delete(current_course)
-        message = 'Course removed from current semester.'
-    else:
-        current_course = CurrentCourse(course_id=course_id)
-        db.session.add(current_course)
-        message = 'Course added to current semester.'
-
+    course = catalogue_cache.course(course_id) or abort(404)
+    removed = CurrentCourse.query.filter_by(user_id=g.user.id, course_id=course_id).delete()
+    if not removed:
+        db.session.add(CurrentCourse(user_id=g.user.id, course_id=course_id))
     db.session.commit()
-    flash(message, 'success')
+    catalogue_cache.invalidate_current_courses(g.user.id)
+    fragment_cache.invalidate(COURSE_ITEM, course_id)
+
+    if wants_fragment():
+        stats = db.session.get(CourseNoteStats, (g.user.id, course_id))
+        return render_template('partials/course_item.html', course=course, current=not removed,
+                               course_stats=stats)
+    flash('Course removed from current semester.' if removed else 'Course added to current semester.', 'success')
     return redirect(request.referrer or url_for('index'))
 
 
@@ -113,8 +1692,14 @@ def edit_elective(course_id):
     if request.method == 'POST':
         new_name = request.form.get('course_name')
         if new_name:
-            course.course_name = new_name
+            # The catalogue is shared, so the new name is stored for this user only
+            db.session.execute(
+                sqlite_insert(CourseNameOverride)
+                .values(user_id=g.user.id, course_id=course.id, course_name=new_name)
+                .on_conflict_do_update(index_elements=['user_id', 'course_id'], set_={'course_name': new_name})
+            )
             db.session.commit()
+            fragment_cache.invalidate(COURSE_ITEM, course.id)
             flash('Course name updated successfully!', 'success')
             return redirect(url_for('current_courses'))
 
@@ -122,9 +1707,10 @@ def edit_elective(course_id):
 
 
 @app.route('/add_note/<int:course_id>', methods=['GET', 'POST'])
+@rate_limited('upload')
 def add_note(course_id):
     """Add a note for a course, including optional image upload"""
-    course = Course.query.get_or_404(course_id)
+    course = catalogue_cache.course(course_id) or abort(404)
 
     if request.method == 'POST':
         note_text = request.form.get('note')
@@ -132,528 +1718,2011 @@ def add_note(course_id):
         image_path = None
 
         if image and image.filename:
-            image_path = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{image.filename}"
-            image.save(os.path.join(app.config['UPLOAD_FOLDER'], image_path))
+            try:
+                image_path = save_upload(image)
+            except UploadRejected as e:
+                return admission_error(str(e), 415)
 
         note = Note(
+            user_id=g.user.id,
             course_id=course_id,
             notes=note_text,
             image_path=image_path
         )
         db.session.add(note)
+        db.session.flush()
+        record_revision(note.id, note.version, note_text)
         db.session.commit()
+        related_index.changed()
+        if image_path:
+            schedule_variants(image_path)
 
+        if wants_fragment():
+            return render_template('partials/note_card.html', note=note)
         flash('Note added successfully!', 'success')
         return redirect(url_for('courses', dept_id=course.department_id, year=course.year))
 
-    notes = Note.query.filter_by(course_id=course_id).order_by(Note.created_at.desc()).all()
-    return render_template('notes.html', course=course, notes=notes)
+    related = related_notes(g.user.id, course_id)
+    if wants_notes_shell():
+        return notes_page_response(render_template('notes.html', course=course, notes=None, related=related))
+    notes = Note.query.filter_by(user_id=g.user.id, course_id=course_id).order_by(Note.created_at.desc()).all()
+    return notes_page_response(render_template('notes.html', course=course, notes=notes, related=related))
 
 
 @app.route('/delete_note/<int:note_id>', methods=['POST'])
 def delete_note(note_id):
-    """Delete a note along with its associated image (if any)"""
-    note = Note.query.get_or_404(note_id)
+    """Delete a note along with its associated image (if no other note uses it)"""
+    note = Note.query.filter_by(id=note_id, user_id=g.user.id).first_or_404()
     course_id = note.course_id
+    unused_files = release_image(note.image_path) if note.image_path else []
 
-    if note.image_path:
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], note.image_path)
-        if os.path.exists(image_path):
-            os.remove(image_path)
-
+    NoteRevision.query.filter_by(note_id=note.id).delete()
     db.session.delete(note)
     db.session.commit()
+    remove_uploads(unused_files)
+    fragment_cache.invalidate(NOTE_CARD, note_id)
+    related_index.changed()
+    if wants_fragment():
+        return '', 204
     flash('Note deleted successfully!', 'success')
     return redirect(url_for('add_note', course_id=course_id))
 
 
+# Keyset pagination helpers
+
+def encode_cursor(note):
+    """Encode the (created_at, id) position of a note as an opaque cursor"""
+    raw = f"{note.created_at.isoformat()}|{note.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor back to (created_at, id), raising ValueError if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, note_id = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(created_at), int(note_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def notes_after(query, cursor=None):
+    """Order notes newest first and skip everything up to and including the cursor"""
+    if cursor:
+        created_at, note_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            Note.created_at < created_at,
+            and_(Note.created_at == created_at, Note.id < note_id)
+        ))
+    return query.order_by(Note.created_at.desc(), Note.id.desc())
+
+
+def notes_page(query, cursor=None, limit=None):
+    """Return one page of notes and the cursor of the next page (None on the last page)"""
+    limit = limit or app.config['NOTES_PAGE_SIZE']
+    limit = max(1, min(limit, app.config['NOTES_MAX_PAGE_SIZE']))
+    # Fetch one extra row to know whether another page exists without a COUNT(*)
+    notes = notes_after(query, cursor).limit(limit + 1).all()
+    next_cursor = encode_cursor(notes[limit - 1]) if len(notes) > limit else None
+    return notes[:limit], next_cursor
+
+
+def note_to_dict(note):
+    """Serialize a note for the JSON API"""
+    return {
+        'id': note.id,
+        'course_id': note.course_id,
+        'notes': note.notes,
+        'image_path': note.image_path,
+        'version': note.version,
+        'created_at': note.created_at.isoformat() if note.created_at else None,
+        'updated_at': note.updated_at.isoformat() if note.updated_at else None
+    }
+
+
 @app.route('/all_notes')
 def all_notes():
-    """Display all notes"""
-    all_notes = Note.query.order_by(Note.created_at.desc()).all()
-    return render_template('all_notes.html', notes=all_notes)
+    """Display all notes, one page at a time or streamed in a single response"""
+    cursor = request.args.get('cursor')
+    query = Note.query.filter_by(user_id=g.user.id).options(joinedload(Note.course))
+
+    if request.args.get('stream') == '1':
+        # Stream every note after the cursor; rows are fetched in batches while the
+        # template is being sent, so the first cards reach the browser immediately
+        try:
+            notes = notes_after(query, cursor).yield_per(app.config['NOTES_PAGE_SIZE'])
+        except ValueError:
+            abort(400)
+        return stream_template('all_notes.html', notes=notes, next_cursor=None)
+
+    if not cursor and wants_notes_shell():
+        return notes_page_response(render_template('all_notes.html', notes=None, next_cursor=None))
+    try:
+        notes, next_cursor = notes_page(query, cursor)
+    except ValueError:
+        abort(400)
+    return notes_page_response(render_template('all_notes.html', notes=notes, next_cursor=next_cursor))
+
+
+@app.route('/api/notes')
+def api_notes():
+    """JSON feed of notes, newest first, paginated by cursor"""
+    try:
+        notes, next_cursor = notes_page(
+            Note.query.filter_by(user_id=g.user.id),
+            request.args.get('cursor'),
+            request.args.get('limit', type=int)
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({
+        'success': True,
+        'notes': [note_to_dict(note) for note in notes],
+        'next_cursor': next_cursor
+    })
+
+
+# Full-text search over notes (SQLite FTS5)
+
+# External-content FTS5 index over note.notes, kept in sync by triggers so that every
+# insert, update_note() and delete_note() is reflected without application code
+SEARCH_INDEX_DDL = [
+    # Note bodies may be compressed, so the index reads their text through this view
+    "CREATE VIEW IF NOT EXISTS note_plain AS SELECT id, note_text(notes) AS notes FROM note",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5(
+        notes, content='note_plain', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS note_fts_ai AFTER INSERT ON note BEGIN
+        INSERT INTO note_fts(rowid, notes) VALUES (new.id, note_text(new.notes));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS note_fts_ad AFTER DELETE ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, notes) VALUES ('delete', old.id, note_text(old.notes));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS note_fts_au AFTER UPDATE OF notes ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, notes) VALUES ('delete', old.id, note_text(old.notes));
+        INSERT INTO note_fts(rowid, notes) VALUES (new.id, note_text(new.notes));
+    END""",
+]
+
+note_fts = table('note_fts', column('rowid'))
+
+# Control characters used as snippet markers, replaced by <mark> after HTML escaping
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+
+def init_search_index():
+    """Create the search index and its triggers, indexing existing notes on first run"""
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_fts'")
+    ).first()
+    for statement in SEARCH_INDEX_DDL:
+        db.session.execute(text(statement))
+    if not exists:
+        db.session.execute(text("INSERT INTO note_fts(note_fts) VALUES ('rebuild')"))
+        print("Search index built.")
+    db.session.commit()
+
+
+def to_fts_query(user_query):
+    """Turn free text into a safe FTS5 query: every word must match, the last as a prefix"""
+    terms = ['"{}"'.format(term.replace('"', '""')) for term in user_query.split()]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def highlight(snippet):
+    """HTML-escape a search snippet and wrap the matched terms in <mark>"""
+    escaped = str(escape(snippet or ''))
+    return Markup(escaped.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>'))
+
+
+def search_notes(user_id, user_query, course_id=None, dept_id=None, year=None, limit=None):
+    """Return a user's (note, snippet) pairs matching the query, best bm25 rank first"""
+    match = to_fts_query(user_query)
+    if not match:
+        return []
+
+    limit = max(1, min(limit or app.config['NOTES_PAGE_SIZE'], app.config['NOTES_MAX_PAGE_SIZE']))
+    fts = literal_column('note_fts')
+    rank = func.bm25(fts)
+    snippet = func.snippet(fts, 0, SNIPPET_START, SNIPPET_END, '…', 16)
+
+    query = (
+        db.session.query(Note, snippet)
+        .join(note_fts, note_fts.c.rowid == Note.id)
+        .join(Note.course)
+        .options(contains_eager(Note.course))
+        .filter(fts.op('MATCH')(match))
+        .filter(Note.user_id == user_id)
+    )
+    if course_id:
+        query = query.filter(Note.course_id == course_id)
+    if dept_id:
+        query = query.filter(Course.department_id == dept_id)
+    if year:
+        query = query.filter(Course.year == year)
+
+    return [(note, highlight(snip)) for note, snip in query.order_by(rank).limit(limit)]
+
+
+def search_args():
+    """Read the search query and filters from the request arguments"""
+    return {
+        'user_query': request.args.get('q', '').strip(),
+        'course_id': request.args.get('course_id', type=int),
+        'dept_id': request.args.get('dept_id', type=int),
+        'year': request.args.get('year', type=int),
+    }
+
+
+@app.route('/search')
+def search():
+    """Search notes by text, optionally filtered by course, department and year"""
+    args = search_args()
+    results = search_notes(g.user.id, **args)
+    departments = Department.query.order_by(Department.name).all()
+    return render_template('search.html', results=results, departments=departments, **args)
+
+
+@app.route('/api/search')
+def api_search():
+    """JSON search results with highlighted snippets"""
+    results = search_notes(g.user.id, **search_args(), limit=request.args.get('limit', type=int))
+    return jsonify({
+        'success': True,
+        'results': [dict(note_to_dict(note), snippet=str(snip)) for note, snip in results]
+    })
 
 
 @app.route('/update_note/<int:note_id>', methods=['POST'])
+@rate_limited('note_write')
 def update_note(note_id):
-    """Update an existing note"""
+    """Update an existing note, unless it changed since the version the client edited"""
     try:
         data = request.get_json()
-        note = Note.query.get_or_404(note_id)
+        note = Note.query.filter_by(id=note_id, user_id=g.user.id).first_or_404()
+        if data.get('version') is not None and data['version'] != note.version:
+            return note_conflict(note.version, note.notes)
+        previous, base_version = note.notes, note.version
         note.notes = data['note']
+        db.session.flush()
+        record_revision(note.id, note.version, note.notes, previous, base_version, merge=False)
         db.session.commit()
-        return jsonify({'success': True})
+        fragment_cache.invalidate(NOTE_CARD, note_id)
+        related_index.changed()
+        return jsonify({'success': True, 'version': note.version})
+    except StaleDataError:
+        db.session.rollback()
+        note = Note.query.filter_by(id=note_id, user_id=g.user.id).first_or_404()
+        return note_conflict(note.version, note.notes)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 
-def init_db():
-    with app.app_context():
-        db.create_all()
+def note_conflict(version, notes):
+    """409 response carrying the current note, so the client can rebase its edits"""
+    return jsonify({
+        'success': False,
+        'error': 'The note was changed in another window',
+        'version': version,
+        'note': notes,
+    }), 409
+
+
+# Related notes
+#
+# Every note is a row of hashed term frequencies (1 + log count, RELATED_NOTES_FEATURES
+# buckets, so the vocabulary never has to be stored), weighted by inverse document frequency
+# and L2-normalised in a SciPy sparse matrix with rows grouped by user. The notes related to
+# a course are the user's notes from other courses with the highest cosine similarity to the
+# sum of the course's notes: one sparse matrix-vector product over that user's rows.
+#
+# The matrix is rebuilt on a background thread from the notes changed since the last build
+# (Note.updated_at and tombstones, as for delta sync), so writes from any worker process are
+# picked up. Local writes start a rebuild at once, otherwise one is started when the index is
+# older than RELATED_NOTES_REFRESH; queries meanwhile use the previous matrix.
+
+RelatedSnapshot = namedtuple('RelatedSnapshot', 'ids user_ids course_ids tf matrix users')
+
+TERM = re.compile(r'\w\w+')
+COMBINING_MARK = re.compile('[\u0300-\u036f]')
+
+
+def note_terms(text):
+    """Lowercased words of a note with diacritics removed, like the search index tokenizer"""
+    text = (text or '').lower()
+    if not text.isascii():
+        text = COMBINING_MARK.sub('', unicodedata.normalize('NFKD', text))
+    return TERM.findall(text)
+
+
+def csr_rows(matrix, start, end):
+    """Rows start:end of a CSR matrix as a view, without copying them like slicing does"""
+    indptr = matrix.indptr[start:end + 1]
+    return sparse.csr_matrix(
+        (matrix.data[indptr[0]:indptr[-1]], matrix.indices[indptr[0]:indptr[-1]], indptr - indptr[0]),
+        shape=(end - start, matrix.shape[1]), copy=False
+    )
+
+
+class RelatedNotesIndex:
+    """TF-IDF vectors of every note, updated from the notes changed since the last build"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._since = None  # newest updated_at / deleted_at read so far
+        self._boundary = set()  # the writes read at exactly that time
+        self._checked = 0.0
+        self._running = False
+        self._again = False
+
+    @property
+    def enabled(self):
+        return np is not None and app.config['RELATED_NOTES']
+
+    def changed(self):
+        """Note that notes were written, so the next build picks them up soon"""
+        if self.enabled:
+            self._start()
+
+    def related(self, user_id, course_id, limit=None):
+        """(note_id, score) of the user's notes in other courses most similar to a course's notes"""
+        if not self.enabled:
+            return []
+        if time.monotonic() - self._checked > app.config['RELATED_NOTES_REFRESH']:
+            self._start()
+        snapshot = self._snapshot
+        if snapshot is None or user_id not in snapshot.users:
+            return []
+
+        # A user's rows are sorted by course, so the course's notes are contiguous too
+        start, end = snapshot.users[user_id]
+        first, last = np.searchsorted(snapshot.course_ids[start:end], [course_id, course_id + 1])
+        if first == last:
+            return []
+        rows = csr_rows(snapshot.matrix, start, end)
+        centroid = np.asarray(csr_rows(rows, first, last).sum(axis=0)).ravel()
+        scores = rows @ (centroid / (np.linalg.norm(centroid) or 1))
+        scores[first:last] = 0
+        limit = min(limit or app.config['RELATED_NOTES_COUNT'], len(scores))
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best])]
+        return [(int(snapshot.ids[start + i]), float(scores[i])) for i in best
+                if scores[i] >= app.config['RELATED_NOTES_MIN_SCORE']]
+
+    def _start(self):
+        """Run a build on a background thread, or another one after the running build"""
+        with self._lock:
+            self._checked = time.monotonic()
+            if self._running:
+                self._again = True
+                return
+            self._running = True
+        threading.Thread(target=self._run, name='related-notes', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                with app.app_context():
+                    self._build()
+            except Exception:
+                app.logger.exception('Related notes index build failed')
+            with self._lock:
+                if not self._again:
+                    self._running = False
+                    return
+                self._again = False
+
+    def _build(self):
+        """Replace the rows of changed and deleted notes and recompute the weights"""
+        since = self._since
+        query = db.session.query(Note.id, Note.user_id, Note.course_id, Note.notes, Note.version,
+                                 Note.updated_at).filter(Note.user_id.isnot(None))
+        deleted = []
+        if since is not None:
+            # Inclusive, because rows committed later may carry the same timestamp;
+            # the writes already read at that timestamp are left out below
+            query = query.filter(Note.updated_at >= since)
+            deleted = db.session.query(NoteTombstone.note_id, NoteTombstone.deleted_at) \
+                .filter(NoteTombstone.deleted_at >= since).all()
+        notes = query.all()
+        db.session.rollback()  # end the read transaction before the slow part
+        notes = [note for note in notes
+                 if ('note', note.id, note.version, note.updated_at) not in self._boundary]
+        deleted = [row for row in deleted if ('deleted', row.note_id, None, row.deleted_at) not in self._boundary]
+        if since is not None and not notes and not deleted:
+            return
+
+        features = app.config['RELATED_NOTES_FEATURES']
+        buckets = {}
+        data, indices, indptr = [], [], [0]
+        for note in notes:
+            for term, count in Counter(note_terms(note.notes)).items():
+                bucket = buckets.get(term)
+                if bucket is None:
+                    bucket = buckets[term] = zlib.crc32(term.encode()) % features
+                indices.append(bucket)
+                data.append(1 + math.log(count))
+            indptr.append(len(indices))
+        tf = sparse.csr_matrix((np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32),
+                                np.array(indptr, dtype=np.int64)), shape=(len(notes), features))
+        tf.sum_duplicates()  # terms hashed to the same bucket
+        ids = np.array([note.id for note in notes], dtype=np.int64)
+        user_ids = np.array([note.user_id for note in notes], dtype=np.int64)
+        course_ids = np.array([note.course_id for note in notes], dtype=np.int64)
+
+        previous = self._snapshot
+        if previous is not None and since is not None:
+            gone = np.concatenate([ids, np.array([row.note_id for row in deleted], dtype=np.int64)])
+            keep = ~np.isin(previous.ids, gone)
+            tf = sparse.vstack([previous.tf[keep], tf], format='csr')
+            ids = np.concatenate([previous.ids[keep], ids])
+            user_ids = np.concatenate([previous.user_ids[keep], user_ids])
+            course_ids = np.concatenate([previous.course_ids[keep], course_ids])
+
+        order = np.lexsort((ids, course_ids, user_ids))
+        tf, ids, user_ids, course_ids = tf[order], ids[order], user_ids[order], course_ids[order]
+
+        # Smoothed idf, as in scikit-learn's TfidfTransformer
+        document_frequency = np.bincount(tf.indices, minlength=features)
+        idf = np.log((1 + len(ids)) / (1 + document_frequency)).astype(np.float32) + 1
+        matrix = tf @ sparse.diags(idf)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix = sparse.csr_matrix(sparse.diags(1 / norms) @ matrix)
+
+        users, starts, counts = np.unique(user_ids, return_index=True, return_counts=True)
+        self._snapshot = RelatedSnapshot(
+            ids, user_ids, course_ids, tf, matrix,
+            {int(user): (int(start), int(start + count)) for user, start, count in zip(users, starts, counts)}
+        )
+        seen = {('note', note.id, note.version, note.updated_at) for note in notes if note.updated_at} | \
+            {('deleted', row.note_id, None, row.deleted_at) for row in deleted}
+        newest = max([write[3] for write in seen] + ([since] if since is not None else []), default=None)
+        self._since = newest
+        self._boundary = {write for write in seen | self._boundary if write[3] == newest}
 
-        # Add departments
-        if not Department.query.first():
-            departments = [
-                'Computer Engineering',
-                'Industrial Engineering',
-                'Electrical-Electronics Engineering',
-                'Software Engineering',
-                'Energy Systems Engineering',
-                'Civil Engineering',
-                'Mechanical Engineering'
-            ]
 
-            for dept_name in departments:
-                dept = Department(name=dept_name)
-                db.session.add(dept)
-            db.session.commit()
-            print("Departments added.")
-
-        # Computer Engineering courses
-        comp_eng = Department.query.filter_by(name='Computer Engineering').first()
-        if comp_eng and not Course.query.filter_by(department_id=comp_eng.id).first():
-            comp_courses = [
-                # 1st Year Fall
-                (1, 'Fall', 'MATH 1100 - MATHEMATICAL LOGIC'),
-                (1, 'Fall', 'MATH 1131 - CALCULUS I'),
-                (1, 'Fall', 'PHYS 1121 - PHYSICS I'),
-                (1, 'Fall', 'SE 1105 - PROGRAMMING AND PROBLEM SOLVING I'),
-                (1, 'Fall', 'SOFL 1101 - ACADEMIC ENGLISH I'),
-                # 1st Year Spring
-                (1, 'Spring', 'COMP 1202 - DISCRETE STRUCTURES'),
-                (1, 'Spring', 'MATH 1132 - CALCULUS II'),
-                (1, 'Spring', 'PHYS 1122 - PHYSICS II'),
-                (1, 'Spring', 'SOFL 1102 - ACADEMIC ENGLISH II'),
-                (1, 'Spring', 'UNV. COMP 1 - UNIVERSITY ELECTIVE COURSE'),
-                # 2nd Year Fall
-                (2, 'Fall', 'COMP 2233 - DATA STRUCTURES'),
-                (2, 'Fall', 'EEE 2274 - FUNDAMENTALS OF ELECTRONICS'),
-                (2, 'Fall', 'MATH 2260 - PROBABILITY AND STATISTICS FOR ENGINEERS'),
-                (2, 'Fall', 'SE 2228 - ALGORITHM ANALYSIS AND DESIGN'),
-                (2, 'Fall', 'UNV ELECT COMP - UNIVERSITY ELECTIVE COURSE'),
-                # 2nd Year Spring
-                (2, 'Spring', 'COMP 2215 - OBJECT-ORIENTED PROGRAMMING'),
-                (2, 'Spring', 'COMP 3330 - AUTOMATA THEORY'),
-                (2, 'Spring', 'EEE 2110 - DIGITAL DESIGN'),
-                (2, 'Spring', 'MATH 2255 - LINEAR ALGEBRA'),
-                # 3rd Year Fall
-                (3, 'Fall', 'COMP 3315 - COMPUTER ORGANIZATION'),
-                (3, 'Fall', 'COMP 3327 - COMPUTER NETWORKS'),
-                (3, 'Fall', 'MATH 2261 - INTRODUCTION TO DIFFERENTIAL EQUATIONS'),
-                (3, 'Fall', 'ELECT COMP A1 - DEPARTMENT ELECTIVE COURSE'),
-                (3, 'Fall', 'UNV. COMP 2 - UNIVERSITY ELECTIVE COURSE'),
-                # 3rd Year Spring
-                (3, 'Spring', 'COMP 3304 - FUNDAMENTALS OF SOFTWARE ENGINEERING'),
-                (3, 'Spring', 'COMP 3323 - OPERATING SYSTEMS'),
-                (3, 'Spring', 'COMP 3328 - EMBEDDED SYSTEMS'),
-                (3, 'Spring', 'ENGR 3450 - PROJECT MANAGEMENT'),
-                (3, 'Spring', 'ENGR 4400 - ENGINEERING ETHICS AND SEMINAR'),
-                (3, 'Spring', 'UNV. COMP 3 - UNIVERSITY ELECTIVE COURSE'),
-                # 4th Year Fall
-                (4, 'Fall', 'COMP 4910 - SENIOR DESIGN PROJECT I'),
-                (4, 'Fall', 'ELECT COMP A2 - DEPARTMENT ELECTIVE COURSE'),
-                (4, 'Fall', 'ELECT COMP B2 - DEPARTMENT ELECTIVE COURSE'),
-                (4, 'Fall', 'UNV. COMP 4 - UNIVERSITY ELECTIVE COURSE'),
-                # 4th Year Spring
-                (4, 'Spring', 'COMP 4920 - SENIOR DESIGN PROJECT II'),
-                (4, 'Spring', 'ELECT COMP A3 - DEPARTMENT ELECTIVE COURSE'),
-                (4, 'Spring', 'ELECT COMP B3 - DEPARTMENT ELECTIVE COURSE')
-            ]
+related_index = RelatedNotesIndex()
 
-            for year, semester, course_name in comp_courses:
-                course = Course(
-                    department_id=comp_eng.id,
-                    year=year,
-                    semester=semester,
-                    course_name=course_name
-                )
-                db.session.add(course)
-            db.session.commit()
-            print("Computer Engineering courses added.")
-
-        # Industrial Engineering courses
-        ind_eng = Department.query.filter_by(name='Industrial Engineering').first()
-        if ind_eng and not Course.query.filter_by(department_id=ind_eng.id).first():
-            ind_courses = [
-                # 1st Year Fall
-                (1, 'Fall', 'ENGR 1115 - INTRODUCTION TO PROGRAMMING'),
-                (1, 'Fall', 'MATH 1100 - MATHEMATICAL LOGIC'),
-                (1, 'Fall', 'MATH 1131 - CALCULUS I'),
-                (1, 'Fall', 'PHYS 1121 - PHYSICS I'),
-                (1, 'Fall', 'SOFL 1101 - ACADEMIC ENGLISH I'),
-                # 1st Year Spring
-                (1, 'Spring', 'CHEM 1130 - ENGINEERING CHEMISTRY'),
-                (1, 'Spring', 'ENGR 1116 - OBJECT-ORIENTED PROGRAMMING'),
-                (1, 'Spring', 'MATH 1132 - CALCULUS II'),
-                (1, 'Spring', 'SOFL 1102 - ACADEMIC ENGLISH II'),
-                # 2nd Year Fall
-                (2, 'Fall', 'ECON 1120 - ESSANTIALS ECONOMICS'),
-                (2, 'Fall', 'IE 2511 - COST ANALYSIS IN ENGINEERING'),
-                (2, 'Fall', 'IE 2531 - PROBABILITY FOR ENGINEERS'),
-                (2, 'Fall', 'IE 2551 - ALGORITHMS AND COMPUTATION'),
-                (2, 'Fall', 'MATH 2255 - LINEAR ALGEBRA'),
-                # 2nd Year Spring
-                (2, 'Spring', 'IE 2512 - ENGINEERING ECONOMICS'),
-                (2, 'Spring', 'IE 2524 - WORK SYSTEMS ANALYSIS AND DESIGN'),
-                (2, 'Spring', 'IE 2532 - STATISTICS FOR ENGINEERS'),
-                (2, 'Spring', 'IE 2552 - MODELING IN OPERATIONS RESEARCH'),
-                (2, 'Spring', 'MATH 2261 - INTRODUCTION TO DIFFERENTIAL EQUATIONS'),
-                # 3rd Year Fall
-                (3, 'Fall', 'ENGR 3450 - PROJECT MANAGEMENT'),
-                (3, 'Fall', 'ENGR 4400 - ENGINEERING ETHICS AND SEMINAR'),
-                (3, 'Fall', 'IE 3513 - QUALITY ASSURANCE AND RELIABILITY'),
-                (3, 'Fall', 'IE 3523 - PRODUCTION AND SERVICE SYSTEMS PLANNING'),
-                (3, 'Fall', 'IE 3553 - DETERMINISTIC OPERATIONS RESEARCH'),
-                (3, 'Fall', '[G] UNV ELECT IE1 - UNIVERSITY ELECTIVE COURSE IE1'),
-                # 3rd Year Spring
-                (3, 'Spring', 'IE 3511 - SYSTEM SIMULATION'),
-                (3, 'Spring', 'IE 3524 - INTEGRATED MANUFACTURING SYSTEMS'),
-                (3, 'Spring', 'IE 3554 - STOCHASTIC OPERATIONS RESEARCH'),
-                (3, 'Spring', 'IE 3562 - INDUSTRIAL INFORMATION SYSTEMS'),
-                (3, 'Spring', '[G] ELECT IE 45X1-A - DEPARTMENT ELECTIVE COURSE IE 45X1-A'),
-                # 4th Year Fall
-                (4, 'Fall', 'IE 4911 - SYSTEM ANALYSIS'),
-                (4, 'Fall', '[G] ELECT IE 45X1-B - DEPARTMENT ELECTIVE COURSE IE 45X1-B'),
-                (4, 'Fall', '[G] ELECT IE 45X2-A - DEPARTMENT ELECTIVE COURSE IE 45X2-A'),
-                (4, 'Fall', '[G] UNV ELECT IE2 - UNIVERSITY ELECTIVE COURSE IE2'),
-                # 4th Year Spring
-                (4, 'Spring', 'IE 4912 - SYSTEM DESIGN'),
-                (4, 'Spring', '[G] ELECT IE 45X2-B - DEPARTMENT ELECTIVE COURSE IE 45X2-B'),
-                (4, 'Spring', '[G] ELECT IE 45X3-A - DEPARTMENT ELECTIVE COURSE IE 45X3-A'),
-                (4, 'Spring', '[G] ELECT IE 45X4-A - DEPARTMENT ELECTIVE COURSE IE 45X4-A'),
-                (4, 'Spring', '[G] UNV ELECT IE3 - UNIVERSITY ELECTIVE COURSE IE3')
-            ]
 
-            for year, semester, course_name in ind_courses:
-                course = Course(
-                    department_id=ind_eng.id,
-                    year=year,
-                    semester=semester,
-                    course_name=course_name
-                )
-                db.session.add(course)
-            db.session.commit()
-            print("Industrial Engineering courses added.")
-
-        # Civil Engineering courses
-        civil_eng = Department.query.filter_by(name='Civil Engineering').first()
-        if civil_eng and not Course.query.filter_by(department_id=civil_eng.id).first():
-            civil_courses = [
-                # 1st Year Fall
-                (1, 'Fall', 'ENGR 1115 - INTRODUCTION TO PROGRAMMING'),
-                (1, 'Fall', 'MATH 1100 - MATHEMATICAL LOGIC'),
-                (1, 'Fall', 'MATH 1131 - CALCULUS I'),
-                (1, 'Fall', 'PHYS 1121 - PHYSICS I'),
-                (1, 'Fall', 'SOFL 1101 - ACADEMIC ENGLISH I'),
-                # 1st Year Spring
-                (1, 'Spring', 'CE 1102 - ENGINEERING MECHANICS I'),
-                (1, 'Spring', 'CHEM 1130 - ENGINEERING CHEMISTRY'),
-                (1, 'Spring', 'MATH 1132 - CALCULUS II'),
-                (1, 'Spring', 'SOFL 1102 - ACADEMIC ENGLISH II'),
-                # 2nd Year Fall
-                (2, 'Fall', 'CE 2101 - FUNDAMENTALS OF MATERIAL SCIENCE'),
-                (2, 'Fall', 'CE 2103 - STRENGTH OF MATERIALS'),
-                (2, 'Fall', 'CE 2105 - ENGINEERING MECHANICS II : DYNAMICS'),
-                (2, 'Fall', 'MATH 2230 - COMPUTATIONAL METHODS IN ENGINEERING'),
-                (2, 'Fall', 'MATH 2263 - DIFFERENTIAL EQUATIONS AND DYNAMIC SYSTEMS'),
-                (2, 'Fall', 'UNV ELECT CE1 - UNIVERSITY ELECTIVE CE 1'),
-                # 2nd Year Spring
-                (2, 'Spring', 'CE 2102 - INTRODUCTION TO STRUCTURAL ANALYSIS'),
-                (2, 'Spring', 'CE 2104 - CONSTRUCTION MATERIALS'),
-                (2, 'Spring', 'CE 2106 - FLUID MECHANICS'),
-                (2, 'Spring', 'MATH 2260 - PROBABILITY AND STATISTICS FOR ENGINEERS'),
-                # 3rd Year Fall
-                (3, 'Fall', 'CE 3101 - FUNDAMENTALS OF TRANSPORTATION ENGINEERING'),
-                (3, 'Fall', 'CE 3103 - SOIL MECHANICS'),
-                (3, 'Fall', 'CE 3105 - HYDROMECHANICS'),
-                (3, 'Fall', 'ENGR 3450 - PROJECT MANAGEMENT'),
-                (3, 'Fall', 'ELECT CE B1 - CE FIELD ELECTIVE GROUP B1'),
-                # 3rd Year Spring
-                (3, 'Spring', 'CE 3102 - FUNDAMENTALS OF REINFORCED CONCRETE DESIGN'),
-                (3, 'Spring', 'CE 3104 - FUNDAMENTALS OF STEEL STRUCTURE DESIGN'),
-                (3, 'Spring', 'CE 3106 - FOUNDATION ENGINEERING'),
-                (3, 'Spring', 'CE 3108 - CONSTRUCTION MANAGEMENT'),
-                (3, 'Spring', 'CE 3110 - COMPUTER-AIDED DESIGN'),
-                (3, 'Spring', 'ELECT CE A1 - CE FIELD ELECTIVE GROUP A1'),
-                # 4th Year Fall
-                (4, 'Fall', 'CE 4120 - SUSTAINABILITY AND CIRCULAR ECONOMY FOR CIVIL ENGINEERS'),
-                (4, 'Fall', 'CE 4910 - SENIOR DESIGN PROJECT I'),
-                (4, 'Fall', 'ENGR 4400 - ENGINEERING ETHICS AND SEMINAR'),
-                (4, 'Fall', 'ELECT CE A2 - CE FIELD ELECTIVE GROUP A2'),
-                (4, 'Fall', 'ELECT CE A3 - CE FIELD ELECTIVE GROUP A3'),
-                # 4th Year Spring
-                (4, 'Spring', 'CE 4920 - SENIOR DESIGN PROJECT II'),
-                (4, 'Spring', 'ELECT CE A4 - CE FIELD ELECTIVE GROUP A4'),
-                (4, 'Spring', 'ELECT CE B2 - CE FIELD ELECTIVE GROUP B2'),
-                (4, 'Spring', 'UNV ELECT CE2 - UNIVERSITY ELECTIVE CE2'),
-                (4, 'Spring', 'UNV ELECT CE3 - UNIVERSITY ELECTIVE CE3')
-            ]
+def related_notes(user_id, course_id):
+    """The user's notes from other courses related to a course, most similar first"""
+    scores = dict(related_index.related(user_id, course_id))
+    if not scores:
+        return []
+    notes = Note.query.options(joinedload(Note.course)).filter(Note.id.in_(scores), Note.user_id == user_id)
+    return sorted(notes, key=lambda note: -scores[note.id])
 
-            for year, semester, course_name in civil_courses:
-                course = Course(
-                    department_id=civil_eng.id,
-                    year=year,
-                    semester=semester,
-                    course_name=course_name
-                )
-                db.session.add(course)
-            db.session.commit()
-            print("Civil Engineering courses added.")
-
-        # Mechanical Engineering courses
-        mech_eng = Department.query.filter_by(name='Mechanical Engineering').first()
-        if mech_eng and not Course.query.filter_by(department_id=mech_eng.id).first():
-            mech_courses = [
-                # 1st Year Fall
-                (1, 'Fall', 'ENGR 1115 - INTRODUCTION TO PROGRAMMING'),
-                (1, 'Fall', 'MATH 1100 - MATHEMATICAL LOGIC'),
-                (1, 'Fall', 'MATH 1131 - CALCULUS I'),
-                (1, 'Fall', 'PHYS 1121 - PHYSICS I'),
-                (1, 'Fall', 'SOFL 1101 - ACADEMIC ENGLISH I'),
-                # 1st Year Spring
-                (1, 'Spring', 'CHEM 1130 - ENGINEERING CHEMISTRY'),
-                (1, 'Spring', 'MATH 1132 - CALCULUS II'),
-                (1, 'Spring', 'ME 1110 - INTRODUCTION TO MECHANICAL ENGINEERING'),
-                (1, 'Spring', 'PHYS 1122 - PHYSICS II'),
-                (1, 'Spring', 'SOFL 1102 - ACADEMIC ENGLISH II'),
-                # 2nd Year Fall
-                (2, 'Fall', 'EEE 2280 - ELECTRICAL CIRCUITS AND SYSTEMS'),
-                (2, 'Fall', 'ENGR 2120 - INTRODUCTION TO COMPUTER-AIDED MODELING'),
-                (2, 'Fall', 'ME 2210 - ENGINEERING MECHANICS I'),
-                (2, 'Fall', 'ME 2710 - MATERIAL SCIENCE'),
-                # 2nd Year Spring
-                (2, 'Spring', 'MATH 2230 - COMPUTATIONAL METHODS IN ENGINEERING'),
-                (2, 'Spring', 'MATH 2263 - DIFFERENTIAL EQUATIONS AND DYNAMIC SYSTEMS'),
-                (2, 'Spring', 'ME 2220 - MECHANICS OF MATERIALS'),
-                (2, 'Spring', 'ME 2320 - THERMODYNAMICS'),
-                # 3rd Year Fall
-                (3, 'Fall', 'EEE 3718 - FEEDBACK SYSTEMS'),
-                (3, 'Fall', 'ENGR 3450 - PROJECT MANAGEMENT'),
-                (3, 'Fall', 'ME 3220 - ENGINEERING MECHANICS II'),
-                (3, 'Fall', 'ME 3320 - HEAT AND MASS TRANSFER'),
-                (3, 'Fall', 'ME 3420 - PRODUCTION TECHNOLOGIES AND PROCESSES'),
-                (3, 'Fall', 'UNV ELECT ME1 - UNIVERSITY ELECTIVE COURSE ME1'),
-                # 3rd Year Spring
-                (3, 'Spring', 'MATH 2260 - PROBABILITY AND STATISTICS FOR ENGINEERS'),
-                (3, 'Spring', 'ME 3330 - FLUID MECHANICS AND MACHINERY'),
-                (3, 'Spring', 'ME 3410 - MECHANICAL COMPONENTS'),
-                (3, 'Spring', 'ME 3510 - THEORY OF MACHINES AND MECHANISMS'),
-                (3, 'Spring', 'ELECT ME A1 - DEPARTMENTAL ELECTIVE COURSE A1'),
-                # 4th Year Fall
-                (4, 'Fall', 'ENGR 4400 - ENGINEERING ETHICS AND SEMINAR'),
-                (4, 'Fall', 'ME 4910 - SENIOR DESIGN PROJECT I'),
-                (4, 'Fall', 'ELECT ME A2 - DEPARTMENTAL ELECTIVE COURSE A2'),
-                (4, 'Fall', 'ELECT ME B1 - DEPARTMENTAL ELECTIVE COURSE B1'),
-                (4, 'Fall', 'UNV ELECT ME2 - UNIVERSITY ELECTIVE COURSE ME2'),
-                # 4th Year Spring
-                (4, 'Spring', 'ME 4920 - SENIOR DESIGN PROJECT II'),
-                (4, 'Spring', 'ELECT ME A3 - DEPARTMENTAL ELECTIVE COURSE A3'),
-                (4, 'Spring', 'ELECT ME B2 - DEPARTMENTAL ELECTIVE COURSE B2'),
-                (4, 'Spring', 'ELECT ME B3 - DEPARTMENTAL ELECTIVE COURSE B3'),
-                (4, 'Spring', 'UNV ELECT ME3 - UNIVERSITY ELECTIVE ME3')
-            ]
 
-            for year, semester, course_name in mech_courses:
-                course = Course(
-                    department_id=mech_eng.id,
-                    year=year,
-                    semester=semester,
-                    course_name=course_name
-                )
-                db.session.add(course)
-            db.session.commit()
-            print("Mechanical Engineering courses added.")
-
-        # Electrical-Electronics Engineering courses
-        ee_eng = Department.query.filter_by(name='Electrical-Electronics Engineering').first()
-        if ee_eng and not Course.query.filter_by(department_id=ee_eng.id).first():
-            ee_courses = [
-                # 1st Year Fall
-                (1, 'Fall', 'ENGR 1115 - INTRODUCTION TO PROGRAMMING'),
-                (1, 'Fall', 'MATH 1100 - MATHEMATICAL LOGIC'),
-                (1, 'Fall', 'MATH 1131 - CALCULUS I'),
-                (1, 'Fall', 'PHYS 1121 - PHYSICS I'),
-                (1, 'Fall', 'SOFL 1101 - ACADEMIC ENGLISH I'),
-                # 1st Year Spring
-                (1, 'Spring', 'MATH 2255 - LINEAR ALGEBRA'),
-                (1, 'Spring', 'MATH 1132 - CALCULUS II'),
-                (1, 'Spring', 'PHYS 1122 - PHYSICS II'),
-                (1, 'Spring', 'SOFL 1102 - ACADEMIC ENGLISH II'),
-                # 2nd Year Fall
-                (2, 'Fall', 'EEE 2271 - CIRCUIT THEORY I'),
-                (2, 'Fall', 'EEE 2273 - DIGITAL DESIGN'),
-                (2, 'Fall', 'MATH 2259 - ENGINEERING MATHEMATICS'),
-                (2, 'Fall', 'MATH 2263 - DIFFERENTIAL EQUATIONS AND DYNAMIC SYSTEMS'),
-                # 2nd Year Spring
-                (2, 'Spring', 'EEE 2022 - CIRCUIT THEORY II'),
-                (2, 'Spring', 'EEE 2214 - ENGINEERING ELECTROMAGNETICS'),
-                (2, 'Spring', 'EEE 2426 - ANALOG ELECTRONICS'),
-                (2, 'Spring', 'ELECT EEE A1 - DEPARTMENTAL ELECTIVE COURSES EEE A1'),
-                # 3rd Year Fall
-                (3, 'Fall', 'EEE 3435 -	DIGITAL ELECTRONICS'),
-                (3, 'Fall', 'EEE 3513 -	SIGNALS AND SYSTEMS'),
-                (3, 'Fall', 'EEE 3615 -	ELECTROMECHANICAL ENERGY CONVERSION'),
-                (3, 'Fall', 'MATH 3305 - PROBABILITY AND RANDOM PROCESSES'),
-                (3, 'Fall', 'ENGR 3450 - PROJECT MANAGEMENT'),
-                # 3rd Year Spring
-                (3, 'Spring', 'EEE 3134 - MICROCONTROLLERS'),
-                (3, 'Spring', 'EEE 3524 - TELECOMMUNICATIONS'),
-                (3, 'Spring', 'EEE 3638 - POWER SYSTEMS'),
-                (3, 'Spring', 'EEE 3718 - FEEDBACK SYSTEMS'),
-                (3, 'Spring', 'UNV. EEE2 - UNIVERSITY ELECTIVE COURSES EEE2'),
-                # 4th Year Fall
-                (4, 'Fall', 'EEE 4910 - SENIOR DESIGN PROJECT I'),
-                (4, 'Fall', 'ENGR 4400 - ENGINEERING ETHICS AND SEMINAR'),
-                (4, 'Fall', 'ELECT EEE A2 - DEPARTMENTAL ELECTIVE COURSE A2'),
-                (4, 'Fall', 'ELECT EEE B1 - DEPARTMENTAL ELECTIVE COURSE B1'),
-                (4, 'Fall', 'UNV ELECT EEE1 - UNIVERSITY ELECTIVE COURSE EEE1'),
-                # 4th Year Spring
-                (4, 'Spring', 'EEE 4920 - SENIOR DESIGN PROJECT II'),
-                (4, 'Spring', 'ELECT EEE A3 - DEPARTMENTAL ELECTIVE COURSE A3'),
-                (4, 'Spring', 'ELECT EEE B2 - DEPARTMENTAL ELECTIVE COURSE B2'),
-                (4, 'Spring', 'ELECT EEE B3 - DEPARTMENTAL ELECTIVE COURSE B3'),
-                (4, 'Spring', 'UNV ELECT EEE2 - UNIVERSITY ELECTIVE COURSE EEE2')
-            ]
+# Autosave: editors send only what changed since the note version they last saw.
+#
+# Patches that arrive within AUTOSAVE_BATCH_WINDOW of each other are applied by one writer
+# thread per process and committed together, so a burst of saves costs one transaction and
+# consecutive patches to the same note become a single UPDATE. The UPDATE is conditional on
+# the version that was read, so writes from other worker processes are detected as conflicts.
+
+AutosaveResult = namedtuple('AutosaveResult', 'status version notes error', defaults=(None, None, None))
+
+
+class PatchError(ValueError):
+    """A change that does not apply to the note text"""
 
-            for year, semester, course_name in ee_courses:
-                course = Course(
-                    department_id=ee_eng.id,
-                    year=year,
-                    semester=semester,
-                    course_name=course_name
-                )
-                db.session.add(course)
-            db.session.commit()
-            print("Electrical-Electronics Engineering courses added.")
-
-        # Energy Systems Engineering courses
-        energy_eng = Department.query.filter_by(name='Energy Systems Engineering').first()
-        if energy_eng and not Course.query.filter_by(department_id=energy_eng.id).first():
-            energy_courses = [
-                # 1st Year Fall
-                (1, 'Fall', 'ENGR 1115 - INTRODUCTION TO PROGRAMMING'),
-                (1, 'Fall', 'MATH 1100 - MATHEMATICAL LOGIC'),
-                (1, 'Fall', 'MATH 1131 - CALCULUS I'),
-                (1, 'Fall', 'PHYS 1121 - PHYSICS I'),
-                (1, 'Fall', 'SOFL 1101 - ACADEMIC ENGLISH I'),
-                # 1st Year Spring
-                (1, 'Spring', 'CHEM 1130 - ENGINEERING CHEMISTRY'),
-                (1, 'Spring', 'ESE 1110 - INTRODUCTION TO ENERGY SYSTEMS ENGINEERING'),
-                (1, 'Spring', 'MATH 1132 - CALCULUS II'),
-                (1, 'Spring', 'PHYS 1122 - PHYSICS II'),
-                (1, 'Spring', 'SOFL 1102 - ACADEMIC ENGLISH II'),
-                # 2nd Year Fall
-                (2, 'Fall', 'ENGR 2120 - INTRO TO COMPUTER AIDED MODELING'),
-                (2, 'Fall', 'MATH 2230 - COMPUTATIONAL METHODS IN ENGINEERING'),
-                (2, 'Fall', 'ME 2320 - THERMODYNAMICS'),
-                (2, 'Fall', 'MATH 2263 - DIFFERENTIAL EQUATIONS AND DYNAMIC SYSTEMS'),
-                # 2nd Year Spring
-                (2, 'Spring', 'EEE 2280 - ELECTRIC CIRCUITS AND SYSTEMS'),
-                (2, 'Spring', 'ESE 2501 - MEASUREMENT TECHNIQUES AND INSTRUMENTATION'),
-                (2, 'Spring', 'MATH 2260 - PROBABILITY AND STATISTICS FOR ENGINEERING'),
-                (2, 'Spring', 'ME 3330 - FLUID MECHANICS AND MACHINERY'),
-                # 3rd Year Fall
-                (3, 'Fall', 'EEE 3718 - FEEDBACK SYSTEMS'),
-                (3, 'Fall', 'ESE 3504 -	SMART ENERGY SYSTEMS'),
-                (3, 'Fall', 'EEE 3615 -	ELECTROMECHANICAL ENERGY CONVERSION'),
-                (3, 'Fall', 'ME 2710 - MATERIAL SCIENCE'),
-                (3, 'Fall', 'ME 3320 - HEAT AND MASS TRANSFER'),
-                # 3rd Year Spring
-                (3, 'Spring', 'ENGR 3450 - PROJECT MANAGEMENT'),
-                (3, 'Spring', 'ESE 3404 - ENERGY EFFICIENCY AND MANAGEMENT'),
-                (3, 'Spring', 'ESE 3510 - POWER CONVERSION SYSTEMS'),
-                (3, 'Spring', 'ELECT ESE B1 - DEPARTMENTAL ELECTIVE COURSES-B1'),
-                (3, 'Spring', 'ESE 32X2 - RENEWABLE ENERGY ELECTIVE II'),
-                (3, 'Spring', 'UNV ELECT ESE1 - UNIVERSITY ELECTIVE COURSE ESE1'),
-                # 4th Year Fall
-                (4, 'Fall', 'ENGR 4400 - ENGINEERING ETHICS AND SEMINAR'),
-                (4, 'Fall', 'ESE 4910 -	ENERGY SYSTEMS ANALYSIS'),
-                (4, 'Fall', 'ELECT ESE A1 - DEPARTMENTAL ELECTIVE COURSE A1'),
-                (4, 'Fall', 'ELECT ESE B1 - DEPARTMENTAL ELECTIVE COURSE B1'),
-                (4, 'Fall', 'UNV ELECT ESE2 - UNIVERSITY ELECTIVE COURSE ESE2'),
-                # 4th Year Spring
-                (4, 'Spring', 'ESE 4920 - ENERGY SYSTEMS DESIGN'),
-                (4, 'Spring', 'ELECT ESE A2 - DEPARTMENTAL ELECTIVE COURSE A2'),
-                (4, 'Spring', 'ELECT ESE B2 - DEPARTMENTAL ELECTIVE COURSE B2'),
-                (4, 'Spring', 'ELECT ESE B3 - DEPARTMENTAL ELECTIVE COURSE B3'),
-                (4, 'Spring', 'UNV ELECT ESE3 - UNIVERSITY ELECTIVE COURSE ESE3')
-            ]
 
-            for year, semester, course_name in energy_courses:
-                course = Course(
-                    department_id=energy_eng.id,
-                    year=year,
-                    semester=semester,
-                    course_name=course_name
+def apply_changes(notes, changes):
+    """Apply [{start, end, text}] splices in order; offsets count UTF-16 code units like JavaScript"""
+    data = (notes or '').encode('utf-16-le')
+    try:
+        for change in changes:
+            start, end, insert = change['start'], change['end'], change['text']
+            if not (isinstance(start, int) and isinstance(end, int) and isinstance(insert, str)
+                    and 0 <= start <= end <= len(data) // 2):
+                raise PatchError(f'Invalid change {change!r}')
+            data = data[:2 * start] + insert.encode('utf-16-le') + data[2 * end:]
+        return data.decode('utf-16-le')
+    except (KeyError, TypeError):
+        raise PatchError('Changes must be objects with start, end and text')
+    except UnicodeError:
+        raise PatchError('A change splits a character')
+
+
+class AutosaveQueue:
+    """Collects autosave patches and writes them in batched transactions"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = []
+        self._thread = None
+
+    def submit(self, user_id, note_id, base_version, changes):
+        """Queue a patch and wait until it is committed or rejected"""
+        item = (user_id, note_id, base_version, changes, Future())
+        window = app.config['AUTOSAVE_BATCH_WINDOW']
+        if not window:
+            self._write([item])
+            return item[-1].result()
+
+        with self._condition:
+            self._pending.append(item)
+            if self._thread is None:
+                # Started on first use, so every gunicorn worker gets its own writer after the fork
+                self._thread = threading.Thread(target=self._run, args=(window,), name='autosave', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return item[-1].result(timeout=app.config['AUTOSAVE_TIMEOUT'])
+
+    def _run(self, window):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            time.sleep(window)  # let the rest of the burst arrive
+            with self._condition:
+                batch, self._pending = self._pending, []
+            with app.app_context():
+                self._write(batch)
+
+    def _write(self, batch):
+        """Apply a batch of patches in arrival order and commit them in one transaction"""
+        results = {}
+        try:
+            note_ids = {item[1] for item in batch}
+            state = {
+                row.id: {'user_id': row.user_id, 'notes': row.notes, 'version': row.version,
+                          'read_notes': row.notes, 'read_version': row.version}
+                for row in db.session.query(Note.id, Note.user_id, Note.notes, Note.version).filter(Note.id.in_(note_ids))
+            }
+
+            for user_id, note_id, base_version, changes, future in batch:
+                note = state.get(note_id)
+                if note is None or note['user_id'] != user_id:
+                    results[future] = AutosaveResult(404)
+                elif base_version != note['version']:
+                    results[future] = AutosaveResult(409, note['version'], note['notes'])
+                else:
+                    try:
+                        note['notes'] = apply_changes(note['notes'], changes)
+                    except PatchError as e:
+                        results[future] = AutosaveResult(400, note['version'], error=str(e))
+                        continue
+                    note['version'] += 1
+                    results[future] = AutosaveResult(200, note['version'])
+
+            lost = set()
+            for note_id, note in state.items():
+                if note['version'] == note['read_version']:
+                    continue
+                updated = db.session.execute(
+                    Note.__table__.update()
+                    .where(Note.id == note_id, Note.version == note['read_version'])
+                    .values(notes=note['notes'], version=note['version'])
                 )
-                db.session.add(course)
+                if updated.rowcount == 0:
+                    lost.add(note_id)
+                else:
+                    record_revision(note_id, note['version'], note['notes'], note['read_notes'], note['read_version'],
+                                    merge=True)
             db.session.commit()
-            print("Energy Systems Engineering courses added.")
-
-        # Software Engineering courses
-        software_eng = Department.query.filter_by(name='Software Engineering').first()
-        if software_eng and not Course.query.filter_by(department_id=software_eng.id).first():
-            software_courses = [
-                # 1st Year Fall
-                (1, 'Fall', 'MATH 1100 - MATHEMATICAL LOGIC'),
-                (1, 'Fall', 'MATH 1131 - CALCULUS I'),
-                (1, 'Fall', 'PHYS 1121 - PHYSICS I'),
-                (1, 'Fall', 'SE 1105 - PROGRAMMING AND PROBLEM SOLVING I'),
-                (1, 'Fall', 'SOFL 1101 - ACADEMIC ENGLISH I'),
-                # 1st Year Spring
-                (1, 'Spring', 'MATH 1132 - CALCULUS II'),
-                (1, 'Spring', 'PHYS 1122 - PHYSICS II'),
-                (1, 'Spring', 'SE 1108 - PROGRAMMING AND PROBLEM SOLVING II'),
-                (1, 'Spring', 'SOFL 1102 - ACADEMIC ENGLISH II'),
-                # 2nd Year Fall
-                (2, 'Fall', 'MATH 2255 - LINEAR ALGEBRA'),
-                (2, 'Fall', 'COMP 1202 - DISCRETE COMPUTATIONAL STRUCTURES'),
-                (2, 'Fall', 'SE 2217 - SOFTWARE ENGINEERING PRINCIPLES'),
-                (2, 'Fall', 'SE 2310 - DATA STRUCTURES AND ALGORITHMS'),
-                # 2nd Year Spring
-                (2, 'Spring', 'MATH 2261 - INTRODUCTION TO DIFFERENTIAL EQUATIONS'),
-                (2, 'Spring', 'SE 2226 - SOFTWARE QUALITY ASSURANCE AND TESTING'),
-                (2, 'Spring', 'SE 2228 - ANALYSIS AND DESIGN OF ALGORITHMS'),
-                (2, 'Spring', 'SE 2230 - DATABASE SYSTEMS'),
-                (2, 'Spring', 'SE 2232 - SOFTWARE SYSTEM ANALYSIS'),
-                # 3rd Year Fall
-                (3, 'Fall', 'SE 3317 - SOFTWARE DESIGN AND ARCHITECTURE'),
-                (3, 'Fall', 'SE 3310 - OPERATING SYSTEMS AND NETWORKING'),
-                (3, 'Fall', 'MATH 2260 - PROBABILITY AND STATISTICS FOR ENGINEERING'),
-                (3, 'Fall', 'COMP 3330 - AUTOMATA THEORY'),
-                (3, 'Fall', 'UNV ELECT SE1 - UNIVERSITY ELECTIVE COURSE SE1'),
-                # 3rd Year Spring
-                (3, 'Spring', 'EEE 2110	- DIGITAL DESIGN'),
-                (3, 'Spring', '	ENGR 3450 - PROJECT MANAGEMENT'),
-                (3, 'Spring', 'ENGR 4400 - ENGINEERING ETHICS AND SEMINAR'),
-                (3, 'Spring', 'SE 3318 - SOFTWARE CONSTRUCTION'),
-                (3, 'Spring', 'SE 3332 - LOW LEVEL PROGRAMMING'),
-                (3, 'Spring', 'ELECT SE A1 - DEPARTMENT ELECTIVE COURSE A1'),
-                # 4th Year Fall
-                (4, 'Fall', 'SE 4910 - GRADUATION DESIGN PROJECT I'),
-                (4, 'Fall', 'ELECT SE A2 - DEPARTMENTAL ELECTIVE COURSE A2'),
-                (4, 'Fall', 'ELECT SE A3 - DEPARTMENTAL ELECTIVE COURSE A3'),
-                (4, 'Fall', 'UNV ELECT SE2 - UNIVERSITY ELECTIVE COURSE SE2'),
-                # 4th Year Spring
-                (4, 'Spring', 'SE 4920 - GRADUATION DESIGN PROJECT II'),
-                (4, 'Spring', 'ELECT SE B1 - DEPARTMENTAL ELECTIVE COURSE B1'),
-                (4, 'Spring', 'ELECT SE B2 - DEPARTMENTAL ELECTIVE COURSE B2'),
-                (4, 'Spring', 'UNV ELECT SE4 - UNIVERSITY ELECTIVE COURSE SE3')
-            ]
+            related_index.changed()
 
-            for year, semester, course_name in software_courses:
-                course = Course(
-                    department_id=software_eng.id,
-                    year=year,
-                    semester=semester,
-                    course_name=course_name
+            if lost:
+                # Another process wrote these notes after they were read; report its version
+                current = dict(
+                    (row.id, row) for row in
+                    db.session.query(Note.id, Note.notes, Note.version).filter(Note.id.in_(lost))
                 )
-                db.session.add(course)
+                for user_id, note_id, base_version, changes, future in batch:
+                    if note_id in lost and results[future].status == 200:
+                        row = current.get(note_id)
+                        results[future] = (AutosaveResult(409, row.version, row.notes) if row
+                                           else AutosaveResult(404))
+        except Exception as e:
+            db.session.rollback()
+            for *_, future in batch:
+                future.set_exception(e)
+            if not has_request_context():
+                app.logger.exception('Autosave batch failed')
+            return
+
+        for *_, future in batch:
+            future.set_result(results[future])
+
+
+autosave_queue = AutosaveQueue()
+
+
+@app.route('/api/notes/<int:note_id>/autosave', methods=['POST'])
+@rate_limited('note_write')
+def autosave_note(note_id):
+    """Apply text changes to a note, based on the version the editor last saw"""
+    data = request.get_json(silent=True) or {}
+    base_version, changes = data.get('base_version'), data.get('changes')
+    if not isinstance(base_version, int) or not isinstance(changes, list):
+        return jsonify({'success': False, 'error': 'base_version and a list of changes are required'}), 400
+
+    try:
+        result = autosave_queue.submit(g.user.id, note_id, base_version, changes)
+    except TimeoutError:
+        return jsonify({'success': False, 'error': 'Autosave is busy, try again'}), 503
+
+    if result.status == 404:
+        abort(404)
+    if result.status == 409:
+        return note_conflict(result.version, result.notes)
+    if result.status == 400:
+        return jsonify({'success': False, 'error': result.error, 'version': result.version}), 400
+    return jsonify({'success': True, 'version': result.version})
+
+
+# Revision history
+#
+# Every save of a note adds a NoteRevision holding a zlib-compressed delta against the
+# previous revision, so history grows with the size of the edits. Every
+# REVISION_SNAPSHOT_INTERVAL revisions the full text is stored instead, which bounds
+# reconstructing any revision to that many deltas. Autosaves within REVISION_MERGE_SECONDS of
+# the latest revision replace it when that was an autosave too, so an autosaving editor does
+# not leave a revision per pause; explicit saves, restores and new notes always keep their own.
+
+def make_delta(old, new):
+    """Describe new as [start, end] slices of old and inserted strings, trimming common ends"""
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-suffix - 1] == new[-suffix - 1]:
+        suffix += 1
+    old_end, new_end = len(old) - suffix, len(new) - suffix
+
+    ops = [[0, prefix]] if prefix else []
+    old_lines = old[prefix:old_end].splitlines(keepends=True)
+    new_lines = new[prefix:new_end].splitlines(keepends=True)
+    if len(old_lines) > 1 and len(new_lines) > 1:
+        # Several lines changed: keep the unchanged lines in between as slices too
+        offsets = [prefix]
+        for line in old_lines:
+            offsets.append(offsets[-1] + len(line))
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                ops.append([offsets[i1], offsets[i2]])
+            elif j1 < j2:
+                ops.append(''.join(new_lines[j1:j2]))
+    elif new_end > prefix:
+        ops.append(new[prefix:new_end])
+    if suffix:
+        ops.append([old_end, len(old)])
+    return ops
+
+
+def apply_delta(old, ops):
+    return ''.join(old[op[0]:op[1]] if isinstance(op, list) else op for op in ops)
+
+
+def encode_delta(ops):
+    return zlib.compress(json.dumps(ops, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+def decode_delta(data):
+    return json.loads(zlib.decompress(data))
+
+
+def revision_chain(note_id, version):
+    """The revisions from the last snapshot up to version, oldest first"""
+    snapshot = (db.session.query(func.max(NoteRevision.version))
+                .filter(NoteRevision.note_id == note_id, NoteRevision.version <= version, NoteRevision.depth == 0)
+                .scalar_subquery())
+    return (NoteRevision.query
+            .filter(NoteRevision.note_id == note_id, NoteRevision.version >= snapshot, NoteRevision.version <= version)
+            .order_by(NoteRevision.version)
+            .all())
+
+
+def revision_text(note_id, version):
+    """Reconstruct the text of a revision, or None if there is no such revision"""
+    chain = revision_chain(note_id, version)
+    if not chain or chain[-1].version != version:
+        return None
+    notes = ''
+    for revision in chain:
+        notes = apply_delta(notes, decode_delta(revision.delta))
+    return notes
+
+
+def record_revision(note_id, version, notes, previous=None, base_version=None, merge=False):
+    """Store version of a note, edited from the text previous at base_version (None for a new note);
+    merge=True marks an autosave, which may be folded into a recent autosave revision"""
+    notes, previous = notes or '', previous or ''
+    now = datetime.utcnow()
+    if base_version is None:
+        # A new note: its first revision is a snapshot
+        revision = NoteRevision(note_id=note_id, version=version, depth=0,
+                                delta=encode_delta([notes]), length=len(notes), created_at=now)
+        db.session.add(revision)
+        return revision
+
+    latest = (NoteRevision.query.filter_by(note_id=note_id)
+              .order_by(NoteRevision.version.desc()).first())
+
+    if latest is None:
+        # First save since history began: keep the text it replaces as the first snapshot
+        latest = NoteRevision(note_id=note_id, version=base_version, depth=0,
+                              delta=encode_delta([previous]), length=len(previous), created_at=now)
+        db.session.add(latest)
+        merge = False
+
+    if (merge and latest.autosave
+            and now - latest.created_at < timedelta(seconds=app.config['REVISION_MERGE_SECONDS'])):
+        # Fold this save into the latest revision, re-deriving its delta from the one before
+        if latest.depth == 0:
+            ops = [notes]
+        else:
+            base = revision_text(note_id, revision_chain(note_id, latest.version)[-2].version)
+            ops = make_delta(base, notes)
+        latest.version, latest.delta, latest.length = version, encode_delta(ops), len(notes)
+        return latest
+
+    # Chain a delta only onto the revision this save was edited from; anything else starts a snapshot
+    chained = (latest is not None and latest.version == base_version
+               and latest.depth + 1 < app.config['REVISION_SNAPSHOT_INTERVAL'])
+    revision = NoteRevision(
+        note_id=note_id,
+        version=version,
+        depth=latest.depth + 1 if chained else 0,
+        delta=encode_delta(make_delta(previous, notes) if chained else [notes]),
+        length=len(notes),
+        created_at=now,
+        autosave=merge,
+    )
+    db.session.add(revision)
+    return revision
+
+
+@app.route('/notes/<int:note_id>/history')
+def note_history(note_id):
+    """List the revisions of a note and show the text of one of them"""
+    note = Note.query.filter_by(id=note_id, user_id=g.user.id).first_or_404()
+    revisions = (NoteRevision.query.filter_by(note_id=note.id)
+                 .with_entities(NoteRevision.version, NoteRevision.length, NoteRevision.created_at)
+                 .order_by(NoteRevision.version.desc()).all())
+
+    selected = request.args.get('version', type=int)
+    if selected is None and revisions:
+        selected = revisions[0].version
+    selected_text = revision_text(note.id, selected) if selected is not None else None
+    if selected is not None and selected_text is None:
+        abort(404)
+    return render_template('note_history.html', note=note, revisions=revisions,
+                           selected=selected, selected_text=selected_text)
+
+
+@app.route('/notes/<int:note_id>/restore/<int:version>', methods=['POST'])
+def restore_note(note_id, version):
+    """Make an earlier revision the current text of a note, as a new revision"""
+    note = Note.query.filter_by(id=note_id, user_id=g.user.id).first_or_404()
+    restored = revision_text(note.id, version)
+    if restored is None:
+        abort(404)
+
+    previous, base_version = note.notes, note.version
+    note.notes = restored
+    db.session.flush()
+    # Never merged, so the text being replaced stays in the history
+    record_revision(note.id, note.version, restored, previous, base_version, merge=False)
+    db.session.commit()
+    related_index.changed()
+
+    if request.is_json:
+        return jsonify({'success': True, 'version': note.version})
+    flash(f'Note restored to revision {version}.', 'success')
+    return redirect(url_for('add_note', course_id=note.course_id))
+
+
+# Export and import
+#
+# An export is an uncompressed tar stream: manifest.json, then for every EXPORT_BATCH_SIZE
+# notes the images they use that were not exported yet (under images/<upload path>),
+# followed by the notes themselves as notes/<n>.jsonl. Members are written straight from
+# the database and the upload files, so memory stays constant however large the export.
+# Import reads the same layout as a stream, stores images by content hash (so an image
+# already on the server is not stored twice) and inserts notes in batched transactions,
+# skipping notes that are already present so an interrupted import can simply be rerun.
+
+EXPORT_FORMAT = 'noteswise-export'
+EXPORT_FORMAT_VERSION = 1
+
+
+def tar_member(name, size, chunks, mtime=None):
+    """Yield one tar member: its header, the data chunks and padding to a full block"""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime if mtime is not None else time.time())
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    yield from chunks
+    if size % tarfile.BLOCKSIZE:
+        yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+
+
+def export_batches(user_id=None):
+    """Notes with their owner and the natural key of their course, in batches by id"""
+    query = (db.session.query(Note.id, Note.notes, Note.image_path, Note.created_at, User.username,
+                              Department.name.label('department'), Course.year, Course.semester,
+                              Course.code, Course.course_name)
+             .join(Course, Note.course_id == Course.id)
+             .join(Department, Course.department_id == Department.id)
+             .outerjoin(User, Note.user_id == User.id))
+    if user_id is not None:
+        query = query.filter(Note.user_id == user_id)
+
+    last_id = 0
+    while batch := query.filter(Note.id > last_id).order_by(Note.id).limit(app.config['EXPORT_BATCH_SIZE']).all():
+        yield batch
+        last_id = batch[-1].id
+
+
+def generate_export(user_id=None):
+    """Yield the export archive of one user's notes, or of every note, as byte chunks"""
+    manifest = json.dumps({
+        'format': EXPORT_FORMAT,
+        'version': EXPORT_FORMAT_VERSION,
+        'exported_at': datetime.utcnow().isoformat(timespec='seconds'),
+    }, indent=2).encode()
+    yield from tar_member('manifest.json', len(manifest), [manifest])
+
+    exported_images = set()
+    for number, batch in enumerate(export_batches(user_id), start=1):
+        lines = []
+        for row in batch:
+            image = f'images/{row.image_path}' if row.image_path else None
+            if image and image not in exported_images:
+                stored = storage.stat(row.image_path)
+                if stored is None:
+                    app.logger.warning('Exporting note %s without its missing image %s', row.id, row.image_path)
+                    image = None
+                else:
+                    exported_images.add(image)
+                    yield from tar_member(image, stored.size, storage.read_chunks(row.image_path), stored.mtime)
+            lines.append(json.dumps({
+                'user': row.username,
+                'course': {'department': row.department, 'year': row.year, 'semester': row.semester,
+                           'code': row.code, 'course_name': row.course_name},
+                'notes': row.notes,
+                'image': image,
+                'created_at': row.created_at.isoformat() if row.created_at else None,
+            }, ensure_ascii=False))
+        data = ('\n'.join(lines) + '\n').encode()
+        yield from tar_member(f'notes/{number:06d}.jsonl', len(data), [data])
+    # End of archive: two empty blocks
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+class NoteImporter:
+    """Inserts the notes of an export archive in batches, resolving courses and users once"""
+
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+        self.images = {}  # archive member name -> (upload path, sha256)
+        self.used_images = set()
+        self.courses = {}
+        self.users = {}
+        self.pending = []
+        self.stats = Counter()
+
+    def add_image(self, name, stream):
+        """Store an image member; anything that is not an image is left out of the import"""
+        try:
+            self.images[name] = store_image(stream, name)
+        except UploadRejected:
+            self.stats['rejected_images'] += 1
+
+    def add_note(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= app.config['IMPORT_BATCH_SIZE']:
+            self.flush()
+
+    def course_id(self, course):
+        key = (course['department'], course['year'], course['semester'], course['code'] or course['course_name'])
+        if key not in self.courses:
+            query = (db.session.query(Course.id).join(Course.department)
+                     .filter(Department.name == course['department'], Course.year == course['year'],
+                             Course.semester == course['semester']))
+            if course['code']:
+                query = query.filter(Course.code == course['code'])
+            else:
+                query = query.filter(Course.course_name == course['course_name'])
+            self.courses[key] = query.scalar()
+        return self.courses[key]
+
+    def owner_id(self, username):
+        if self.user_id is not None:
+            return self.user_id
+        if username not in self.users:
+            self.users[username] = db.session.query(User.id).filter_by(username=username).scalar()
+        return self.users[username]
+
+    def flush(self):
+        """Insert the pending notes that are not already present, in one transaction"""
+        rows = []
+        for record in self.pending:
+            user_id, course_id = self.owner_id(record['user']), self.course_id(record['course'])
+            if user_id is None or course_id is None:
+                self.stats['skipped'] += 1
+                continue
+            # A bulk insert bypasses the column default, so notes without a date are dated now
+            created_at = (datetime.fromisoformat(record['created_at']) if record.get('created_at')
+                          else datetime.now(timezone(timedelta(hours=3))))
+            rows.append({'user_id': user_id, 'course_id': course_id, 'notes': record['notes'],
+                         'image': record['image'], 'created_at': created_at})
+        self.pending = []
+
+        existing = set(
+            db.session.query(Note.user_id, Note.course_id, Note.created_at, Note.notes)
+            .filter(Note.user_id.in_({row['user_id'] for row in rows}),
+                    Note.created_at.in_({row['created_at'] for row in rows}))
+        ) if rows else set()
+
+        inserts = []
+        refs = Counter()
+        for row in rows:
+            key = (row['user_id'], row['course_id'], row['created_at'], row['notes'])
+            if key in existing:
+                self.stats['duplicates'] += 1
+                continue
+            existing.add(key)
+            stored = self.images.get(row.pop('image'))
+            row['image_path'] = stored[0] if stored else None
+            if stored:
+                refs[stored] += 1
+            inserts.append(row)
+
+        if inserts:
+            db.session.execute(Note.__table__.insert(), inserts)
+        for (path, sha256), count in refs.items():
+            add_image_refs(path, sha256, count)
+        db.session.commit()
+        self.stats['notes'] += len(inserts)
+
+        for path, sha256 in refs:
+            if path not in self.used_images:
+                self.used_images.add(path)
+                schedule_variants(path)
+
+    def finish(self):
+        """Flush the last batch and delete stored images that no note ended up using"""
+        self.flush()
+        unused = {path for path, sha256 in self.images.values()} - self.used_images
+        if unused:
+            referenced = {path for path, in db.session.query(ImageBlob.path).filter(ImageBlob.path.in_(unused))}
+            remove_uploads(unused - referenced)
+        self.stats['images'] = len(self.used_images)
+        return self.stats
+
+
+def import_archive(fileobj, user_id=None):
+    """Import an export archive read as a stream; raises ValueError if it is not one"""
+    importer = NoteImporter(user_id)
+    manifest = None
+    try:
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                if member.name == 'manifest.json':
+                    manifest = json.load(archive.extractfile(member))
+                    if manifest.get('format') != EXPORT_FORMAT or manifest.get('version', 0) > EXPORT_FORMAT_VERSION:
+                        raise ValueError('Unsupported export format')
+                elif manifest is None:
+                    raise ValueError('The archive does not start with an export manifest')
+                elif member.name.startswith('images/'):
+                    importer.add_image(member.name, archive.extractfile(member))
+                elif member.name.startswith('notes/') and member.name.endswith('.jsonl'):
+                    for line in archive.extractfile(member):
+                        if line.strip():
+                            importer.add_note(json.loads(line))
+    except (tarfile.TarError, KeyError, TypeError, ValueError) as e:
+        db.session.rollback()
+        raise ValueError(f'Could not import the archive: {e}') from e
+    if manifest is None:
+        raise ValueError('The archive does not contain an export manifest')
+    return importer.finish()
+
+
+@app.route('/export')
+def export_notes():
+    """Download all of the user's notes and images as a tar archive"""
+    filename = f"noteswise-{g.user.username}-{datetime.now():%Y%m%d}.tar"
+    return app.response_class(
+        stream_with_context(generate_export(g.user.id)),
+        mimetype='application/x-tar',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+
+@app.route('/import', methods=['POST'])
+def import_notes():
+    """Add the notes of an uploaded export archive to the user's notes"""
+    archive = request.files.get('archive')
+    if not archive or not archive.filename:
+        flash('Choose an exported archive to import.', 'error')
+        return redirect(url_for('all_notes'))
+
+    try:
+        stats = import_archive(archive.stream, g.user.id)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('all_notes'))
+
+    flash(f"Imported {stats['notes']} notes with {stats['images']} images "
+          f"({stats['duplicates']} notes were already here, {stats['skipped']} belong to unknown courses, "
+          f"{stats['rejected_images']} files were not images).", 'success')
+    return redirect(url_for('all_notes'))
+
+
+@app.cli.command('export-notes')
+@click.argument('output', type=click.File('wb'))
+@click.option('--user', 'username', help='Only export the notes of this user.')
+def export_notes_command(output, username):
+    """Write every note and image to a tar archive (- for stdout)"""
+    user_id = None
+    if username:
+        user_id = db.session.query(User.id).filter_by(username=username).scalar()
+        if user_id is None:
+            raise click.ClickException(f'No user named {username!r}')
+    for chunk in generate_export(user_id):
+        output.write(chunk)
+
+
+@app.cli.command('import-notes')
+@click.argument('archive', type=click.File('rb'))
+@click.option('--user', 'username', help='Give every note to this user instead of the user it was exported from.')
+def import_notes_command(archive, username):
+    """Import an archive written by export-notes or /export (- for stdin)"""
+    user_id = None
+    if username:
+        user_id = db.session.query(User.id).filter_by(username=username).scalar()
+        if user_id is None:
+            raise click.ClickException(f'No user named {username!r}')
+    try:
+        stats = import_archive(archive, user_id)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"Imported {stats['notes']} notes with {stats['images']} images; "
+          f"{stats['duplicates']} notes were already present, {stats['skipped']} had an unknown user or course, "
+          f"{stats['rejected_images']} files were not images and were left out.")
+
+
+# JSON API, version 1
+#
+# Everything under /api/v1 answers with compact JSON ({"success": true, ...}). List and
+# detail endpoints take ?fields=a,b to return only some fields; batch endpoints apply up to
+# API_BATCH_LIMIT changes in one transaction, and write nothing if any item is invalid.
+
+DEPARTMENT_FIELDS = ('id', 'name')
+COURSE_FIELDS = ('id', 'department_id', 'year', 'semester', 'name', 'current')
+NOTE_FIELDS = ('id', 'course_id', 'notes', 'image_path', 'version', 'created_at', 'updated_at')
+
+
+class ApiError(Exception):
+    """An API request that cannot be served; becomes a JSON error response"""
+
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+@app.errorhandler(ApiError)
+def handle_api_error(e):
+    return api_response(status=e.status, success=False, error=str(e), **e.details)
+
+
+@app.errorhandler(HTTPException)
+def handle_http_error(e):
+    """JSON errors for API clients, the usual error pages for everyone else"""
+    if request.path.startswith('/api/') and e.code >= 400:
+        return api_response(status=e.code, success=False, error=e.description)
+    return e
+
+
+def api_response(status=200, **payload):
+    """Compact JSON response, whatever the app's debug pretty-printing"""
+    body = json.dumps({'success': True, **payload}, ensure_ascii=False, separators=(',', ':'))
+    return app.response_class(body, status=status, mimetype='application/json')
+
+
+def api_fields(allowed):
+    """Fields requested with ?fields=, all of them by default"""
+    requested = request.args.get('fields')
+    if not requested:
+        return allowed
+    fields = tuple(dict.fromkeys(field.strip() for field in requested.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ApiError(f"Unknown fields: {', '.join(unknown)}", allowed=list(allowed))
+    return fields
+
+
+def api_json():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ApiError('Expected a JSON object')
+    return data
+
+
+def api_id_list(data, key):
+    """A list of integer ids from the request body, at most API_BATCH_LIMIT long"""
+    ids = data.get(key, [])
+    if not isinstance(ids, list) or not all(isinstance(item, int) for item in ids):
+        raise ApiError(f'{key} must be a list of ids')
+    return ids
+
+
+def check_batch_size(*items):
+    size = sum(len(item) for item in items)
+    if size > app.config['API_BATCH_LIMIT']:
+        raise ApiError(f"At most {app.config['API_BATCH_LIMIT']} changes per request", 413)
+
+
+def course_fields(course, fields, current_ids):
+    values = {
+        'id': course.id,
+        'department_id': course.department_id,
+        'year': course.year,
+        'semester': course.semester,
+        'name': display_course_name(course),
+        'current': course.id in current_ids,
+    }
+    return {field: values[field] for field in fields}
+
+
+def note_fields(note, fields):
+    return {field: value for field, value in note_to_dict(note).items() if field in fields}
+
+
+@app.route('/api/v1/departments')
+@cached_view('department')
+def api_v1_departments():
+    """Every department"""
+    fields = api_fields(DEPARTMENT_FIELDS)
+    return api_response(departments=[
+        {field: getattr(department, field) for field in fields} for department in catalogue_cache.departments()
+    ])
+
+
+@app.route('/api/v1/departments/<int:dept_id>/courses')
+@cached_view('department', 'course', 'current_course', 'course_name_override')
+def api_v1_department_courses(dept_id):
+    """Courses of a department, for one year (?year=) and optionally one semester (?semester=)"""
+    catalogue_cache.department(dept_id) or abort(404)
+    year = request.args.get('year', type=int)
+    fields = api_fields(COURSE_FIELDS)
+    if year is None:
+        raise ApiError('year is required')
+    current_ids = catalogue_cache.current_course_ids(g.user.id) if g.user else frozenset()
+    courses = catalogue_cache.courses(dept_id, year, request.args.get('semester'))
+    return api_response(courses=[course_fields(course, fields, current_ids) for course in courses])
+
+
+@app.route('/api/v1/courses/<int:course_id>')
+@cached_view('department', 'course', 'current_course', 'course_name_override')
+def api_v1_course(course_id):
+    """One course"""
+    course = catalogue_cache.course(course_id) or abort(404)
+    current_ids = catalogue_cache.current_course_ids(g.user.id) if g.user else frozenset()
+    return api_response(course=course_fields(course, api_fields(COURSE_FIELDS), current_ids))
+
+
+@app.route('/api/v1/current_courses')
+@cached_view('department', 'course', 'current_course', 'course_name_override')
+def api_v1_current_courses():
+    """The user's current courses, most recently added first"""
+    fields = api_fields(COURSE_FIELDS)
+    course_ids = [course_id for course_id, in
+                  db.session.query(CurrentCourse.course_id).filter(CurrentCourse.user_id == g.user.id)
+                  .order_by(CurrentCourse.added_at.desc())]
+    current_ids = frozenset(course_ids)
+    courses = filter(None, map(catalogue_cache.course, course_ids))
+    return api_response(courses=[course_fields(course, fields, current_ids) for course in courses])
+
+
+@app.route('/api/v1/current_courses/batch', methods=['POST'])
+def api_v1_current_courses_batch():
+    """Add and remove many current courses at once: {"add": [ids], "remove": [ids]}"""
+    data = api_json()
+    add, remove = api_id_list(data, 'add'), api_id_list(data, 'remove')
+    check_batch_size(add, remove)
+    if set(add) & set(remove):
+        raise ApiError('A course cannot be both added and removed')
+    unknown = [course_id for course_id in add if catalogue_cache.course(course_id) is None]
+    if unknown:
+        raise ApiError('Unknown courses', 404, missing=unknown)
+
+    if add:
+        now = datetime.utcnow()
+        db.session.execute(
+            sqlite_insert(CurrentCourse)
+            .values([{'user_id': g.user.id, 'course_id': course_id, 'added_at': now} for course_id in set(add)])
+            .on_conflict_do_nothing(index_elements=['user_id', 'course_id'])
+        )
+    if remove:
+        (CurrentCourse.query
+         .filter(CurrentCourse.user_id == g.user.id, CurrentCourse.course_id.in_(remove))
+         .delete(synchronize_session=False))
+    db.session.commit()
+    catalogue_cache.invalidate_current_courses(g.user.id)
+    return api_response(current_course_ids=sorted(catalogue_cache.current_course_ids(g.user.id)))
+
+
+@app.route('/api/v1/notes')
+def api_v1_notes():
+    """The user's notes, newest first, paginated by cursor and optionally for one course"""
+    fields = api_fields(NOTE_FIELDS)
+    query = Note.query.filter_by(user_id=g.user.id)
+    course_id = request.args.get('course_id', type=int)
+    if course_id is not None:
+        query = query.filter_by(course_id=course_id)
+    try:
+        notes, next_cursor = notes_page(query, request.args.get('cursor'), request.args.get('limit', type=int))
+    except ValueError as e:
+        raise ApiError(str(e))
+    return api_response(notes=[note_fields(note, fields) for note in notes], next_cursor=next_cursor)
+
+
+@app.route('/api/v1/notes/<int:note_id>')
+def api_v1_note(note_id):
+    """One note"""
+    note = Note.query.filter_by(id=note_id, user_id=g.user.id).first_or_404()
+    return api_response(note=note_fields(note, api_fields(NOTE_FIELDS)))
+
+
+@app.route('/api/v1/notes/batch', methods=['POST'])
+def api_v1_notes_batch():
+    """Create and delete many notes in one transaction:
+    {"create": [{"course_id": 1, "notes": "..."}], "delete": [ids]}
+    """
+    data = api_json()
+    create, delete = data.get('create', []), api_id_list(data, 'delete')
+    if not isinstance(create, list) or not all(
+            isinstance(item, dict) and isinstance(item.get('course_id'), int)
+            and isinstance(item.get('notes'), str) for item in create):
+        raise ApiError('create must be a list of {"course_id": id, "notes": text} objects')
+    check_batch_size(create, delete)
+    fields = api_fields(NOTE_FIELDS)
+
+    unknown = sorted({item['course_id'] for item in create if catalogue_cache.course(item['course_id']) is None})
+    if unknown:
+        raise ApiError('Unknown courses', 404, missing=unknown)
+    doomed = Note.query.filter(Note.user_id == g.user.id, Note.id.in_(delete)).all() if delete else []
+    missing = sorted(set(delete) - {note.id for note in doomed})
+    if missing:
+        raise ApiError('Unknown notes', 404, missing=missing)
+
+    unused_files = []
+    if doomed:
+        NoteRevision.query.filter(NoteRevision.note_id.in_(delete)).delete(synchronize_session=False)
+        for note in doomed:
+            if note.image_path:
+                unused_files += release_image(note.image_path)
+            db.session.delete(note)
+
+    created = [Note(user_id=g.user.id, course_id=item['course_id'], notes=item['notes']) for item in create]
+    db.session.add_all(created)
+    db.session.flush()
+    for note in created:
+        record_revision(note.id, note.version, note.notes)
+    db.session.commit()
+    remove_uploads(unused_files)
+    for note_id in delete:
+        fragment_cache.invalidate(NOTE_CARD, note_id)
+    related_index.changed()
+
+    return api_response(created=[note_fields(note, fields) for note in created], deleted=sorted(delete))
+
+
+# Delta sync
+#
+# Clients keep a copy of the user's notes (see static/js/main.js) and fetch only what changed
+# since their last sync. Every note write stamps Note.updated_at with SQL_NOW and every delete
+# leaves a NoteTombstone, so /api/v1/sync returns the notes changed after a sync token in
+# (updated_at, id) order plus the ids deleted since then. SQLite admits one writer at a time,
+# so a transaction that commits later than a sync read stamps its rows at or after everything
+# that read saw; tokens are therefore inclusive of their timestamp once a client has caught up.
+# Tombstones are pruned after SYNC_TOMBSTONE_DAYS, and clients that have not synced for that
+# long are sent everything again.
+
+NOTE_SYNC_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS note_tombstone_ad AFTER DELETE ON note
+    WHEN old.user_id IS NOT NULL BEGIN
+        INSERT OR REPLACE INTO note_tombstone (note_id, user_id, deleted_at)
+        VALUES (old.id, old.user_id, strftime('%Y-%m-%d %H:%M:%f000', 'now'));
+    END""",
+    # SQLite may hand the id of a deleted note to a new one
+    """CREATE TRIGGER IF NOT EXISTS note_tombstone_ai AFTER INSERT ON note BEGIN
+        DELETE FROM note_tombstone WHERE note_id = new.id;
+    END""",
+]
+
+# Timestamp of a token issued before the first sync
+SYNC_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_sync_token(changed_at, note_id, synced_at):
+    """Opaque token: position in the (updated_at, id) feed and when the client synced"""
+    raw = f"{changed_at.isoformat()}|{note_id}|{synced_at.isoformat()}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_sync_token(token):
+    """Decode a sync token to (changed_at, note_id, synced_at), raising ValueError if it is malformed"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        changed_at, note_id, synced_at = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(changed_at), int(note_id), datetime.fromisoformat(synced_at)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f'Invalid sync token: {token!r}') from e
+
+
+@app.route('/api/v1/sync')
+def api_v1_sync():
+    """Notes changed and ids deleted since ?since=<token>, oldest change first
+
+    Without a token, or with one older than SYNC_TOMBSTONE_DAYS, the response has
+    "reset": true and starts from scratch. While "more" is true, call again with the
+    returned token. ?html=1 adds each note's rendered card.
+    """
+    since = request.args.get('since')
+    limit = request.args.get('limit', app.config['SYNC_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['SYNC_PAGE_SIZE']))
+    now = datetime.utcnow()
+    changed_at, after_id, reset = SYNC_EPOCH, 0, True
+    if since:
+        try:
+            changed_at, after_id, synced_at = decode_sync_token(since)
+        except ValueError as e:
+            raise ApiError(str(e))
+        reset = synced_at < now - timedelta(days=app.config['SYNC_TOMBSTONE_DAYS'])
+        if reset:
+            changed_at, after_id = SYNC_EPOCH, 0
+
+    query = Note.query.filter(Note.user_id == g.user.id).options(joinedload(Note.course))
+    if not reset:
+        query = query.filter(or_(Note.updated_at > changed_at,
+                                 and_(Note.updated_at == changed_at, Note.id > after_id)))
+    notes = query.order_by(Note.updated_at, Note.id).limit(limit + 1).all()
+    more = len(notes) > limit
+    notes = notes[:limit]
+
+    deleted = [] if reset else (
+        db.session.query(NoteTombstone.note_id, NoteTombstone.deleted_at)
+        .filter(NoteTombstone.user_id == g.user.id, NoteTombstone.deleted_at >= changed_at)
+        .all()
+    )
+
+    if more:
+        token = encode_sync_token(notes[-1].updated_at, notes[-1].id, now)
+    else:
+        # Caught up: the next sync starts at the latest change seen and includes its timestamp,
+        # in case another transaction stamped the same millisecond and had not committed yet
+        latest = max([note.updated_at for note in notes] + [row.deleted_at for row in deleted] + [changed_at])
+        token = encode_sync_token(latest, 0, now)
+
+    html = request.args.get('html') == '1'
+    payload = []
+    for note in notes:
+        item = note_to_dict(note)
+        item['cursor'] = encode_cursor(note)
+        if html:
+            item['html'] = render_template('partials/note_card.html', note=note, show_course=True)
+        payload.append(item)
+    return api_response(user_id=g.user.id, reset=reset, notes=payload,
+                        deleted=[row.note_id for row in deleted], token=token, more=more)
+
+
+@app.route('/sw.js')
+def service_worker():
+    """The service worker, served from the root so that it controls every page"""
+    response = app.send_static_file('js/sw.js')
+    response.cache_control.no_cache = True
+    return response
+
+
+# Per-course note statistics
+#
+# course_note_stats holds one row per user and course, maintained by triggers in the same
+# transaction as every note insert, delete and move, so the course lists read the numbers
+# with a primary key lookup instead of counting notes. Notes without an owner are left out.
+
+COURSE_NOTE_STATS_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS course_note_stats_ai AFTER INSERT ON note
+    WHEN new.user_id IS NOT NULL BEGIN
+        INSERT INTO course_note_stats (user_id, course_id, note_count, image_count, latest_note_at)
+        VALUES (new.user_id, new.course_id, 1, new.image_path IS NOT NULL, new.created_at)
+        ON CONFLICT (user_id, course_id) DO UPDATE SET
+            note_count = note_count + 1,
+            image_count = image_count + excluded.image_count,
+            latest_note_at = CASE WHEN latest_note_at IS NULL OR excluded.latest_note_at > latest_note_at
+                             THEN excluded.latest_note_at ELSE latest_note_at END;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS course_note_stats_ad AFTER DELETE ON note
+    WHEN old.user_id IS NOT NULL BEGIN
+        UPDATE course_note_stats SET
+            note_count = note_count - 1,
+            image_count = image_count - (old.image_path IS NOT NULL),
+            -- Only deleting the latest note needs a new maximum, read from ix_note_user_course_created
+            latest_note_at = CASE WHEN old.created_at < latest_note_at THEN latest_note_at ELSE (
+                SELECT MAX(created_at) FROM note WHERE user_id = old.user_id AND course_id = old.course_id
+            ) END
+        WHERE user_id = old.user_id AND course_id = old.course_id;
+        DELETE FROM course_note_stats
+        WHERE user_id = old.user_id AND course_id = old.course_id AND note_count <= 0;
+    END""",
+    # A note moved to another user or course, or that gained or lost its image, counts as
+    # deleted from its old row and inserted into its new one
+    """CREATE TRIGGER IF NOT EXISTS course_note_stats_au_old AFTER UPDATE OF user_id, course_id, image_path ON note
+    WHEN old.user_id IS NOT NULL BEGIN
+        UPDATE course_note_stats SET
+            note_count = note_count - 1,
+            image_count = image_count - (old.image_path IS NOT NULL),
+            latest_note_at = (SELECT MAX(created_at) FROM note WHERE user_id = old.user_id AND course_id = old.course_id)
+        WHERE user_id = old.user_id AND course_id = old.course_id;
+        DELETE FROM course_note_stats
+        WHERE user_id = old.user_id AND course_id = old.course_id AND note_count <= 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS course_note_stats_au_new AFTER UPDATE OF user_id, course_id, image_path ON note
+    WHEN new.user_id IS NOT NULL BEGIN
+        INSERT INTO course_note_stats (user_id, course_id, note_count, image_count, latest_note_at)
+        VALUES (new.user_id, new.course_id, 1, new.image_path IS NOT NULL, new.created_at)
+        ON CONFLICT (user_id, course_id) DO UPDATE SET
+            note_count = note_count + 1,
+            image_count = image_count + excluded.image_count,
+            latest_note_at = CASE WHEN latest_note_at IS NULL OR excluded.latest_note_at > latest_note_at
+                             THEN excluded.latest_note_at ELSE latest_note_at END;
+    END""",
+]
+
+COURSE_NOTE_STATS_QUERY = """
+    SELECT user_id, course_id, COUNT(*), COUNT(image_path), MAX(created_at)
+    FROM note WHERE user_id IS NOT NULL GROUP BY user_id, course_id
+"""
+
+
+def rebuild_course_note_stats():
+    """Recompute every row of course_note_stats from the notes"""
+    db.session.execute(text('DELETE FROM course_note_stats'))
+    db.session.execute(text(
+        'INSERT INTO course_note_stats (user_id, course_id, note_count, image_count, latest_note_at)'
+        + COURSE_NOTE_STATS_QUERY
+    ))
+
+
+def course_note_stats(user_id, course_ids):
+    """Note statistics of a user's courses, by course id (courses without notes are missing)"""
+    if not user_id or not course_ids:
+        return {}
+    return {stats.course_id: stats for stats in
+            CourseNoteStats.query.filter(CourseNoteStats.user_id == user_id,
+                                         CourseNoteStats.course_id.in_(course_ids))}
+
+
+@app.cli.command('rebuild-course-stats')
+def rebuild_course_stats_command():
+    """Recompute the per-course note counts, image counts and latest note dates"""
+    rebuild_course_note_stats()
+    db.session.commit()
+    print(f"Rebuilt note statistics for {CourseNoteStats.query.count()} user courses.")
+
+
+# Tables whose writes are counted in table_version
+VERSIONED_TABLES = ('department', 'course', 'current_course', 'note', 'image_blob', 'course_name_override',
+                    'course_note_stats')
+
+
+def table_version_ddl(tables):
+    """Statements that register tables in table_version and bump it on every write"""
+    return [
+        f"INSERT OR IGNORE INTO table_version (name, version, updated_at) VALUES ('{table}', 1, CURRENT_TIMESTAMP)"
+        for table in tables
+    ] + [
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_version_{op[:3].lower()} AFTER {op} ON {table} BEGIN
+            UPDATE table_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE name = '{table}';
+        END"""
+        for table in tables for op in ('INSERT', 'UPDATE', 'DELETE')
+    ]
+
+
+# Schema migrations
+#
+# db.create_all() only creates missing tables, so changes to existing tables are applied
+# here. Each entry upgrades the schema by one version, tracked in PRAGMA user_version.
+# A step is either an SQL string or a callable; steps must also be safe to run on a
+# database freshly created by db.create_all().
+
+MIGRATIONS = [
+    # 1: indexes for the hot query shapes
+    [
+        # Drop duplicate current-course rows so the unique index can be built
+        """DELETE FROM current_course WHERE id NOT IN (
+            SELECT MIN(id) FROM current_course GROUP BY course_id
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_current_course_course_id ON current_course (course_id)",
+        "CREATE INDEX IF NOT EXISTS ix_course_department_year ON course (department_id, year)",
+        "CREATE INDEX IF NOT EXISTS ix_note_course_created ON note (course_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_note_created_at ON note (created_at)",
+    ],
+    # 2: table version counters for HTTP caching
+    table_version_ddl(('department', 'course', 'current_course', 'note', 'image_blob')),
+    # 3: natural keys for idempotent catalogue seeding
+    [
+        lambda: add_column('course', 'code VARCHAR(50)'),
+        lambda: backfill_course_codes(),
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_department_name ON department (name)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_course_natural_key ON course (department_id, year, semester, code)",
+    ],
+    # 4: user accounts; existing notes and current courses stay unowned until claimed
+    [
+        lambda: add_column('note', 'user_id INTEGER REFERENCES user (id)'),
+        lambda: add_column('current_course', 'user_id INTEGER REFERENCES user (id)'),
+        "DROP INDEX IF EXISTS uq_current_course_course_id",
+        "DROP INDEX IF EXISTS ix_note_course_created",
+        "DROP INDEX IF EXISTS ix_note_created_at",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_current_course_user_course ON current_course (user_id, course_id)",
+        "CREATE INDEX IF NOT EXISTS ix_note_user_created ON note (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_note_user_course_created ON note (user_id, course_id, created_at)",
+    ] + table_version_ddl(('course_name_override',)),
+    # 5: note versions for autosave and optimistic concurrency
+    [
+        lambda: add_column('note', 'version INTEGER NOT NULL DEFAULT 1'),
+    ],
+    # 6: per-course note statistics (the course_note_stats table comes from db.create_all())
+    COURSE_NOTE_STATS_DDL + [
+        lambda: rebuild_course_note_stats(),
+    ] + table_version_ddl(('course_note_stats',)),
+    # 7: delta sync (the note_tombstone table comes from db.create_all())
+    [
+        lambda: add_column('note', 'updated_at DATETIME'),
+        "UPDATE note SET updated_at = strftime('%Y-%m-%d %H:%M:%f000', 'now') WHERE updated_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_note_user_updated ON note (user_id, updated_at)",
+    ] + NOTE_SYNC_DDL,
+    # 8: compressed note bodies; init_search_index() rebuilds the index over note_plain
+    [
+        "DROP TRIGGER IF EXISTS note_fts_ai",
+        "DROP TRIGGER IF EXISTS note_fts_ad",
+        "DROP TRIGGER IF EXISTS note_fts_au",
+        "DROP TABLE IF EXISTS note_fts",
+        lambda: compress_note_bodies(),
+    ],
+    # 9: autosave revisions, the only ones later autosaves are merged into
+    [
+        lambda: add_column('note_revision', 'autosave BOOLEAN NOT NULL DEFAULT 0'),
+    ],
+    # 10: current courses in the order they were added
+    [
+        "CREATE INDEX IF NOT EXISTS ix_current_course_user_added ON current_course (user_id, added_at)",
+    ],
+]
+
+
+def compress_note_bodies():
+    """Store the existing long note bodies compressed, leaving their version and updated_at"""
+    note = Note.__table__
+    rows = db.session.execute(
+        select(note.c.id, note.c.notes)
+        .where(func.typeof(note.c.notes) == 'text',
+               func.length(db.cast(note.c.notes, db.LargeBinary)) >= app.config['NOTE_COMPRESS_MIN_BYTES'])
+    ).all()
+    for start in range(0, len(rows), 500):
+        db.session.execute(
+            note.update()
+            .where(note.c.id == bindparam('note_id'))
+            .values(notes=bindparam('body'), updated_at=note.c.updated_at),
+            [{'note_id': row.id, 'body': row.notes} for row in rows[start:start + 500]]
+        )
+
+
+def add_column(table, column_ddl):
+    """ALTER TABLE ... ADD COLUMN, unless db.create_all() already created the column"""
+    name = column_ddl.split()[0]
+    columns = {row[1] for row in db.session.execute(text(f'PRAGMA table_info({table})'))}
+    if name not in columns:
+        db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column_ddl}'))
+
+
+def migrate_db():
+    """Apply pending migrations, each in its own transaction"""
+    version = db.session.execute(text('PRAGMA user_version')).scalar()
+    for number, steps in enumerate(MIGRATIONS[version:], start=version + 1):
+        for step in steps:
+            if callable(step):
+                step()
+            else:
+                db.session.execute(text(step))
+        db.session.execute(text(f'PRAGMA user_version = {number}'))
+        db.session.commit()
+        print(f"Migrated database to version {number}.")
+
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Create missing tables and apply pending schema migrations"""
+    db.create_all()
+    migrate_db()
+    init_search_index()
+
+
+def hot_queries():
+    """The queries behind the busiest routes, with representative parameters"""
+    cursor = encode_cursor(Note(id=1, created_at=datetime(2025, 1, 1)))
+    return {
+        'courses': Course.query.filter_by(department_id=1, year=1),
+        'add_note': Note.query.filter_by(user_id=1, course_id=1).order_by(Note.created_at.desc()),
+        'toggle_current_course': CurrentCourse.query.filter_by(user_id=1, course_id=1),
+        'current_courses': current_courses_query(1),
+        'all_notes': notes_after(Note.query.filter_by(user_id=1), cursor).limit(app.config['NOTES_PAGE_SIZE'] + 1),
+    }
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail unless every hot query is answered from an index (EXPLAIN QUERY PLAN)"""
+    failures = 0
+    for route, query in hot_queries().items():
+        sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        plan = [row[-1] for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+        # A full table scan or a sort after the fact means an index is missing
+        bad = [step for step in plan if
+               (step.startswith('SCAN') and 'INDEX' not in step) or 'TEMP B-TREE' in step]
+        failures += bool(bad)
+        print(f"{'FAIL' if bad else 'ok'}  {route}: {'; '.join(plan)}")
+    if failures:
+        raise SystemExit(1)
+
+
+def read_catalogue(path):
+    """Read catalogue rows (department, year, semester, code, course_name) from a CSV file"""
+    with open(path, newline='', encoding='utf-8') as f:
+        return [
+            {
+                'department': row['department'].strip(),
+                'year': int(row['year']),
+                'semester': row['semester'].strip(),
+                'code': row['code'].strip(),
+                'course_name': row['course_name'].strip(),
+            }
+            for row in csv.DictReader(f)
+        ]
+
+
+def seed_catalogue(path):
+    """Insert the departments and courses from a catalogue file that are not in the database yet
+
+    Rows are matched on their natural keys (department name; department, year, semester
+    and course code), so re-running is idempotent and leaves renamed electives alone.
+    Everything is inserted with two executemany statements in one transaction.
+    """
+    rows = read_catalogue(path)
+    department_names = list(dict.fromkeys(row['department'] for row in rows))
+
+    departments_before = Department.query.count()
+    courses_before = Course.query.count()
+
+    db.session.execute(
+        sqlite_insert(Department).on_conflict_do_nothing(index_elements=['name']),
+        [{'name': name} for name in department_names]
+    )
+    department_ids = dict(
+        db.session.query(Department.name, Department.id).filter(Department.name.in_(department_names))
+    )
+    db.session.execute(
+        sqlite_insert(Course).on_conflict_do_nothing(
+            index_elements=['department_id', 'year', 'semester', 'code']
+        ),
+        [
+            {
+                'department_id': department_ids[row['department']],
+                'year': row['year'],
+                'semester': row['semester'],
+                'code': row['code'],
+                'course_name': row['course_name'],
+            }
+            for row in rows
+        ]
+    )
+    db.session.commit()
+
+    departments_added = Department.query.count() - departments_before
+    courses_added = Course.query.count() - courses_before
+    if departments_added or courses_added:
+        print(f"Catalogue loaded: {departments_added} departments and {courses_added} courses added.")
+
+
+def backfill_course_codes():
+    """Give courses seeded before the code column existed their catalogue code
+
+    A course keeps its code-like name unless it is an elective that was renamed, so
+    names are matched first and the remaining courses of each department, year and
+    semester are paired with the remaining catalogue entries in insertion order.
+    """
+    catalogue = defaultdict(list)
+    for row in read_catalogue(app.config['CATALOGUE_FILE']):
+        catalogue[(row['department'], row['year'], row['semester'])].append(row['code'])
+
+    uncoded = defaultdict(list)
+    query = (
+        db.session.query(Course, Department.name)
+        .join(Course.department)
+        .filter(Course.code.is_(None))
+        .order_by(Course.id)
+    )
+    for course, department_name in query:
+        uncoded[(department_name, course.year, course.semester)].append(course)
+
+    for key, courses in uncoded.items():
+        codes = catalogue.get(key, [])
+        unmatched = []
+        for course in courses:
+            code = ' '.join(course.course_name.split()).split(' - ')[0]
+            if code in codes:
+                course.code = code
+                codes.remove(code)
+            else:
+                unmatched.append(course)
+        for course, code in zip(unmatched, codes):
+            course.code = code
+    db.session.flush()
+
+
+def init_db():
+    with app.app_context():
+        db.create_all()
+        migrate_db()
+        init_search_index()
+        seed_catalogue(app.config['CATALOGUE_FILE'])
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the tables, apply migrations and seed the course catalogue"""
+    create_folders()
+    init_db()
+
+
+@app.cli.command('claim-shared-data')
+@click.argument('username')
+def claim_shared_data_command(username):
+    """Give the notes and current courses created before user accounts to one user
+
+    Electives renamed in the shared catalogue also get their catalogue name back,
+    with the custom name kept as this user's own name for the course.
+    """
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'No user named {username!r}')
+
+    notes = Note.query.filter(Note.user_id.is_(None)).update({'user_id': user.id})
+    current = CurrentCourse.query.filter(CurrentCourse.user_id.is_(None)).update({'user_id': user.id})
+
+    catalogue_names = {
+        (row['department'], row['year'], row['semester'], row['code']): row['course_name']
+        for row in read_catalogue(app.config['CATALOGUE_FILE'])
+    }
+    renamed = 0
+    for course, department_name in db.session.query(Course, Department.name).join(Course.department):
+        catalogue_name = catalogue_names.get((department_name, course.year, course.semester, course.code))
+        if not catalogue_name or course.course_name == catalogue_name:
+            continue
+        # Names that only differ in whitespace were not renamed, just seeded untidily
+        if ' '.join(course.course_name.split()) != catalogue_name:
+            if not CourseNameOverride.query.filter_by(user_id=user.id, course_id=course.id).first():
+                db.session.add(CourseNameOverride(user_id=user.id, course_id=course.id,
+                                                  course_name=course.course_name))
+            renamed += 1
+        course.course_name = catalogue_name
+
+    db.session.commit()
+    catalogue_cache.invalidate_catalogue()
+    print(f"{username} now owns {notes} notes and {current} current courses; {renamed} elective names moved.")
+
+
+@app.cli.command('load-catalogue')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def load_catalogue_command(path):
+    """Add the departments and courses of a catalogue CSV file"""
+    seed_catalogue(path)
+
+
+# Maintenance
+#
+# Commands for cron or an operator, all safe to run next to live workers: checks read
+# inside one snapshot, repairs are short write transactions, and files are only removed
+# once they are older than --min-age so uploads that have not committed yet are left alone.
+
+def referenced_uploads():
+    """Upload paths the database refers to: note images, image blobs and their variants"""
+    referenced = {path for path, in db.session.query(Note.image_path).filter(Note.image_path.isnot(None)).distinct()}
+    widths = set(app.config['IMAGE_VARIANT_WIDTHS'])
+    for blob in ImageBlob.query:
+        referenced.add(blob.path)
+        # Variants are written before their widths are recorded, so count every configured width
+        recorded = set(map(int, blob.variant_widths.split(','))) if blob.variant_widths else set()
+        referenced.update(blob.variant_path(width) for width in widths | recorded)
+    return referenced
+
+
+def human_size(size):
+    if size < 1024:
+        return f'{size} B'
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if size < 1024 or unit == 'GiB':
+            return f'{size:.1f} {unit}'
+
+
+@app.cli.command('gc-uploads')
+@click.option('--min-age', default=3600, show_default=True, help='Only remove files older than this many seconds.')
+@click.option('--dry-run', is_flag=True, help='List the orphaned files without removing them.')
+def gc_uploads_command(min_age, dry_run):
+    """Remove uploaded files that no note or image blob refers to"""
+    files = storage.files()
+    orphans = sorted(set(files) - referenced_uploads())
+    cutoff = time.time() - min_age
+    removed = freed = 0
+    for path in orphans:
+        # Check again right before removing: a new upload of the same content refreshes the mtime
+        stored = storage.stat(path)
+        if stored is None or stored.mtime > cutoff:
+            continue
+        print(f"{'would remove' if dry_run else 'removed'} {path} ({human_size(stored.size)})")
+        if not dry_run:
+            storage.delete([path])
+        removed += 1
+        freed += stored.size
+    skipped = len(orphans) - removed
+    print(f"{removed} orphaned files, {human_size(freed)}{' (dry run)' if dry_run else ''}; "
+          f"{skipped} newer than {min_age}s kept.")
+
+
+@app.cli.command('prune-tombstones')
+def prune_tombstones_command():
+    """Forget note deletions older than SYNC_TOMBSTONE_DAYS"""
+    # A day longer than clients may go without syncing, so a deletion committed while a
+    # client was syncing is still there on its next sync
+    cutoff = datetime.utcnow() - timedelta(days=app.config['SYNC_TOMBSTONE_DAYS'] + 1)
+    removed = NoteTombstone.query.filter(NoteTombstone.deleted_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    print(f"Removed {removed} note tombstones older than {app.config['SYNC_TOMBSTONE_DAYS'] + 1} days.")
+
+
+@app.cli.command('optimize-db')
+@click.option('--analyze', is_flag=True, help='ANALYZE every table, not only those PRAGMA optimize picks.')
+@click.option('--vacuum', is_flag=True, help='Also VACUUM, which blocks writers while it rewrites the file.')
+def optimize_db_command(analyze, vacuum):
+    """Refresh planner statistics, merge the search index and checkpoint the WAL"""
+    database = db.engine.url.database
+    size_before = os.path.getsize(database)
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        # Sample at most this many index rows per table so statistics stay quick on large tables
+        conn.exec_driver_sql('PRAGMA analysis_limit = 1000')
+        if analyze:
+            # Statistics of a nearly empty database can steer the planner to scans later on,
+            # which is why plain runs leave the choice of tables to PRAGMA optimize
+            conn.exec_driver_sql('ANALYZE')
+        # 0x10002: consider every table, not just the ones this connection has queried
+        conn.exec_driver_sql('PRAGMA optimize = 0x10002')
+        conn.exec_driver_sql("INSERT INTO note_fts(note_fts) VALUES ('optimize')")
+        if vacuum:
+            conn.exec_driver_sql('VACUUM')
+        busy, wal_pages, checkpointed = conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)').one()
+    print(f"Database {human_size(size_before)} -> {human_size(os.path.getsize(database))}; "
+          f"WAL checkpoint {'incomplete, readers still active' if busy else 'complete'}.")
+
+
+@app.cli.command('db-stats')
+def db_stats_command():
+    """Report the size of the database, its tables and the uploaded files"""
+    database = db.engine.url.database
+    wal = database + '-wal'
+
+    def pragma(name):
+        return db.session.execute(text(f'PRAGMA {name}')).scalar()
+
+    page_size, page_count, freelist = pragma('page_size'), pragma('page_count'), pragma('freelist_count')
+    print(f"Database: {database}")
+    print(f"  file {human_size(os.path.getsize(database))}, WAL {human_size(os.path.getsize(wal) if os.path.exists(wal) else 0)}, "
+          f"{page_count} pages of {page_size} B, {freelist} free ({human_size(freelist * page_size)} reclaimable by VACUUM)")
+
+    try:
+        sizes = dict(db.session.execute(text('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')).all())
+    except Exception:  # SQLite built without the dbstat table
+        db.session.rollback()
+        sizes = {}
+    for name in sorted(db.metadata.tables) + ['note_fts']:
+        rows = db.session.execute(text(f'SELECT COUNT(*) FROM {name}')).scalar()
+        size = f", {human_size(sizes[name])}" if name in sizes else ''
+        print(f"  {name}: {rows} rows{size}")
+
+    files = storage.files()
+    referenced = referenced_uploads()
+    originals = ({path for path, in db.session.query(ImageBlob.path)}
+                 | {path for path, in db.session.query(Note.image_path).filter(Note.image_path.isnot(None))})
+    variants = (referenced - originals) & set(files)
+    orphans = set(files) - referenced
+    print(f"Uploads: {storage}")
+    print(f"  {len(files)} files, {human_size(sum(stored.size for stored in files.values()))}; "
+          f"{len(variants)} variants, {human_size(sum(files[path].size for path in variants))}; "
+          f"{len(orphans)} orphaned, {human_size(sum(files[path].size for path in orphans))}")
+
+
+@app.cli.command('check-db')
+@click.option('--full', is_flag=True, help='Run the full integrity_check instead of quick_check.')
+@click.option('--repair', is_flag=True, help='Fix image reference counts and rebuild the search index.')
+def check_db_command(full, repair):
+    """Check the database and the uploaded files for corruption and inconsistencies"""
+    problems = 0
+
+    def report(ok, message):
+        nonlocal problems
+        problems += not ok
+        print(f"{'ok' if ok else 'FAIL'}  {message}")
+
+    result = [row[0] for row in db.session.execute(text(f"PRAGMA {'integrity_check' if full else 'quick_check'}"))]
+    report(result == ['ok'], f"{'integrity' if full else 'quick'} check: {'; '.join(result[:5])}")
+
+    dangling = db.session.execute(text('PRAGMA foreign_key_check')).all()
+    report(not dangling, f"{len(dangling)} rows point at missing rows"
+           + (f" ({', '.join(sorted({row[0] for row in dangling}))})" if dangling else ''))
+
+    try:
+        db.session.execute(text("INSERT INTO note_fts(note_fts, rank) VALUES ('integrity-check', 1)"))
+        db.session.rollback()
+        report(True, 'search index matches the notes')
+    except Exception as e:
+        db.session.rollback()
+        report(False, f'search index: {e}')
+        if repair:
+            db.session.execute(text("INSERT INTO note_fts(note_fts) VALUES ('rebuild')"))
             db.session.commit()
-            print("Software Engineering courses added.")
+            print('      search index rebuilt')
+
+    counts = dict(db.session.query(Note.image_path, func.count()).filter(Note.image_path.isnot(None))
+                  .group_by(Note.image_path))
+    wrong = [(blob, counts.get(blob.path, 0)) for blob in ImageBlob.query if blob.ref_count != counts.get(blob.path, 0)]
+    report(not wrong, f"{len(wrong)} image blobs have a wrong reference count")
+    if wrong and repair:
+        for blob, count in wrong:
+            if count:
+                blob.ref_count = count
+            else:
+                db.session.delete(blob)  # its files are removed by gc-uploads
+        db.session.commit()
+        print('      reference counts fixed')
+
+    stored = 'SELECT user_id, course_id, note_count, image_count, latest_note_at FROM course_note_stats'
+    computed = f'SELECT * FROM ({COURSE_NOTE_STATS_QUERY})'
+    stale = sum(db.session.execute(text(f'SELECT COUNT(*) FROM ({a} EXCEPT {b})')).scalar()
+                for a, b in ((stored, computed), (computed, stored)))
+    report(not stale, f"{stale} course note statistics rows differ from the notes")
+    if stale and repair:
+        rebuild_course_note_stats()
+        db.session.commit()
+        print('      course note statistics rebuilt')
+
+    files = storage.files()
+    missing = sorted(path for path in counts if path not in files)
+    report(not missing, f"{len(missing)} note images are missing from {storage}"
+           + (f" (e.g. {', '.join(missing[:3])})" if missing else ''))
+
+    if problems and not repair:
+        raise SystemExit(1)
+
 
 if __name__ == '__main__':
+    app.debug = True
+    create_app()
     init_db()
-    app.run(debug=True , host='0.0.0.0', port=5001)
+    app.run(host='0.0.0.0', port=5001)
 
 
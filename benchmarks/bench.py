@@ -0,0 +1,317 @@
+"""Benchmark every route against a synthetic database.
+
+Populates a throwaway database with N departments, M courses per department and K
+notes (some with images), then drives each route through Flask's test client and
+reports latency percentiles and throughput. Results are written as JSON; with
+--baseline the run fails when a route's p50 or p90 latency regresses past the
+stored baseline by more than --tolerance.
+
+    python benchmarks/bench.py --notes 20000 --output bench_results.json
+    python benchmarks/bench.py --save-baseline            # store benchmarks/baseline.json
+    python benchmarks/bench.py --baseline benchmarks/baseline.json --tolerance 0.25
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+WORDS = ('integral derivative matrix vector graph tree heap queue stack kernel thread process '
+         'memory circuit voltage current force energy entropy probability variance algorithm '
+         'complexity network protocol database index transaction compiler grammar automaton').split()
+
+# A 1x1 PNG, used for uploads when Pillow is not installed
+TINY_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489'
+    '0000000d4944415478da63f8cfc0f01f0005000201a5c1a0c20000000049454e44ae426082'
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--departments', type=int, default=20)
+    parser.add_argument('--courses', type=int, default=40, help='courses per department')
+    parser.add_argument('--notes', type=int, default=10000, help='notes of the benchmark user')
+    parser.add_argument('--other-notes', type=int, default=10000, help='notes spread over other users')
+    parser.add_argument('--users', type=int, default=50, help='other users sharing the database')
+    parser.add_argument('--image-ratio', type=float, default=0.1, help='share of notes with an image')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per route')
+    parser.add_argument('--concurrency', type=int, default=1, help='client threads per route')
+    parser.add_argument('--routes', help='comma-separated subset of routes to run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='fail on regressions against this results file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, 0.25 = 25%%')
+    parser.add_argument('--save-baseline', nargs='?', const=DEFAULT_BASELINE, metavar='PATH',
+                        help='also store the results as the baseline')
+    return parser.parse_args()
+
+
+def configure_environment(workdir):
+    """Point the app at a throwaway database and upload folder before it is imported"""
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['FLASK_UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.environ['FLASK_QUERY_COUNT_LIMIT'] = 'null'
+    os.environ['FLASK_UPLOAD_RATE_PER_MINUTE'] = 'null'
+    os.environ['FLASK_NOTE_WRITE_RATE_PER_MINUTE'] = 'null'
+    sys.path.insert(0, ROOT)
+
+
+def sample_image(rng):
+    """A small random image, so every upload gets its own content hash"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return TINY_PNG + rng.randbytes(16)
+    buffer = io.BytesIO()
+    color = tuple(rng.randrange(256) for _ in range(3))
+    Image.new('RGB', (1024, 768), color).save(buffer, 'JPEG', quality=70)
+    return buffer.getvalue()
+
+
+def note_text(rng, words=80):
+    return ' '.join(rng.choices(WORDS, k=words))
+
+
+def populate(args, rng):
+    """Fill the database with synthetic catalogue, users, notes and images"""
+    from werkzeug.datastructures import FileStorage
+    from app import (app, db, init_db, seed_catalogue, save_upload, generate_variants,
+                     User, Note, Course, CurrentCourse)
+
+    with app.app_context():
+        init_db()
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerow(['department', 'year', 'semester', 'code', 'course_name'])
+            for d in range(args.departments):
+                for c in range(args.courses):
+                    name = f'BENCH {c} - {"ELECTIVE " if c % 10 == 0 else ""}COURSE {c} OF DEPARTMENT {d}'
+                    writer.writerow([f'Bench Department {d}', c % 4 + 1, ('Fall', 'Spring')[c % 2], f'BENCH {c}', name])
+        seed_catalogue(f.name)
+        os.remove(f.name)
+
+        users = [User(username=f'bench{i}') for i in range(args.users + 1)]
+        users[0].set_password('benchmark')
+        for user in users[1:]:
+            user.password_hash = users[0].password_hash  # hashing is slow and they never log in
+        db.session.add_all(users)
+        db.session.commit()
+
+        course_ids = [course_id for course_id, in db.session.query(Course.id)]
+        bench_user = users[0].id
+        other_users = [user.id for user in users[1:]] or [bench_user]
+
+        images = []
+        image_count = int(args.notes * args.image_ratio)
+        for _ in range(min(image_count, 50)):  # notes share these, like re-uploaded slides
+            path = save_upload(FileStorage(io.BytesIO(sample_image(rng)), filename='bench.jpg'))
+            db.session.commit()
+            generate_variants(path)
+            images.append(path)
+
+        start = datetime(2024, 1, 1)
+        rows = []
+        for i in range(args.notes + args.other_notes):
+            own = i < args.notes
+            rows.append({
+                'user_id': bench_user if own else rng.choice(other_users),
+                'course_id': rng.choice(course_ids),
+                'notes': note_text(rng),
+                'image_path': rng.choice(images) if own and images and i < image_count else None,
+                'created_at': start + timedelta(minutes=i),
+            })
+        db.session.execute(Note.__table__.insert(), rows)
+        db.session.execute(CurrentCourse.__table__.insert(), [
+            {'user_id': bench_user, 'course_id': course_id, 'added_at': start}
+            for course_id in rng.sample(course_ids, min(8, len(course_ids)))
+        ])
+        db.session.commit()
+
+        first_course = db.session.get(Course, course_ids[0])
+        return {
+            'course_ids': course_ids,
+            'dept_id': first_course.department_id,
+            'note_ids': [note_id for note_id, in db.session.query(Note.id).filter(Note.user_id == bench_user)],
+        }
+
+
+def logged_in_client():
+    from app import app
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'bench0', 'password': 'benchmark'})
+    assert response.status_code == 302, 'benchmark user could not log in'
+    return client
+
+
+def scenarios(data, rng):
+    """Route name -> function(client) issuing one request; each returns the response"""
+    course_ids = data['course_ids']
+    note_ids = data['note_ids']
+
+    def add_note(client):
+        image = (io.BytesIO(sample_image(rng)), 'upload.jpg') if rng.random() < 0.5 else None
+        form = {'note': note_text(rng)}
+        if image:
+            form['image'] = image
+        return client.post(f'/add_note/{rng.choice(course_ids)}', data=form, content_type='multipart/form-data')
+
+    return {
+        'index': lambda client: client.get('/'),
+        'courses': lambda client: client.get(f"/courses/{data['dept_id']}/{rng.randint(1, 4)}"),
+        'current_courses': lambda client: client.get('/current_courses'),
+        'all_notes': lambda client: client.get('/all_notes'),
+        'add_note': add_note,
+        'update_note': lambda client: client.post(f'/update_note/{rng.choice(note_ids)}',
+                                                  json={'note': note_text(rng)}),
+        'toggle_current_course': lambda client: client.post(f'/toggle_current_course/{rng.choice(course_ids)}'),
+    }
+
+
+def request_error(response):
+    """The status, or the error of a JSON route that answered 200 with success: false"""
+    if response.status_code >= 400:
+        return response.status_code
+    if response.is_json:
+        body = response.get_json(silent=True)
+        if isinstance(body, dict) and body.get('success') is False:
+            return body.get('error', 'success: false')
+    return None
+
+
+def run_route(request, args):
+    """Issue warmup and measured requests from --concurrency threads"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_thread = max(1, args.requests // args.concurrency)
+
+    def worker():
+        client = logged_in_client()
+        for _ in range(args.warmup):
+            request(client)
+        local = []
+        for _ in range(per_thread):
+            t0 = time.perf_counter()
+            response = request(client)
+            local.append(time.perf_counter() - t0)
+            error = request_error(response)
+            if error is not None:
+                errors.append(error)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Warmup requests are included in the wall time, so throughput is measured separately
+    elapsed = sum(latencies) / args.concurrency
+
+    if errors:
+        raise SystemExit(f'{len(errors)} requests failed: {sorted(set(map(str, errors)))}')
+    latencies.sort()
+    ms = [value * 1000 for value in latencies]
+
+    def percentile(p):
+        return ms[min(len(ms) - 1, int(round(p / 100 * (len(ms) - 1))))]
+
+    return {
+        'requests': len(ms),
+        'mean_ms': round(statistics.fmean(ms), 3),
+        'p50_ms': round(percentile(50), 3),
+        'p90_ms': round(percentile(90), 3),
+        'p99_ms': round(percentile(99), 3),
+        'max_ms': round(ms[-1], 3),
+        'rps': round(len(ms) / elapsed, 1) if elapsed else None,
+        'wall_s': round(time.perf_counter() - started, 3),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the routes whose p50 or p90 latency regressed past the tolerance"""
+    ignored = {'routes', 'tolerance'}
+    params = {k: v for k, v in results['meta']['params'].items() if k not in ignored}
+    previous_params = {k: v for k, v in baseline.get('meta', {}).get('params', {}).items() if k not in ignored}
+    if params != previous_params:
+        print('Warning: the baseline was recorded with different parameters.')
+
+    regressions = []
+    for route, current in results['routes'].items():
+        previous = baseline.get('routes', {}).get(route)
+        if not previous:
+            continue
+        for metric in ('p50_ms', 'p90_ms'):
+            limit = previous[metric] * (1 + tolerance)
+            if current[metric] > limit:
+                regressions.append(f'{route} {metric}: {current[metric]:.2f} ms > {limit:.2f} ms '
+                                   f'(baseline {previous[metric]:.2f} ms)')
+    return regressions
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory(prefix='noteswise-bench-') as workdir:
+        configure_environment(workdir)
+        t0 = time.perf_counter()
+        data = populate(args, rng)
+        print(f'Populated database in {time.perf_counter() - t0:.1f}s')
+
+        routes = scenarios(data, rng)
+        selected = args.routes.split(',') if args.routes else list(routes)
+        results = {
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'params': {key: value for key, value in vars(args).items()
+                           if key not in ('output', 'baseline', 'save_baseline')},
+            },
+            'routes': {},
+        }
+
+        print(f"{'route':<24}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+        for name in selected:
+            stats = run_route(routes[name], args)
+            results['routes'][name] = stats
+            print(f"{name:<24}{stats['p50_ms']:>10.2f}{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['rps']:>10.1f}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline stored in {args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressions against baseline:')
+            for line in regressions:
+                print('  ' + line)
+            raise SystemExit(1)
+        print('No regressions against baseline.')
+
+
+if __name__ == '__main__':
+    main()
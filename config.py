@@ -2,8 +2,156 @@ import os
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# Only good for development, see Config.SECRET_KEY
+PLACEHOLDER_SECRET_KEY = 'your-secret-key-here'
+
 class Config:
-    SECRET_KEY = 'your-secret-key-here'
+    # Signs the session cookie, which holds the logged-in user, so anyone who knows the key can
+    # log in as anyone. Set FLASK_SECRET_KEY or SECRET_KEY in instance/config.py; create_app()
+    # refuses to start outside debug and testing mode while the placeholder is in use.
+    SECRET_KEY = PLACEHOLDER_SECRET_KEY
+    # The session cookie is not sent with POSTs from other sites, so they cannot delete or
+    # import notes as the logged-in user
+    SESSION_COOKIE_SAMESITE = 'Lax'
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'instance', 'yasar__uni.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    UPLOAD_FOLDER = os.path.join(basedir, 'static', 'uploads')
\ No newline at end of file
+    # Connections kept per worker process, and how many more may be opened under load
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+    }
+
+    # SQLite settings applied to every connection: WAL lets readers run alongside a
+    # writer, and busy_timeout makes writers wait instead of failing with "database is locked"
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_BUSY_TIMEOUT = 5000  # milliseconds
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE = -16000  # negative values are KiB
+    UPLOAD_FOLDER = os.path.join(basedir, 'static', 'uploads')
+    # Departments and courses seeded by `flask init-db`
+    CATALOGUE_FILE = os.path.join(basedir, 'data', 'catalogue.csv')
+
+    # Notes listed per page on /all_notes and /api/notes
+    NOTES_PAGE_SIZE = 50
+    NOTES_MAX_PAGE_SIZE = 200
+
+    # Maximum SQL statements a single request may issue in debug/test mode (None disables the check)
+    QUERY_COUNT_LIMIT = 10
+
+    # Image uploads: copy buffer size, background workers for resizing (0 = resize inline),
+    # and the widths of the WebP variants served through srcset
+    UPLOAD_CHUNK_SIZE = 64 * 1024
+    IMAGE_WORKERS = 2
+    IMAGE_VARIANT_WIDTHS = (320, 640, 1280)
+    IMAGE_WEBP_QUALITY = 80
+
+    # Upload admission: request bodies over MAX_CONTENT_LENGTH (IMPORT_MAX_CONTENT_LENGTH for
+    # archives sent to /import) are refused before they are read
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+    IMPORT_MAX_CONTENT_LENGTH = 1024 * 1024 * 1024
+
+    # Rate limits per client (the user, or the IP address when logged out) as token buckets of
+    # BURST requests refilled at PER_MINUTE (None disables a limit). 'memory' keeps the buckets
+    # in each worker process, so every worker allows the full rate; 'database' shares them
+    # between the workers. Buckets idle for RATE_LIMIT_IDLE_SECONDS are dropped from the database;
+    # the memory backend drops full buckets, and the least recently used beyond RATE_LIMIT_MAX_CLIENTS.
+    RATE_LIMIT_BACKEND = 'memory'
+    RATE_LIMIT_MAX_CLIENTS = 10000
+    RATE_LIMIT_IDLE_SECONDS = 24 * 3600
+    UPLOAD_RATE_BURST = 10
+    UPLOAD_RATE_PER_MINUTE = 20
+    NOTE_WRITE_RATE_BURST = 60
+    NOTE_WRITE_RATE_PER_MINUTE = 240
+
+    # Where uploads are stored: 'local' keeps them in UPLOAD_FOLDER, 's3' in a bucket of an
+    # S3-compatible store (needs boto3; set S3_ENDPOINT_URL for MinIO and other self-hosted
+    # stores). S3 downloads redirect to URLs presigned for S3_PRESIGN_EXPIRES seconds, unless
+    # UPLOAD_BASE_URL points at a public bucket or CDN. Files above S3_MULTIPART_THRESHOLD are
+    # transferred in S3_MULTIPART_CHUNK_SIZE parts by S3_MAX_CONCURRENCY threads.
+    STORAGE_BACKEND = 'local'
+    S3_BUCKET = None
+    S3_PREFIX = 'uploads/'
+    S3_ENDPOINT_URL = None
+    S3_REGION = None
+    S3_ACCESS_KEY_ID = None  # None uses the usual AWS credential chain
+    S3_SECRET_ACCESS_KEY = None
+    S3_PRESIGN_EXPIRES = 3600
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    S3_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+    S3_MAX_CONCURRENCY = 4
+    UPLOAD_BASE_URL = None
+
+    # Note bodies of NOTE_COMPRESS_MIN_BYTES or more are stored compressed: 'zstd' (needs the
+    # zstandard package, falls back to zlib), 'zlib', or None to store new bodies as plain text
+    NOTE_COMPRESSION = 'zstd'
+    NOTE_COMPRESS_MIN_BYTES = 1024
+    NOTE_COMPRESSION_LEVEL = 3
+
+    # HTTP responses: text bodies of COMPRESS_MIN_SIZE bytes or more are sent gzip-compressed at
+    # COMPRESS_LEVEL, or brotli-compressed at COMPRESS_BROTLI_QUALITY when the brotli package is
+    # installed. Turn this off when a reverse proxy already compresses responses.
+    COMPRESS_RESPONSES = True
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+
+    # Cache lifetime (seconds) of fingerprinted static files and content-addressed uploads
+    STATIC_MAX_AGE = 365 * 24 * 3600
+
+    # Seconds between checks of the in-process catalogue cache against writes from other processes
+    CATALOGUE_CACHE_TTL = 1.0
+    # Cached entries kept in memory, mostly per-user current course sets
+    CATALOGUE_CACHE_MAX_ENTRIES = 10000
+
+    # Rendered note cards and course items kept in memory per worker process (bytes of HTML),
+    # and where create_app() stores compiled templates for new workers (None compiles on every start)
+    FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    JINJA_BYTECODE_CACHE_DIR = os.path.join(basedir, 'instance', 'jinja_cache')
+
+    # Request instrumentation: Prometheus metrics at /metrics, an optional Server-Timing
+    # header, and an opt-in profiler that samples requests and keeps profiles of slow ones.
+    # /metrics only answers requests carrying "Authorization: Bearer <METRICS_TOKEN>" or coming
+    # from METRICS_ALLOWED_IPS (behind a reverse proxy every request comes from the proxy's
+    # address, so use the token there)
+    METRICS_ENABLED = True
+    METRICS_TOKEN = None
+    METRICS_ALLOWED_IPS = []
+    SERVER_TIMING = False
+    PROFILE_SLOW_REQUESTS = False
+    PROFILE_SAMPLE_RATE = 0.1
+    PROFILE_THRESHOLD_MS = 500
+    PROFILE_DIR = os.path.join(basedir, 'instance', 'profiles')
+
+    # Autosave: patches arriving within this many seconds are committed in one transaction
+    # (0 writes each patch in its own request); requests wait up to AUTOSAVE_TIMEOUT seconds
+    AUTOSAVE_BATCH_WINDOW = 0.05
+    AUTOSAVE_TIMEOUT = 10
+
+    # Note history: a full snapshot every REVISION_SNAPSHOT_INTERVAL revisions, deltas in
+    # between; autosaves within REVISION_MERGE_SECONDS of the latest autosave revision are folded into it
+    REVISION_SNAPSHOT_INTERVAL = 20
+    REVISION_MERGE_SECONDS = 60
+
+    # Export archives hold EXPORT_BATCH_SIZE notes per JSONL member; imports commit every
+    # IMPORT_BATCH_SIZE notes
+    EXPORT_BATCH_SIZE = 500
+    IMPORT_BATCH_SIZE = 500
+
+    # Most creations, deletions, additions and removals one /api/v1 batch request may carry
+    API_BATCH_LIMIT = 500
+
+    # Related notes on course pages (needs numpy and scipy): how many to show, the lowest cosine
+    # similarity worth showing, hashed term buckets, and how often (seconds) the index looks for
+    # notes written by other worker processes
+    RELATED_NOTES = True
+    RELATED_NOTES_COUNT = 5
+    RELATED_NOTES_MIN_SCORE = 0.1
+    RELATED_NOTES_FEATURES = 2 ** 18
+    RELATED_NOTES_REFRESH = 5.0
+
+    # Delta sync: notes per /api/v1/sync response, and how long deletions are remembered for
+    # clients; a client that has not synced for longer downloads every note again
+    SYNC_PAGE_SIZE = 200
+    SYNC_TOMBSTONE_DAYS = 30
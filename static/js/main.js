@@ -56,6 +56,9 @@ document.head.insertAdjacentHTML('beforeend', `
     </style>
 `);
 
+// Autosave delay after the last keystroke, in milliseconds
+const AUTOSAVE_DELAY = 800;
+
 // Edit note function
 function editNote(noteId, button) {
     const noteCard = button.closest('.note-card');
@@ -66,7 +69,7 @@ function editNote(noteId, button) {
     const editArea = document.createElement('div');
     editArea.className = 'edit-area';
     editArea.innerHTML = `
-        <textarea class="note-textarea editing">${currentText}</textarea>
+        <textarea class="note-textarea editing"></textarea>
         <div class="edit-actions">
             <button class="save-btn" onclick="saveNote(${noteId}, this)">
                 <i class="fas fa-save"></i> Save
@@ -74,14 +77,107 @@ function editNote(noteId, button) {
             <button class="cancel-btn" onclick="cancelEdit(this)">
                 <i class="fas fa-times"></i> Cancel
             </button>
+            <span class="autosave-status"></span>
         </div>
     `;
+    const textarea = editArea.querySelector('textarea');
+    textarea.value = currentText;
+
+    // Autosave state: the text and version the server last confirmed
+    editArea.autosave = {
+        savedText: currentText,
+        version: parseInt(noteCard.dataset.noteVersion, 10),
+        timer: null,
+        inFlight: false,
+        conflict: false,
+    };
+    textarea.addEventListener('input', () => scheduleAutosave(noteId, editArea));
 
     // Hide original content and insert edit area
     noteContent.style.display = 'none';
     noteContent.parentNode.insertBefore(editArea, noteContent.nextSibling);
 }
 
+// The single splice turning oldText into newText, found by trimming the common prefix and suffix
+function textChange(oldText, newText) {
+    let start = 0;
+    const maxStart = Math.min(oldText.length, newText.length);
+    while (start < maxStart && oldText[start] === newText[start]) {
+        start++;
+    }
+    let oldEnd = oldText.length;
+    let newEnd = newText.length;
+    while (oldEnd > start && newEnd > start && oldText[oldEnd - 1] === newText[newEnd - 1]) {
+        oldEnd--;
+        newEnd--;
+    }
+    // Never split a surrogate pair
+    if (start > 0 && /[\uD800-\uDBFF]/.test(oldText[start - 1])) {
+        start--;
+    }
+    if (/[\uDC00-\uDFFF]/.test(oldText[oldEnd] || '')) {
+        oldEnd++;
+        newEnd++;
+    }
+    return { start: start, end: oldEnd, text: newText.slice(start, newEnd) };
+}
+
+function setAutosaveStatus(editArea, message) {
+    editArea.querySelector('.autosave-status').textContent = message;
+}
+
+function scheduleAutosave(noteId, editArea) {
+    const state = editArea.autosave;
+    if (state.conflict) {
+        return;
+    }
+    clearTimeout(state.timer);
+    state.timer = setTimeout(() => autosaveNote(noteId, editArea), AUTOSAVE_DELAY);
+}
+
+// Send only what changed since the last saved version; one request at a time per note
+function autosaveNote(noteId, editArea) {
+    const state = editArea.autosave;
+    const text = editArea.querySelector('textarea').value;
+    if (state.inFlight || state.conflict || text === state.savedText) {
+        return;
+    }
+    state.inFlight = true;
+    setAutosaveStatus(editArea, 'Saving...');
+
+    fetch(`/api/notes/${noteId}/autosave`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ base_version: state.version, changes: [textChange(state.savedText, text)] })
+    })
+    .then(response => response.json().then(data => ({ status: response.status, data: data })))
+    .then(({ status, data }) => {
+        state.inFlight = false;
+        if (data.success) {
+            state.savedText = text;
+            state.version = data.version;
+            setAutosaveStatus(editArea, 'Saved');
+            noteChanged();
+            // Typing continued while the request was in flight
+            scheduleAutosave(noteId, editArea);
+        } else if (status === 409) {
+            state.conflict = true;
+            state.version = data.version;
+            state.savedText = data.note;
+            setAutosaveStatus(editArea, 'Changed in another window; press Save to keep your version');
+        } else {
+            setAutosaveStatus(editArea, 'Autosave failed');
+        }
+    })
+    .catch(error => {
+        state.inFlight = false;
+        console.error('Error:', error);
+        setAutosaveStatus(editArea, 'Autosave failed');
+    });
+}
+
 // Save edited note
 function saveNote(noteId, button) {
     const editArea = button.closest('.edit-area');
@@ -89,6 +185,13 @@ function saveNote(noteId, button) {
     const textarea = editArea.querySelector('textarea');
     const noteContent = noteCard.querySelector('.note-text');
     const newText = textarea.value;
+    const state = editArea.autosave;
+    clearTimeout(state.timer);
+    if (state.inFlight) {
+        // Wait for the running autosave so the save is based on its version
+        setTimeout(() => saveNote(noteId, button), 100);
+        return;
+    }
 
     // AJAX request to update the note
     fetch(`/update_note/${noteId}`, {
@@ -96,14 +199,24 @@ function saveNote(noteId, button) {
         headers: {
             'Content-Type': 'application/json',
         },
-        body: JSON.stringify({ note: newText })
+        body: JSON.stringify({ note: newText, version: state.version })
     })
-    .then(response => response.json())
-    .then(data => {
+    .then(response => response.json().then(data => ({ status: response.status, data: data })))
+    .then(({ status, data }) => {
         if (data.success) {
+            noteCard.dataset.noteVersion = data.version;
             noteContent.textContent = newText;
             noteContent.style.display = 'block';
             editArea.remove();
+            noteChanged();
+        } else if (status === 409) {
+            state.version = data.version;
+            state.savedText = data.note;
+            if (confirm('This note was changed in another window. Replace that version with yours?')) {
+                saveNote(noteId, button);
+            }
+        } else if (status === 429) {
+            alert(data.error);
         } else {
             alert('An error occurred while updating the note!');
         }
@@ -117,7 +230,323 @@ function saveNote(noteId, button) {
 // Cancel editing
 function cancelEdit(button) {
     const editArea = button.closest('.edit-area');
+    const noteCard = editArea.closest('.note-card');
     const noteContent = editArea.previousElementSibling;
+    const state = editArea.autosave;
+    clearTimeout(state.timer);
+    // Autosaved edits are already stored, so show what the server has
+    noteContent.textContent = state.savedText;
+    noteCard.dataset.noteVersion = state.version;
     noteContent.style.display = 'block';
     editArea.remove();
 }
+
+// Partial page updates: forms marked with data-fragment are sent with fetch, and the
+// server answers with just the changed fragment instead of a redirect and a full page
+const fragmentActions = {
+    // Swap the course item for the re-rendered one (Add/Remove from My Courses)
+    'replace-course': (form, html) => {
+        form.closest('.course-item').outerHTML = html;
+    },
+    // Drop the course item from the My Courses list
+    'remove-course': (form) => {
+        form.closest('.course-item').remove();
+    },
+    // Drop the deleted note card
+    'remove-note': (form) => {
+        form.closest('.note-card').remove();
+        noteChanged();
+    },
+    // Put the new note card at the top of the list and clear the form
+    'prepend-note': (form, html) => {
+        const section = document.querySelector('.notes-section');
+        const placeholder = section.querySelector('.no-notes');
+        if (placeholder) {
+            placeholder.remove();
+        }
+        section.querySelector('.section-title').insertAdjacentHTML('afterend', html);
+        form.reset();
+        const preview = form.querySelector('.image-preview');
+        if (preview) {
+            preview.remove();
+        }
+        noteChanged();
+    },
+};
+
+// Statuses of requests the server refused on purpose (see admission_error() in app.py)
+const REFUSED_STATUSES = [413, 415, 429];
+
+document.addEventListener('submit', function(event) {
+    const form = event.target;
+    const action = fragmentActions[form.dataset.fragment];
+    if (!action) {
+        return;
+    }
+    event.preventDefault();
+
+    const buttons = form.querySelectorAll('button[type="submit"]');
+    buttons.forEach(button => button.disabled = true);
+    fetch(form.action || window.location.href, {
+        method: 'POST',
+        headers: { 'X-Fragment': '1' },
+        body: new FormData(form)
+    })
+    .then(response => {
+        if (REFUSED_STATUSES.includes(response.status)) {
+            // Too large, not an image or too many requests: sending the form again would not help
+            return response.json().then(data => alert(data.error));
+        }
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        return response.text().then(html => action(form, html));
+    })
+    .catch(error => {
+        // Fall back to an ordinary form submission and page load
+        console.error('Error:', error);
+        delete form.dataset.fragment;
+        form.submit();
+    })
+    .finally(() => buttons.forEach(button => button.disabled = false));
+});
+
+// Offline-first notes: the user's notes are kept in IndexedDB and notes pages are rendered
+// from them at once; the service worker (static/js/sw.js) then asks the server for these pages
+// without their notes, and only what changed since the last sync is fetched from /api/v1/sync
+const NOTES_DB = 'noteswise';
+const NOTES_CACHE = 'noteswise-v1';
+
+function openNotesDb() {
+    return new Promise((resolve, reject) => {
+        const request = indexedDB.open(NOTES_DB, 1);
+        request.onupgradeneeded = () => {
+            const db = request.result;
+            db.createObjectStore('notes', { keyPath: 'id' }).createIndex('course_id', 'course_id');
+            db.createObjectStore('meta');
+        };
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+// Run fn(notesStore, metaStore) in one transaction; resolves with fn's result once committed
+function notesTransaction(mode, fn) {
+    return openNotesDb().then(db => new Promise((resolve, reject) => {
+        const transaction = db.transaction(['notes', 'meta'], mode);
+        const result = fn(transaction.objectStore('notes'), transaction.objectStore('meta'));
+        transaction.oncomplete = () => {
+            db.close();
+            resolve(result);
+        };
+        transaction.onerror = transaction.onabort = () => {
+            db.close();
+            reject(transaction.error);
+        };
+    }));
+}
+
+// Forget the saved notes and pages, e.g. after logging out on a shared computer
+function clearNotesCache() {
+    indexedDB.deleteDatabase(NOTES_DB);
+    if ('caches' in window) {
+        caches.delete(NOTES_CACHE);
+    }
+}
+
+// Saved notes of one course (or of every course), newest first like the server renders them
+function loadSavedNotes(courseId) {
+    const found = {};
+    return notesTransaction('readonly', notes => {
+        const request = courseId === null ? notes.getAll() : notes.index('course_id').getAll(courseId);
+        request.onsuccess = () => found.notes = request.result;
+        return found;
+    }).then(found => found.notes.sort(compareNotes));
+}
+
+function compareNotes(a, b) {
+    if (a.created_at !== b.created_at) {
+        return a.created_at < b.created_at ? 1 : -1;
+    }
+    return b.id - a.id;
+}
+
+// Store one /api/v1/sync response and the token to continue from
+function saveSyncPage(data) {
+    return notesTransaction('readwrite', (notes, meta) => {
+        if (data.reset) {
+            notes.clear();
+        }
+        data.notes.forEach(note => notes.put({
+            id: note.id,
+            course_id: note.course_id,
+            created_at: note.created_at,
+            version: note.version,
+            cursor: note.cursor,
+            html: note.html,
+        }));
+        data.deleted.forEach(id => notes.delete(id));
+        meta.put({ userId: data.user_id, token: data.token, more: data.more }, 'sync');
+    });
+}
+
+// Fetch every change since the saved token; resolves with the notes changed and ids deleted
+function fetchNoteChanges() {
+    const userId = Number(document.body.dataset.userId);
+    const changes = { reset: false, notes: [], deleted: [] };
+
+    function fetchPage(token) {
+        const query = token ? `&since=${encodeURIComponent(token)}` : '';
+        return fetch(`/api/v1/sync?html=1${query}`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(data => {
+                if (data.user_id !== userId) {
+                    throw new Error('Logged in as another user');
+                }
+                return saveSyncPage(data).then(() => {
+                    if (data.reset) {
+                        changes.reset = true;
+                        changes.notes = [];
+                        changes.deleted = [];
+                    }
+                    changes.notes.push(...data.notes);
+                    changes.deleted.push(...data.deleted);
+                    return data.more ? fetchPage(data.token) : changes;
+                });
+            });
+    }
+
+    const found = {};
+    return notesTransaction('readonly', (notes, meta) => {
+        const request = meta.get('sync');
+        request.onsuccess = () => found.sync = request.result;
+        return found;
+    }).then(found => {
+        // Notes saved for someone else are never shown or continued from
+        const sync = found.sync && found.sync.userId === userId ? found.sync : null;
+        return fetchPage(sync ? sync.token : null);
+    });
+}
+
+// One sync at a time; a sync requested while one runs starts after it
+let notesSync = Promise.resolve();
+function syncNotes() {
+    notesSync = notesSync.catch(() => null).then(fetchNoteChanges);
+    return notesSync;
+}
+
+// The list of notes on this page: one course's (data-notes-course) or all of them (data-notes-all)
+function notesSection() {
+    return document.querySelector('.notes-section[data-notes-course], .notes-section[data-notes-all]');
+}
+
+function sectionCourseId(section) {
+    return section.dataset.notesCourse === undefined ? null : Number(section.dataset.notesCourse);
+}
+
+function updateNotesPlaceholder(section) {
+    const placeholder = section.querySelector('.no-notes');
+    if (placeholder) {
+        placeholder.hidden = section.querySelector('.note-card') !== null;
+    }
+}
+
+// Fill a page that was served without its notes from the saved ones
+function renderSavedNotes(section) {
+    return loadSavedNotes(sectionCourseId(section)).then(notes => {
+        section.querySelectorAll('.note-card').forEach(card => card.remove());
+        const pageSize = section.dataset.pageSize ? Number(section.dataset.pageSize) : notes.length;
+        const shown = notes.slice(0, pageSize);
+        section.insertAdjacentHTML('beforeend', shown.map(note => note.html).join(''));
+        updateNotesPlaceholder(section);
+
+        // Older notes are paged by the server from the last one shown
+        const pagination = document.querySelector('.pagination');
+        if (pagination && notes.length > shown.length) {
+            pagination.querySelector('a').href = `/all_notes?cursor=${encodeURIComponent(shown[shown.length - 1].cursor)}`;
+            pagination.hidden = false;
+        }
+    });
+}
+
+// Put a note card in created_at order, leaving cards that are being edited alone
+function placeNoteCard(section, note) {
+    const card = section.querySelector(`.note-card[data-note-id="${note.id}"]`);
+    if (card) {
+        if (!card.querySelector('.edit-area') && Number(card.dataset.noteVersion) < note.version) {
+            card.outerHTML = note.html;
+        }
+        return;
+    }
+    const cards = Array.from(section.querySelectorAll('.note-card'));
+    const next = cards.find(other => compareNotes(note, {
+        created_at: other.dataset.createdAt,
+        id: Number(other.dataset.noteId),
+    }) < 0);
+    if (next) {
+        next.insertAdjacentHTML('beforebegin', note.html);
+    } else if (!section.dataset.pageSize || cards.length < Number(section.dataset.pageSize)) {
+        section.insertAdjacentHTML('beforeend', note.html);
+    }
+}
+
+// Bring the notes shown on this page up to date with a sync
+function showNoteChanges(section, changes) {
+    if (changes.reset) {
+        return section.hasAttribute('data-notes-shell') ? renderSavedNotes(section) : null;
+    }
+    const courseId = sectionCourseId(section);
+    changes.deleted.forEach(id => {
+        const card = section.querySelector(`.note-card[data-note-id="${id}"]`);
+        if (card && !card.querySelector('.edit-area')) {
+            card.remove();
+        }
+    });
+    changes.notes.forEach(note => {
+        if (courseId === null || note.course_id === courseId) {
+            placeNoteCard(section, note);
+        }
+    });
+    updateNotesPlaceholder(section);
+}
+
+// Keep the saved notes current after this page changed one
+function noteChanged() {
+    if ('indexedDB' in window && document.body.dataset.userId) {
+        refreshNotes().catch(error => console.error('Error:', error));
+    }
+}
+
+function refreshNotes() {
+    const section = notesSection();
+    return syncNotes().then(changes => {
+        // Later pages of /all_notes and streamed pages are left as the server rendered them
+        if (section && !window.location.search) {
+            return showNoteChanges(section, changes);
+        }
+    });
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    if (!('indexedDB' in window)) {
+        return;
+    }
+    if (!document.body.dataset.userId) {
+        clearNotesCache();
+        return;
+    }
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register('/sw.js').catch(error => console.error('Error:', error));
+    }
+
+    const section = notesSection();
+    const rendered = section && section.hasAttribute('data-notes-shell') ? renderSavedNotes(section) : Promise.resolve();
+    rendered
+        .then(refreshNotes)
+        .catch(error => console.error('Error:', error));
+});
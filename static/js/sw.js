@@ -0,0 +1,94 @@
+// Service worker: notes pages are fetched without their notes when this browser already
+// holds the user's notes (main.js renders them from IndexedDB and syncs the changes), static
+// assets and uploads are answered from the cache, and the last notes pages stay readable offline.
+
+const CACHE_NAME = 'noteswise-v1';
+const NOTES_DB = 'noteswise';
+
+// Pages listing notes, which the server can send as a shell without the notes
+const NOTES_PAGES = [/^\/add_note\/\d+$/, /^\/all_notes$/];
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(names.filter(name => name !== CACHE_NAME).map(name => caches.delete(name))))
+            .then(() => self.clients.claim())
+    );
+});
+
+// The user whose notes are in IndexedDB, or null before the first complete sync
+function cachedUserId() {
+    return new Promise(resolve => {
+        const request = indexedDB.open(NOTES_DB);
+        request.onupgradeneeded = () => request.transaction.abort();
+        request.onerror = () => resolve(null);
+        request.onsuccess = () => {
+            const db = request.result;
+            if (!db.objectStoreNames.contains('meta')) {
+                db.close();
+                resolve(null);
+                return;
+            }
+            const get = db.transaction('meta').objectStore('meta').get('sync');
+            get.onsuccess = () => {
+                const sync = get.result;
+                resolve(sync && !sync.more ? sync.userId : null);
+                db.close();
+            };
+            get.onerror = () => {
+                resolve(null);
+                db.close();
+            };
+        };
+    });
+}
+
+async function notesPage(request) {
+    const userId = await cachedUserId();
+    const headers = userId ? { 'X-Notes-Cache': String(userId) } : {};
+    try {
+        // Redirects (e.g. to the login page) are handed back to the browser to follow
+        const response = await fetch(request.url, { headers: headers, credentials: 'same-origin', redirect: 'manual' });
+        if (response.ok) {
+            const cache = await caches.open(CACHE_NAME);
+            await cache.put(request.url, response.clone());
+        }
+        return response;
+    } catch (error) {
+        const cached = await caches.match(request.url);
+        if (cached) {
+            return cached;
+        }
+        throw error;
+    }
+}
+
+// Fingerprinted assets (?v=<hash>) and content-addressed uploads never change
+async function cacheFirst(request) {
+    const cached = await caches.match(request);
+    if (cached) {
+        return cached;
+    }
+    const response = await fetch(request);
+    if (response.ok && response.type === 'basic') {
+        const cache = await caches.open(CACHE_NAME);
+        await cache.put(request, response.clone());
+    }
+    return response;
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== self.location.origin) {
+        return;
+    }
+    if (request.mode === 'navigate' && !url.search && NOTES_PAGES.some(pattern => pattern.test(url.pathname))) {
+        event.respondWith(notesPage(request));
+    } else if ((url.pathname.startsWith('/static/') && url.searchParams.has('v'))
+               || /^\/uploads\/[0-9a-f]{2}\/[0-9a-f]{64}/.test(url.pathname)) {
+        event.respondWith(cacheFirst(request));
+    }
+});
@@ -0,0 +1,28 @@
+"""Every test module shares one throwaway database, set up before the app is imported"""
+import os
+import sys
+import tempfile
+
+WORKDIR = tempfile.mkdtemp(prefix='noteswise-test-')
+os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(WORKDIR, 'test.db')
+os.environ['FLASK_UPLOAD_FOLDER'] = os.path.join(WORKDIR, 'uploads')
+os.environ['FLASK_AUTOSAVE_BATCH_WINDOW'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from app import app, init_db
+
+
+@pytest.fixture(scope='session')
+def make_client():
+    """Return a function that registers a user and returns a test client logged in as them"""
+    app.testing = True
+    with app.app_context():
+        init_db()
+
+    def make(username):
+        client = app.test_client()
+        client.post('/register', data={'username': username, 'password': 'password1'})
+        return client
+    return make
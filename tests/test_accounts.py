@@ -0,0 +1,21 @@
+"""Accounts: logging in only redirects within the site"""
+import pytest
+
+from app import app
+
+
+@pytest.mark.parametrize('next_url, expected', [
+    ('/all_notes', '/all_notes'),
+    ('//evil.com', '/'),
+    ('/\\evil.com', '/'),
+    ('/\t/evil.com', '/'),
+    ('https://evil.com/', '/'),
+])
+def test_login_redirects_only_within_site(make_client, next_url, expected):
+    make_client('grace')
+    client = app.test_client()
+    response = client.post('/login', query_string={'next': next_url},
+                           data={'username': 'grace', 'password': 'password1'})
+    assert response.status_code == 302
+    assert response.headers['Location'] == expected
+    assert 'SameSite=Lax' in response.headers['Set-Cookie']
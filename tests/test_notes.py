@@ -0,0 +1,77 @@
+"""Notes pages: cached note cards, imported notes and shared images"""
+
+import io
+import json
+import tarfile
+
+
+def test_reused_note_id_does_not_show_cached_card(make_client):
+    alice, bob = make_client('alice'), make_client('bob')
+    created = alice.post('/api/v1/notes/batch', json={'create': [{'course_id': 1, 'notes': 'ALICE SECRET'}]})
+    note_id = created.get_json()['created'][0]['id']
+    assert b'ALICE SECRET' in alice.get('/all_notes').data
+
+    alice.post('/api/v1/notes/batch', json={'delete': [note_id]})
+    created = bob.post('/api/v1/notes/batch', json={'create': [{'course_id': 1, 'notes': 'bob note'}]})
+    assert created.get_json()['created'][0]['id'] == note_id
+    page = bob.get('/all_notes').data
+    assert b'bob note' in page and b'ALICE SECRET' not in page
+
+
+def test_batch_delete_drops_cached_cards(make_client):
+    from app import fragment_cache, NOTE_CARD
+    client = make_client('carol')
+    created = client.post('/api/v1/notes/batch', json={'create': [{'course_id': 2, 'notes': 'short lived'}]})
+    note_id = created.get_json()['created'][0]['id']
+    client.get('/all_notes')
+    assert fragment_cache._rows.get((NOTE_CARD, note_id))
+
+    client.post('/api/v1/notes/batch', json={'delete': [note_id]})
+    assert (NOTE_CARD, note_id) not in fragment_cache._rows
+
+
+def test_import_without_created_at(make_client):
+    client = make_client('dave')
+    client.post('/api/v1/notes/batch', json={'create': [{'course_id': 3, 'notes': 'exported'}]})
+    exported = tarfile.open(fileobj=io.BytesIO(client.get('/export').data))
+
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as out:
+        for member in exported:
+            data = exported.extractfile(member).read()
+            if member.name.startswith('notes/'):
+                record = json.loads(data)
+                undated = dict(record, notes='undated', created_at=None)
+                missing = {key: value for key, value in record.items() if key != 'created_at'}
+                missing['notes'] = 'no date at all'
+                data = '\n'.join(json.dumps(line) for line in (undated, missing)).encode() + b'\n'
+                member.size = len(data)
+            out.addfile(member, io.BytesIO(data))
+    archive.seek(0)
+    client.post('/import', data={'archive': (archive, 'notes.tar')}, content_type='multipart/form-data')
+
+    page = client.get('/all_notes')
+    assert page.status_code == 200
+    assert b'undated' in page.data and b'no date at all' in page.data
+
+
+def test_shared_image_is_removed_with_its_last_note(make_client):
+    from app import app, db, ImageBlob, Note
+    client = make_client('frank')
+    png = bytes.fromhex('89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489'
+                        '0000000d4944415478da63f8cfc0f01f0005000201a5c1a0c20000000049454e44ae426082')
+    for course_id in (7, 8):
+        client.post(f'/add_note/{course_id}', data={'note': 'slide', 'image': (io.BytesIO(png), 'slide.png')},
+                    content_type='multipart/form-data')
+    with app.app_context():
+        notes = Note.query.filter(Note.image_path.isnot(None), Note.course_id.in_((7, 8))).all()
+        path = notes[0].image_path
+        assert [note.image_path for note in notes] == [path, path]
+        assert db.session.get(ImageBlob, path).ref_count == 2
+
+    client.post(f'/delete_note/{notes[0].id}')
+    with app.app_context():
+        assert db.session.get(ImageBlob, path).ref_count == 1
+    client.post(f'/delete_note/{notes[1].id}')
+    with app.app_context():
+        assert db.session.get(ImageBlob, path) is None
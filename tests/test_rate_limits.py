@@ -0,0 +1,18 @@
+"""Rate limits: in-memory token buckets stay bounded"""
+import time
+
+from app import app, MemoryRateLimiter
+
+
+def test_memory_buckets_evict_full_and_least_recently_used(monkeypatch):
+    monkeypatch.setitem(app.config, 'RATE_LIMIT_MAX_CLIENTS', 3)
+    limiter = MemoryRateLimiter()
+    limiter.take('refilled', 1, 1000)
+    time.sleep(0.01)
+    for key in ('a', 'b', 'c', 'd'):
+        limiter.take(key, 5, 1)
+    assert list(limiter._buckets) == ['b', 'c', 'd']
+
+    assert limiter.take('b', 5, 1) == 0
+    limiter.take('e', 5, 1)
+    assert list(limiter._buckets) == ['d', 'b', 'e']
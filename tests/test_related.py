@@ -0,0 +1,34 @@
+"""Related notes: the index is only rebuilt when notes change"""
+import time
+
+import pytest
+
+pytest.importorskip('scipy')
+
+from app import app, related_index
+
+
+def build():
+    with app.app_context():
+        related_index._build()
+    return related_index._snapshot
+
+
+def test_refresh_without_writes_keeps_snapshot(make_client, monkeypatch):
+    monkeypatch.setattr(related_index, '_start', lambda: None)  # build here, not on a thread
+    while related_index._running:  # builds started by earlier tests
+        time.sleep(0.01)
+    client = make_client('erin')
+    client.post('/api/v1/notes/batch', json={'create': [{'course_id': 4, 'notes': 'matrix vector'},
+                                                        {'course_id': 5, 'notes': 'matrix kernel'}]})
+    snapshot = build()
+    assert build() is snapshot
+
+    created = client.post('/api/v1/notes/batch', json={'create': [{'course_id': 6, 'notes': 'vector kernel'}]})
+    note_id = created.get_json()['created'][0]['id']
+    updated = build()
+    assert updated is not snapshot and note_id in updated.ids
+    assert build() is updated
+
+    client.post('/api/v1/notes/batch', json={'delete': [note_id]})
+    assert note_id not in build().ids
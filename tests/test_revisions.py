@@ -0,0 +1,48 @@
+"""Note history: quick edits must not fold away earlier revisions.
+
+    python -m pytest tests
+"""
+import pytest
+
+from app import app, NoteRevision
+
+
+@pytest.fixture(scope='module')
+def client(make_client):
+    return make_client('history')
+
+
+def create_note(client, text):
+    client.post('/add_note/1', data={'note': text}, headers={'X-Fragment': '1'})
+    return client.get('/api/v1/notes?fields=id,version&limit=1').get_json()['notes'][0]
+
+
+def revisions(note_id):
+    with app.app_context():
+        return [(r.version, r.autosave) for r in
+                NoteRevision.query.filter_by(note_id=note_id).order_by(NoteRevision.version)]
+
+
+def test_restore_first_version_after_quick_edit_and_autosave(client):
+    note = create_note(client, 'original text')
+    response = client.post(f"/update_note/{note['id']}", json={'note': 'edited text', 'version': 1})
+    assert response.get_json() == {'success': True, 'version': 2}
+    response = client.post(f"/api/notes/{note['id']}/autosave",
+                           json={'base_version': 2, 'changes': [{'start': 0, 'end': 6, 'text': 'autosaved'}]})
+    assert response.get_json() == {'success': True, 'version': 3}
+    assert revisions(note['id']) == [(1, False), (2, False), (3, True)]
+
+    response = client.post(f"/notes/{note['id']}/restore/1", json={})
+    assert response.status_code == 200
+    restored = client.get(f"/api/v1/notes/{note['id']}?fields=notes,version").get_json()
+    assert restored['note'] == {'notes': 'original text', 'version': 4}
+
+
+def test_autosaves_merge_into_autosave_revision_only(client):
+    note = create_note(client, 'abc')
+    for version in (1, 2):
+        response = client.post(f"/api/notes/{note['id']}/autosave",
+                               json={'base_version': version, 'changes': [{'start': 0, 'end': 0, 'text': 'x'}]})
+        assert response.get_json()['success']
+    # The creation snapshot is kept; the second autosave is folded into the first
+    assert revisions(note['id']) == [(1, False), (3, True)]
@@ -0,0 +1,4 @@
+"""WSGI entry point for production servers, e.g. `gunicorn -w 4 wsgi:app`"""
+from app import create_app
+
+app = create_app()